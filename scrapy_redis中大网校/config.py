@@ -38,6 +38,9 @@ REDIS_PARAMS = {
     'password': '',  # 密码
 
 }
+# cookie_get.py 获取到新Cookie后同时写入这个Redis key（并递增 <key>:version），
+# 爬虫在其它机器上时可以从Redis热更新Cookie；留空表示只写文件
+COOKIE_REDIS_KEY = ""
 
 # ==================== MySQL数据库配置 ====================
 # MySQL连接配置
@@ -80,6 +83,9 @@ COOKIES_DIR = RESULTS_DIR / "cookies"  # Cookie保存目录
 CAPTCHA_DIR = RESULTS_DIR / "captchas"  # 验证码图片目录
 SCREENSHOTS_DIR = RESULTS_DIR / "screenshots"  # 错误截图目录
 LOGS_DIR = RESULTS_DIR / "logs"  # 日志目录
+IMAGE_CACHE_DIR = RESULTS_DIR / "image_cache"  # Markdown导出的图片缓存目录
+SEARCH_DB_FILE = str(RESULTS_DIR / "questions.sqlite3")  # 本地全文检索数据库（redis_to_sqlite.py）
+DEDUP_DB_FILE = str(RESULTS_DIR / "dedup.sqlite3")  # 题目去重指纹库（dedup_questions.py）
 
 # 创建所有需要的目录
 for directory in [RESULTS_DIR, COOKIES_DIR, CAPTCHA_DIR, SCREENSHOTS_DIR, LOGS_DIR]:
@@ -1,6 +1,8 @@
+import os
 import time
 import json
 import logging
+import redis
 from datetime import datetime
 from pathlib import Path
 
@@ -37,6 +39,9 @@ try:
 
         # 目录路径
         RESULTS_DIR, COOKIES_DIR, CAPTCHA_DIR,
+
+        # Redis配置（发布Cookie）
+        REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PARAMS, COOKIE_REDIS_KEY,
     )
 
     # 导入超级鹰客户端
@@ -408,10 +413,29 @@ class CookieFetcher:
         logger.info(f"Cookie保存到: {timestamped_file}")
 
         # 保存最新版本（使用配置文件中的路径）
-        with open(COOKIE_LATEST_FILE, "w", encoding="utf-8") as f:
+        # 先写临时文件再改名，正在运行的爬虫热更新时不会读到写了一半的文件
+        tmp_file = f"{COOKIE_LATEST_FILE}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, COOKIE_LATEST_FILE)
         logger.info(f"最新Cookie: {COOKIE_LATEST_FILE}")
 
+        if COOKIE_REDIS_KEY:
+            self.publish_cookies(data)
+
+    def publish_cookies(self, data):
+        """写入Redis并递增版本号（同一个事务），爬虫的CookieInjectionMiddleware看到版本变化后换上新Cookie"""
+        try:
+            client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+                                 password=REDIS_PARAMS.get('password') or None)
+            pipe = client.pipeline(transaction=True)
+            pipe.set(COOKIE_REDIS_KEY, json.dumps(data, ensure_ascii=False))
+            pipe.incr(f"{COOKIE_REDIS_KEY}:version")
+            version = pipe.execute()[1]
+            logger.info(f"Cookie已发布到Redis: {COOKIE_REDIS_KEY}（版本 {version}）")
+        except Exception as e:
+            logger.error(f"Cookie发布到Redis失败: {e}")
+
     def run_forever(self):
         """7x24小时运行"""
         logger.info("=" * 60)
@@ -0,0 +1,96 @@
+"""
+Markdown写入基准：逐题追加（save_single_md 的 a+ 读全文件再追加） vs 聚合后一次性写入（--group）
+
+不需要Redis和网络，使用生成的题目；两种方式的输出（除保存时间外）必须完全一致
+
+用法：
+    python data_tools/bench_md_writer.py                       # 20个文件，每个文件500道题
+    python data_tools/bench_md_writer.py --files 5 --per-file 3000
+"""
+import argparse
+import asyncio
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from redis_to_md import AsyncMDExporter, MarkdownGrouper, write_queue
+
+# 保存时间每次运行都不同，比较输出前去掉
+_SAVE_TIME_RE = re.compile(r'\*题目保存时间: [^*]*\*')
+
+
+def make_items(files: int, per_file: int):
+    """生成题目，按文件轮流排列（和Redis中不同章节交错的顺序类似）"""
+    items = []
+    for n in range(per_file):
+        for f in range(files):
+            items.append({
+                'path': ['税务师', '税法二', f'第{f}章车船税', '第二节征税范围、纳税人和适用税额', f'知识点{f}'],
+                'content': f'<p>第{f}章第{n}题：有关船税的计税依据，下列表述正确的有（）。</p>',
+                'options': ['A、车辆整备质量尾数在0.5吨以下的不计算车船税', 'B、挂车按载货汽车货车税额的50％计征车船税',
+                            'C、已缴纳车船税的车船在同一纳税年度内办理转让过户的，需另行纳税', 'D、非机动驳船，免征车船税'],
+                'textAnalysis': 'B<p>解析：挂车按照货车税额的50%计算。</p><p>（知识点：税目、税额）</p>' * 3,
+            })
+    return items
+
+
+async def save_all(exporter: AsyncMDExporter, items, output_base: Path):
+    """和导出时一样通过process_batch保存"""
+    async def source():
+        for item in items:
+            yield item
+
+    await exporter.process_batch(source(), output_base)
+
+
+async def bench_append(items, output_base: Path) -> float:
+    exporter = AsyncMDExporter()
+    start = time.perf_counter()
+    await save_all(exporter, items, output_base)
+    # 等写入队列全部完成
+    await write_queue.close()
+    return time.perf_counter() - start
+
+
+async def bench_group(items, output_base: Path, buffer_mb: int) -> float:
+    exporter = AsyncMDExporter()
+    exporter.grouper = MarkdownGrouper(max_buffer_bytes=buffer_mb * 1024 * 1024)
+    start = time.perf_counter()
+    await save_all(exporter, items, output_base)
+    await asyncio.to_thread(exporter.grouper.write_all)
+    return time.perf_counter() - start
+
+
+def read_outputs(output_base: Path):
+    return {p.relative_to(output_base): _SAVE_TIME_RE.sub('', p.read_text(encoding='utf-8'))
+            for p in output_base.rglob('*.md')}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Markdown写入基准')
+    parser.add_argument('--files', type=int, default=20, help='生成多少个md文件')
+    parser.add_argument('--per-file', type=int, default=500, help='每个文件多少道题')
+    parser.add_argument('--group-buffer-mb', type=int, default=256, help='聚合模式的内存上限，设小一点可以测试落盘')
+    args = parser.parse_args()
+
+    items = make_items(args.files, args.per_file)
+    print(f"📊 {len(items)} 道题，{args.files} 个文件")
+    print("=" * 50)
+
+    work_dir = Path(tempfile.mkdtemp(prefix='bench_md_'))
+    try:
+        append_time = await bench_append(items, work_dir / 'append')
+        group_time = await bench_group(items, work_dir / 'group', args.group_buffer_mb)
+
+        assert read_outputs(work_dir / 'append') == read_outputs(work_dir / 'group'), "两种方式的输出不一致"
+
+        print(f"逐题追加:   {append_time:8.2f} s")
+        print(f"聚合写入:   {group_time:8.2f} s   提速: {append_time / max(group_time, 1e-9):6.1f}x")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+"""
+HTML清洗微基准：旧的逐字符实现 vs html_sanitizer
+
+用法：
+    python data_tools/bench_sanitizer.py              # 使用内置的真实题目样本
+    python data_tools/bench_sanitizer.py --redis 2000 # 从Redis读取前2000条题目
+"""
+import argparse
+import json
+import re
+import timeit
+
+import html_sanitizer
+
+# 从questions:items中截取的真实题目
+SAMPLE_ITEMS = [
+    {
+        'content': '<p>有关船税的计税依据，下列表述正确的有（）。</p>',
+        'textAnalysis': 'B<p>如图所示：<img title="1.png" src="http://img.wangxiao.cn/bjupload/2020-10-29/53f7a0c0-57de-45d4-aef7-e8137f5309e4.png" /><br /></p><p>（知识点：税目、税额）</p><p>（题库维护老师：zhx）</p>',
+    },
+    {
+        'content': '<p>题目内容<img src="http://img.wangxiao.cn/bjupload/2020-10-29/53f7a0c0-57de-45d4-aef7-e8137f5309e4.png" alt="图片">更多内容</p>',
+        'textAnalysis': 'B<p>解析内容<img src="http://img.wangxiao.cn/bjupload/2019-08-29/b1f990aa-a6a9-43dc-8807-3284ab9a36e9.png">更多解析</p>',
+    },
+    {
+        'content': '<img src="http://img.wangxiao.cn/bjupload/2019-08-29/b1f990aa-a6a9-43dc-8807-3284ab9a36e9.png"><p>图片在前</p>',
+        'textAnalysis': '1<p>判断题解析</p>',
+    },
+]
+
+# 带表格的长解析：把一行真实的税目税额表格重复多次
+_TABLE_ROW = ('<tr><td style="border:1px solid #000;">乘用车[按发动机汽缸容量（排气量）分档]</td>'
+              '<td style="border:1px solid #000;">每辆</td><td>60元至5400元</td></tr>')
+SAMPLE_ITEMS.append({
+    'content': '<p>下列关于车船税税目税额的说法，正确的是（）。</p>',
+    'textAnalysis': 'AC<p>车船税税目税额表如下：</p><table><tbody>' + _TABLE_ROW * 400 + '</tbody></table><p>（知识点：税目、税额）</p>',
+})
+
+
+def legacy_strip(html: str) -> str:
+    """旧实现：逐字符扫描，result += html[i]"""
+    html = html.replace('<p>', '').replace('</p>', '')
+    result = ''
+    i = 0
+    while i < len(html):
+        if html[i] == '<':
+            if html[i:i + 4].lower() == '<img':
+                end = html.find('>', i)
+                if end != -1:
+                    result += html[i:end + 1]
+                    i = end + 1
+                else:
+                    i += 1
+            else:
+                end = html.find('>', i)
+                if end != -1:
+                    i = end + 1
+                else:
+                    i += 1
+        else:
+            result += html[i]
+            i += 1
+    return result
+
+
+def legacy_clean_content(html: str) -> str:
+    if not html:
+        return ""
+    return re.sub(r'\s+', ' ', legacy_strip(html)).strip()
+
+
+def legacy_clean_analysis(analysis: str) -> str:
+    if not analysis:
+        return ""
+    analysis = re.sub(r'^[A-Z0-9]+<p>', '', analysis)
+    return legacy_strip(analysis).strip()
+
+
+def legacy_clean_html_for_markdown(html: str) -> str:
+    if not html:
+        return ""
+    html = html.replace('<p>', '').replace('</p>', '')
+    html = html.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
+    return re.sub(r'\s+', ' ', html).strip()
+
+
+def load_from_redis(count: int):
+    """从Redis读取前count条题目作为样本"""
+    import redis
+    from config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PARAMS
+
+    r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PARAMS['password'], db=REDIS_DB,
+                    decode_responses=True)
+    return [json.loads(item_json) for item_json in r.lrange('questions:items', 0, count - 1) if item_json]
+
+
+def bench(name, old_func, new_func, payloads, number):
+    """校验输出一致后分别计时"""
+    for payload in payloads:
+        assert old_func(payload) == new_func(payload), f"{name} 输出不一致: {payload[:80]}"
+
+    old_time = timeit.timeit(lambda: [old_func(p) for p in payloads], number=number)
+    new_time = timeit.timeit(lambda: [new_func(p) for p in payloads], number=number)
+    print(f"{name:<24} 旧: {old_time * 1000:9.1f} ms   新: {new_time * 1000:9.1f} ms   提速: {old_time / max(new_time, 1e-9):6.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTML清洗微基准')
+    parser.add_argument('--redis', type=int, default=0, help='从Redis读取多少条题目作为样本，0表示使用内置样本')
+    parser.add_argument('--number', type=int, default=20, help='每个函数重复执行的轮数')
+    args = parser.parse_args()
+
+    items = load_from_redis(args.redis) if args.redis else SAMPLE_ITEMS
+    contents = [item.get('content') or '' for item in items]
+    analyses = [item.get('textAnalysis') or '' for item in items]
+    total_kb = sum(len(p) for p in contents + analyses) / 1024
+    print(f"📊 样本: {len(items)} 道题，共 {total_kb:.1f} KB HTML，每轮重复 {args.number} 次")
+    print("=" * 50)
+
+    bench('clean_content', legacy_clean_content, html_sanitizer.clean_content, contents, args.number)
+    bench('clean_analysis', legacy_clean_analysis, html_sanitizer.clean_analysis, analyses, args.number)
+    bench('clean_html_for_markdown', legacy_clean_html_for_markdown, html_sanitizer.clean_html_for_markdown,
+          analyses, args.number)
+
+
+if __name__ == '__main__':
+    main()
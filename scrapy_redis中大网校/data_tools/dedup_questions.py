@@ -0,0 +1,377 @@
+"""
+跨路径的重复题目识别
+
+同一道题经常挂在好几个知识点下面，questions:items 里就有好几份。这里给每道题算两种指纹：
+    exact_hash  归一化文本（去标签、去空白和标点、全角转半角、小写）的SHA1，识别完全相同的题
+    minhash     归一化文本2字片段集合的32个MinHash值，估计的Jaccard相似度不低于--threshold的视为近似重复
+MinHash分成8段、每段4个值建LSH索引（bands表），只有至少一段完全相同的题才会进一步比较，
+不需要两两比较；题目文本普遍较短，改一个字对SimHash影响太大，所以用MinHash
+
+相同或近似的题目用并查集合并成一个簇，簇中最早出现的题目（Redis下标最小）就是规范id（canonical），
+结果保存在SQLite中（默认 results/dedup.sqlite3），流式处理、可以增量运行，内存中只保存被合并过的簇
+
+导出工具通过 DedupIndex.canonical_of() 查询每道题的规范id，比如：
+    python redis_to_sqlite.py build --canonical
+每组重复题只输出一条记录，带上它出现过的全部路径
+"""
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import zlib
+import argparse
+import unicodedata
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import redis
+
+import html_sanitizer
+from redis_to_mysql import iter_redis_items
+from config import (
+    # Redis配置
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_DB,
+    REDIS_PARAMS,
+    # 去重指纹库
+    DEDUP_DB_FILE
+)
+
+# MinHash的哈希函数个数，以及LSH分段：8段 x 4个值
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+# 默认的近似重复阈值（Jaccard相似度）；相似度0.7时成为候选的概率约89%，0.8时约98.5%
+DEFAULT_THRESHOLD = 0.7
+# 归一化文本太短时MinHash没有区分度，只做精确匹配
+MIN_MINHASH_LENGTH = 8
+# 每个LSH桶最多比较的候选数，防止大量模板化短题挤在同一个桶里
+MAX_CANDIDATES = 200
+
+# img标签只保留图片文件名：配图不同的题不能算重复
+_IMG_SRC_RE = re.compile(r'<img[^>]*?src=["\']?([^"\'\s>]+)[^>]*>', re.IGNORECASE)
+# 空白、标点和下划线
+_NOISE_RE = re.compile(r'[\W_]+')
+
+
+def normalize_text(item: Dict) -> str:
+    """题目和选项的归一化文本"""
+    content = html_sanitizer.clean_content(item.get('content') or '')
+    content = _IMG_SRC_RE.sub(lambda match: ' ' + match.group(1).rsplit('/', 1)[-1] + ' ', content)
+    options = ' '.join(html_sanitizer.clean_content(str(option)) for option in item.get('options') or [])
+    text = unicodedata.normalize('NFKC', content + ' ' + options).lower()
+    return _NOISE_RE.sub('', text)
+
+
+def exact_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# 哈希函数族 h(x) = (a * x + b) mod p，参数固定，指纹在多次运行之间可以比较
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+_PERMUTATIONS = [(int.from_bytes(hashlib.sha1(f'a{i}'.encode()).digest()[:8], 'big') % (_PRIME - 1) + 1,
+                  int.from_bytes(hashlib.sha1(f'b{i}'.encode()).digest()[:8], 'big') % _PRIME)
+                 for i in range(NUM_PERM)]
+
+
+def minhash(text: str) -> array:
+    """2字片段集合的MinHash签名"""
+    shingles = {zlib.crc32(text[i:i + 2].encode('utf-8')) for i in range(max(len(text) - 1, 1))}
+    return array('I', [min(((a * x + b) % _PRIME) & _MASK for x in shingles) for a, b in _PERMUTATIONS])
+
+
+def band_keys(signature: array) -> List[bytes]:
+    """每段ROWS个值拼成的桶key"""
+    return [signature[band * ROWS:(band + 1) * ROWS].tobytes() for band in range(BANDS)]
+
+
+def similarity(a: array, b: array) -> float:
+    """两个签名相同位置相等的比例，即Jaccard相似度的估计"""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+class DedupIndex:
+    """指纹、LSH桶和并查集都保存在SQLite中"""
+
+    def __init__(self, db_file: str = DEDUP_DB_FILE, redis_key: str = 'questions:items',
+                 threshold: float = DEFAULT_THRESHOLD):
+        self.db_file = db_file
+        self.redis_key = redis_key
+        self.threshold = threshold
+        self.redis = None
+        # 每次LRANGE读取的条数，以及一次pipeline中打包的LRANGE数量
+        self.chunk_size = 500
+        self.pipeline_pages = 4
+
+        # 其它进程（导出工具）读取时最多等待30秒
+        self.db = sqlite3.connect(db_file, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+        # 并查集：只保存被合并过的簇 {簇id: 父簇id}
+        self.parent: Dict[int, int] = dict(self.db.execute("SELECT cluster, parent FROM merges"))
+        # 本批次中被合并、需要更新items.canonical的簇
+        self.merged: List[int] = []
+
+        # 统计
+        self.stats = {'total': 0, 'exact': 0, 'near': 0, 'new': 0, 'merged': 0, 'failed': 0}
+
+    def init_redis(self):
+        self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PARAMS['password'], db=REDIS_DB,
+                                 decode_responses=True)
+
+    def create_tables(self):
+        self.db.executescript("""
+        CREATE TABLE IF NOT EXISTS items (
+            redis_index INTEGER PRIMARY KEY,
+            exact_hash TEXT NOT NULL,
+            canonical INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_items_canonical ON items (canonical);
+        CREATE TABLE IF NOT EXISTS exact (
+            exact_hash TEXT PRIMARY KEY,
+            signature BLOB,
+            cluster INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bands (
+            band INTEGER NOT NULL,
+            value BLOB NOT NULL,
+            exact_hash TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_bands ON bands (band, value);
+        CREATE TABLE IF NOT EXISTS merges (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            cluster INTEGER NOT NULL UNIQUE,
+            parent INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS export_checkpoint (
+            redis_key TEXT PRIMARY KEY,
+            last_offset INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        );
+        """)
+        self.migrate_merges()
+        self.db.commit()
+
+    def migrate_merges(self):
+        """旧版本的merges表没有合并序号，重建一次；已有的合并按簇id顺序编号"""
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(merges)")}
+        if 'seq' in columns:
+            return
+        print("🔧 merges表增加合并序号seq")
+        self.db.executescript("""
+        BEGIN;
+        ALTER TABLE merges RENAME TO merges_old;
+        CREATE TABLE merges (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            cluster INTEGER NOT NULL UNIQUE,
+            parent INTEGER NOT NULL
+        );
+        INSERT INTO merges (cluster, parent) SELECT cluster, parent FROM merges_old ORDER BY cluster;
+        DROP TABLE merges_old;
+        COMMIT;
+        """)
+
+    def reset(self):
+        """清空全部指纹，从头重建"""
+        self.db.executescript("""
+        DELETE FROM items; DELETE FROM exact; DELETE FROM bands; DELETE FROM merges; DELETE FROM export_checkpoint;
+        """)
+        self.db.commit()
+        self.parent.clear()
+
+    def load_offset(self) -> int:
+        row = self.db.execute("SELECT last_offset FROM export_checkpoint WHERE redis_key = ?",
+                              (self.redis_key,)).fetchone()
+        return row[0] if row else 0
+
+    def save_offset(self, offset: int):
+        self.db.execute("""
+        INSERT INTO export_checkpoint (redis_key, last_offset, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(redis_key) DO UPDATE SET last_offset = excluded.last_offset, updated_at = excluded.updated_at
+        """, (self.redis_key, offset, time.time()))
+
+    def find(self, cluster: int) -> int:
+        """并查集查根，顺便压缩路径"""
+        root = cluster
+        while root in self.parent:
+            root = self.parent[root]
+        while cluster != root:
+            self.parent[cluster], cluster = root, self.parent[cluster]
+        return root
+
+    def union(self, clusters: Iterable[int]) -> int:
+        """合并多个簇，以id最小（最早出现）的为根"""
+        roots = {self.find(cluster) for cluster in clusters}
+        root = min(roots)
+        for other in roots - {root}:
+            self.parent[other] = root
+            self.merged.append(other)
+            self.stats['merged'] += 1
+        return root
+
+    def candidates(self, signature: array) -> Iterator[Tuple[array, int]]:
+        """LSH：和signature至少有一段相同的 (签名, 簇id)"""
+        for band, key in enumerate(band_keys(signature)):
+            for blob, cluster in self.db.execute("""
+            SELECT e.signature, e.cluster FROM bands b JOIN exact e ON e.exact_hash = b.exact_hash
+            WHERE b.band = ? AND b.value = ? LIMIT ?
+            """, (band, key, MAX_CANDIDATES)):
+                other = array('I')
+                other.frombytes(blob)
+                yield other, cluster
+
+    def add(self, redis_index: int, item: Dict) -> int:
+        """登记一道题，返回它所在簇的规范id"""
+        text = normalize_text(item)
+        digest = exact_hash(text)
+
+        row = self.db.execute("SELECT cluster FROM exact WHERE exact_hash = ?", (digest,)).fetchone()
+        if row:
+            canonical = self.find(row[0])
+            self.stats['exact'] += 1
+        else:
+            signature = minhash(text) if len(text) >= MIN_MINHASH_LENGTH else None
+            matches = set()
+            if signature is not None:
+                matches = {cluster for other, cluster in self.candidates(signature)
+                           if similarity(signature, other) >= self.threshold}
+
+            if matches:
+                canonical = self.union(matches)
+                self.stats['near'] += 1
+            else:
+                canonical = redis_index
+                self.stats['new'] += 1
+
+            self.db.execute("INSERT INTO exact (exact_hash, signature, cluster) VALUES (?, ?, ?)",
+                            (digest, signature.tobytes() if signature is not None else None, canonical))
+            if signature is not None:
+                self.db.executemany("INSERT INTO bands (band, value, exact_hash) VALUES (?, ?, ?)",
+                                    [(band, key, digest) for band, key in enumerate(band_keys(signature))])
+
+        self.db.execute("INSERT OR REPLACE INTO items (redis_index, exact_hash, canonical) VALUES (?, ?, ?)",
+                        (redis_index, digest, canonical))
+        return canonical
+
+    def commit(self, offset: int):
+        """保存并查集的变化，把被合并簇中的题目改到新的规范id下，和进度一起提交
+
+        每次写入merges的行都会拿到一个新的、递增的seq（AUTOINCREMENT，reset之后也不会重复使用），
+        导出工具据此只处理上次之后被合并的簇
+        """
+        for cluster in self.merged:
+            self.db.execute("INSERT OR REPLACE INTO merges (cluster, parent) VALUES (?, ?)",
+                            (cluster, self.parent[cluster]))
+            self.db.execute("UPDATE items SET canonical = ? WHERE canonical = ?", (self.find(cluster), cluster))
+        self.merged = []
+        self.save_offset(offset)
+        self.db.commit()
+
+    def build(self, limit: Optional[int] = None, resume: bool = True, batch_size: int = 1000):
+        """流式读取Redis，登记每道题的指纹"""
+        print("🚀 开始计算题目指纹...")
+        self.init_redis()
+        list_len = self.redis.llen(self.redis_key)
+        print(f"📊 Redis中共有 {list_len} 条数据")
+
+        if not resume:
+            self.reset()
+        start = self.load_offset()
+        if start > list_len:
+            # Redis列表被清空重建过，旧的下标已经没有意义
+            print(f"⚠️ 上次处理到第{start}条，但Redis中只有{list_len}条，清空后从头开始")
+            self.reset()
+            start = 0
+        elif start:
+            print(f"⏩ 从上次的进度继续：第{start}条")
+
+        begin = time.time()
+        offset = start
+        for index, item_json in iter_redis_items(self.redis, self.redis_key, start=start, limit=limit,
+                                                 chunk_size=self.chunk_size, pipeline_pages=self.pipeline_pages):
+            self.stats['total'] += 1
+            offset = index + 1
+            try:
+                self.add(index, json.loads(item_json))
+            except Exception as e:
+                print(f"❌ 第{index}条处理失败: {e}")
+                self.stats['failed'] += 1
+            if self.stats['total'] % batch_size == 0:
+                self.commit(offset)
+                print(f"📈 进度: {offset}/{list_len}")
+        self.commit(offset)
+
+        elapsed = time.time() - begin
+        print(f"\n🎉 指纹计算完成！用时 {elapsed:.1f}秒")
+        print(f"   📊 读取: {self.stats['total']} 条")
+        print(f"   🟰 完全重复: {self.stats['exact']} 条")
+        print(f"   ≈ 近似重复: {self.stats['near']} 条（合并了 {self.stats['merged']} 个簇）")
+        print(f"   🆕 新题: {self.stats['new']} 条")
+        print(f"   ❌ 失败: {self.stats['failed']} 条")
+
+    def canonical_of(self, indexes: List[int]) -> Dict[int, int]:
+        """批量查询规范id，没有登记过的下标不在结果中"""
+        result = {}
+        for i in range(0, len(indexes), 500):
+            chunk = indexes[i:i + 500]
+            result.update(self.db.execute(
+                f"SELECT redis_index, canonical FROM items WHERE redis_index IN ({','.join('?' * len(chunk))})",
+                chunk))
+        return result
+
+    def merges_since(self, seq: int) -> Tuple[List[int], int]:
+        """seq之后被合并进别的簇的簇id，以及当前最大的合并序号"""
+        current = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM merges").fetchone()[0]
+        if current < seq:
+            # 指纹库文件被删除重建过，序号重新开始，全部重新处理
+            seq = 0
+        clusters = [row[0] for row in self.db.execute("SELECT cluster FROM merges WHERE seq > ? ORDER BY seq", (seq,))]
+        return clusters, current
+
+    def summary(self, top: int = 10) -> Tuple[int, int, List[Tuple[int, int]]]:
+        """(题目数, 簇数, 最大的几个簇的 (规范id, 题目数))"""
+        total = self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        clusters = self.db.execute("SELECT COUNT(DISTINCT canonical) FROM items").fetchone()[0]
+        largest = self.db.execute("""
+        SELECT canonical, COUNT(*) AS n FROM items GROUP BY canonical HAVING n > 1 ORDER BY n DESC LIMIT ?
+        """, (top,)).fetchall()
+        return total, clusters, largest
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        if self.redis:
+            self.redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='识别重复和近似重复的题目，给每组重复题分配规范id')
+    parser.add_argument('--db', default=DEDUP_DB_FILE, help='指纹库SQLite文件')
+    parser.add_argument('--limit', type=int, default=None, help='处理多少条，默认全部')
+    parser.add_argument('--from-start', action='store_true', help='清空指纹库，从第0条开始重建')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='估计的Jaccard相似度不低于多少算近似重复（1表示只合并MinHash签名相同的题）')
+    parser.add_argument('--batch-size', type=int, default=1000, help='每处理多少条提交一次')
+    parser.add_argument('--summary', action='store_true', help='只打印去重结果统计，不读取Redis')
+    args = parser.parse_args()
+
+    index = DedupIndex(args.db, threshold=args.threshold)
+    try:
+        if not args.summary:
+            index.build(limit=args.limit, resume=not args.from_start, batch_size=args.batch_size)
+        total, clusters, largest = index.summary()
+        print(f"\n📦 共 {total} 道题，去重后 {clusters} 道")
+        for canonical, count in largest:
+            print(f"   规范id {canonical}: {count} 份")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+题目HTML清洗工具（redis_to_mysql.py 和 redis_to_md.py 共用）
+
+所有正则都在模块加载时预编译，清洗过程是对字符串的线性扫描，
+不再逐字符拼接结果字符串；合并空白用 ' '.join(s.split())，和正则替换后再strip()结果相同但快得多
+"""
+import re
+
+# 一个完整标签（从<到最近的>），img标签放在分组1里以便原样保留
+_TAG_RE = re.compile(r'(<[iI][mM][gG][^>]*>)|<[^>]*>')
+# Markdown导出中的换行标签
+_BR_TAGS = ('<br>', '<br/>', '<br />')
+# 解析开头的答案，比如 "B<p>..."
+_ANSWER_PREFIX_RE = re.compile(r'^[A-Z0-9]+<p>')
+
+
+def collapse_whitespace(text: str) -> str:
+    """连续空白合并为一个空格并去掉首尾空白；str.split()和正则认定的空白字符相同"""
+    return ' '.join(text.split())
+
+
+def strip_tags_keep_img(html: str) -> str:
+    """去掉除img以外的所有HTML标签
+
+    与旧的逐字符实现保持一致：没有闭合>的<会被单独丢弃
+    """
+    if not html:
+        return ""
+
+    html = html.replace('<p>', '').replace('</p>', '')
+
+    # 最后一个>之后的<都没有闭合，直接丢弃；之前的每个<都能匹配到完整标签
+    # split后依次是：文本、img标签（非img标签为None）、文本……，拼接时丢掉None即可
+    last = html.rfind('>')
+    parts = _TAG_RE.split(html[:last + 1])
+    return ''.join(filter(None, parts)) + html[last + 1:].replace('<', '')
+
+
+def clean_content(html: str) -> str:
+    """清理题目内容：去掉HTML标签但保留img标签，合并多余空白"""
+    if not html:
+        return ""
+
+    return collapse_whitespace(strip_tags_keep_img(html))
+
+
+def clean_analysis(analysis: str) -> str:
+    """清理答案解析：去掉开头的答案部分，保留img标签"""
+    if not analysis:
+        return ""
+
+    # 比如 "B<p>内容..." 变成 "内容..."
+    analysis = _ANSWER_PREFIX_RE.sub('', analysis, count=1)
+    return strip_tags_keep_img(analysis).strip()
+
+
+def clean_html_for_markdown(html: str) -> str:
+    """清理HTML，转换为Markdown友好格式（保留img等其它标签）"""
+    if not html:
+        return ""
+
+    html = html.replace('<p>', '').replace('</p>', '')
+    # <br>换成空白，随后和其它空白一起合并
+    for tag in _BR_TAGS:
+        html = html.replace(tag, ' ')
+    return collapse_whitespace(html)
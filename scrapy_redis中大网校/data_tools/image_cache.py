@@ -0,0 +1,296 @@
+"""
+图片缓存（redis_to_md.py 使用）
+
+同一张公式/表格图片会出现在几百道题中，这里把图片按内容寻址保存一份：
+    <root>/index.sqlite3           URL -> sha256、ETag、Last-Modified 的索引
+    <root>/objects/ab/<sha256>.png 图片内容，相同内容只存一份
+导出时每个引用位置硬链接到对象文件（跨磁盘等不支持硬链接时复制一份），
+每个URL在多次运行之间最多下载一次；超过revalidate_after后用ETag/Last-Modified做条件请求，
+总大小超过max_bytes时按最近访问时间淘汰
+
+索引使用WAL模式，多个导出进程（--processes）可以共用同一个缓存目录；
+缓存总大小由objects表上的触发器记在cache_size表中，所有进程按同一个总数淘汰
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+# 这些状态码是临时错误，值得重试
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+async def get_with_retry(session: aiohttp.ClientSession, url: str, headers: Optional[dict] = None,
+                         retries: int = 3, backoff: float = 0.5) -> Tuple[int, Mapping[str, str], bytes]:
+    """GET请求，网络错误和5xx/429按带随机抖动的指数退避重试
+
+    返回 (状态码, 响应头, 内容)，只有200时才读取内容；重试用完仍是网络错误时抛出异常
+    """
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status not in RETRY_STATUS or attempt == retries:
+                    content = await response.read() if response.status == 200 else b''
+                    return response.status, response.headers, content
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+
+        # full jitter：在 [0, backoff * 2^attempt] 之间随机等待，避免大量请求同时重试
+        await asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+
+def image_ext(url: str) -> str:
+    """从URL中取图片扩展名，和download_image的文件名规则一致"""
+    filename = url.split('/')[-1].split('?')[0].lower()
+    for ext in IMAGE_EXTS:
+        if filename.endswith(ext):
+            return ext
+    return '.jpg'
+
+
+def link_or_copy(src: Path, dest: Path):
+    """硬链接到dest，不支持时复制；dest已存在时不处理"""
+    if dest.exists():
+        return
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class ImageStore:
+    """按URL索引、按内容去重的持久化图片缓存"""
+
+    def __init__(self, root, max_bytes: int = 2 * 1024 * 1024 * 1024,
+                 revalidate_after: Optional[float] = 7 * 24 * 3600, retries: int = 3):
+        self.root = Path(root)
+        self.objects_dir = self.root / 'objects'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # None表示缓存永不过期，不做条件请求
+        self.revalidate_after = revalidate_after
+        self.retries = retries
+
+        # 其它进程正在写入时最多等待30秒
+        self.db = sqlite3.connect(str(self.root / 'index.sqlite3'), timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+        # 同一个URL同时只下载一次，其它请求等待同一个结果
+        self.inflight: Dict[str, asyncio.Future] = {}
+        # 命中时的访问时间先记在内存中，批量写入，避免长时间占用写锁
+        self.touched: Dict[str, float] = {}
+
+        # 统计
+        self.stats = {'hits': 0, 'downloads': 0, 'revalidated': 0, 'evicted': 0, 'failed': 0}
+
+    def create_tables(self):
+        self.db.executescript("""
+        CREATE TABLE IF NOT EXISTS objects (
+            sha256 TEXT PRIMARY KEY,
+            ext TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_objects_last_access ON objects (last_access);
+        CREATE TABLE IF NOT EXISTS urls (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            checked_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_urls_sha256 ON urls (sha256);
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS cache_size (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            total_bytes INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO cache_size (id, total_bytes) SELECT 0, COALESCE(SUM(size), 0) FROM objects;
+        CREATE TRIGGER IF NOT EXISTS objects_size_insert AFTER INSERT ON objects BEGIN
+            UPDATE cache_size SET total_bytes = total_bytes + NEW.size WHERE id = 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS objects_size_delete AFTER DELETE ON objects BEGIN
+            UPDATE cache_size SET total_bytes = total_bytes - OLD.size WHERE id = 0;
+        END;
+        COMMIT;
+        """)
+        self.db.commit()
+
+    @property
+    def total_bytes(self) -> int:
+        """所有进程共用的缓存总大小"""
+        return self.db.execute("SELECT total_bytes FROM cache_size WHERE id = 0").fetchone()[0]
+
+    def object_path(self, sha256: str, ext: str) -> Path:
+        return self.objects_dir / sha256[:2] / f"{sha256}{ext}"
+
+    def lookup(self, url: str) -> Optional[tuple]:
+        """返回 (sha256, ext, etag, last_modified, checked_at)，对象文件已丢失时视为未缓存"""
+        row = self.db.execute("""
+        SELECT u.sha256, o.ext, u.etag, u.last_modified, u.checked_at
+        FROM urls u JOIN objects o ON o.sha256 = u.sha256 WHERE u.url = ?
+        """, (url,)).fetchone()
+        if row and not self.object_path(row[0], row[1]).exists():
+            return None
+        return row
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> Optional[Path]:
+        """返回URL对应的对象文件，需要时下载；失败返回None"""
+        future = self.inflight.get(url)
+        if future:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[url] = future
+        path = None
+        try:
+            path = await self._fetch(session, url)
+        except Exception as e:
+            logger.warning(f"图片下载失败 {url}: {e}")
+            self.stats['failed'] += 1
+        finally:
+            # 被取消（或其它BaseException）时也要给等待的请求一个结果，否则它们会一直挂起
+            self.inflight.pop(url, None)
+            if not future.done():
+                future.set_result(path)
+        return path
+
+    async def _fetch(self, session: aiohttp.ClientSession, url: str) -> Optional[Path]:
+        row = self.lookup(url)
+        headers = {}
+        if row:
+            sha256, ext, etag, last_modified, checked_at = row
+            fresh = self.revalidate_after is None or time.time() - checked_at < self.revalidate_after
+            if fresh or not (etag or last_modified):
+                self.touch(sha256)
+                self.stats['hits'] += 1
+                return self.object_path(sha256, ext)
+
+            # 过期了：条件请求，没有变化时服务器返回304
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        try:
+            status, response_headers, content = await get_with_retry(session, url, headers, retries=self.retries)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not row:
+                raise
+            # 重新验证失败时继续使用旧的缓存
+            logger.warning(f"图片重新验证失败，使用缓存 {url}: {e}")
+            return self.object_path(row[0], row[1])
+
+        if row and status == 304:
+            self.db.execute("UPDATE urls SET checked_at = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+            self.touch(row[0])
+            self.stats['revalidated'] += 1
+            return self.object_path(row[0], row[1])
+
+        if status != 200:
+            logger.warning(f"图片下载失败 {url}: 状态码 {status}")
+            return self.object_path(row[0], row[1]) if row else None
+
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+
+        self.stats['downloads'] += 1
+        return self.store(url, content, etag, last_modified)
+
+    def store(self, url: str, content: bytes, etag: Optional[str] = None,
+              last_modified: Optional[str] = None) -> Path:
+        """保存图片内容并更新索引，返回对象文件路径"""
+        sha256 = hashlib.sha256(content).hexdigest()
+        ext = image_ext(url)
+        now = time.time()
+
+        exists = self.db.execute("SELECT ext FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        if exists:
+            ext = exists[0]
+        path = self.object_path(sha256, ext)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 先写临时文件再改名，中断时不会留下半个对象
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+        self.db.execute("""
+        INSERT INTO objects (sha256, ext, size, last_access) VALUES (?, ?, ?, ?)
+        ON CONFLICT(sha256) DO UPDATE SET last_access = excluded.last_access
+        """, (sha256, ext, len(content), now))
+        self.db.execute("""
+        INSERT INTO urls (url, sha256, etag, last_modified, checked_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET sha256 = excluded.sha256, etag = excluded.etag,
+            last_modified = excluded.last_modified, checked_at = excluded.checked_at
+        """, (url, sha256, etag, last_modified, now))
+        self.db.commit()
+
+        if self.total_bytes > self.max_bytes:
+            self.evict(keep=sha256)
+        return path
+
+    def touch(self, sha256: str):
+        """记录最近访问时间，攒够一批再写入"""
+        self.touched[sha256] = time.time()
+        if len(self.touched) >= 200:
+            self.flush_touched()
+
+    def flush_touched(self):
+        if not self.touched:
+            return
+        self.db.executemany("UPDATE objects SET last_access = ? WHERE sha256 = ?",
+                            [(last_access, sha256) for sha256, last_access in self.touched.items()])
+        self.db.commit()
+        self.touched.clear()
+
+    def evict(self, keep: Optional[str] = None):
+        """按最近访问时间淘汰，直到总大小降到max_bytes的90%以下"""
+        target = self.max_bytes * 0.9
+        self.flush_touched()
+        # 先拿到写锁再读总大小，其它进程刚淘汰过时这里不会重复淘汰
+        self.db.execute("BEGIN IMMEDIATE")
+        total_bytes = self.total_bytes
+        rows = self.db.execute("SELECT sha256, ext, size FROM objects ORDER BY last_access").fetchall()
+        for sha256, ext, size in rows:
+            if total_bytes <= target:
+                break
+            if sha256 == keep:
+                continue
+
+            # 已经链接到导出目录的文件不受影响
+            try:
+                os.remove(self.object_path(sha256, ext))
+            except FileNotFoundError:
+                pass
+            self.db.execute("DELETE FROM urls WHERE sha256 = ?", (sha256,))
+            self.db.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+            total_bytes -= size
+            self.stats['evicted'] += 1
+        self.db.commit()
+
+    def link(self, blob: Path, dest: Path):
+        """把缓存的图片放到导出目录"""
+        link_or_copy(blob, dest)
+
+    def close(self):
+        self.flush_touched()
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,138 @@
+"""
+Markdown导出的去重索引（redis_to_md.py 使用）
+
+每个输出目录一个SQLite文件（<输出目录>/.md_index.sqlite3），记录每个md文件中已经写入的题目指纹，
+追加前查一次索引即可判断是否重复，不需要读回整个文件；索引在多次运行之间保留
+
+同一个文件中还有一份清单（files表）：每个md文件的内容哈希和题目数，
+--incremental 据此只重写题目集合或内容有变化的文件
+
+使用WAL模式，多个导出进程（--processes）写入同一个输出目录时共用这个索引；
+同一个进程中文件写入池的多个线程共用一个连接，用锁串行访问
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+INDEX_FILENAME = '.md_index.sqlite3'
+
+
+def question_fingerprint(item: Dict) -> str:
+    """题目指纹：题目原文和选项的SHA1，不受图片本地路径和解析修改的影响"""
+    options = item.get('options') or []
+    raw = '\x1f'.join([item.get('content') or '', json.dumps(options, ensure_ascii=False)])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def source_digest(item: Dict) -> bytes:
+    """题目渲染所用的全部原始内容（题目、选项、解析）的摘要，解析修改后也会变化"""
+    options = item.get('options') or []
+    raw = '\x1f'.join([item.get('content') or '', json.dumps(options, ensure_ascii=False),
+                       item.get('textAnalysis') or ''])
+    return hashlib.sha1(raw.encode('utf-8')).digest()
+
+
+def content_hash(digests: Iterable[bytes]) -> str:
+    """一个文件的内容哈希：文件中所有题目的摘要排序后再哈希，和题目顺序无关"""
+    return hashlib.sha1(b''.join(sorted(digests))).hexdigest()
+
+
+class MarkdownIndex:
+    """(md文件, 题目指纹) 索引，文件用相对输出目录的路径表示"""
+
+    def __init__(self, output_base: Path):
+        self.output_base = Path(output_base)
+        # 其它进程正在写入时最多等待30秒
+        self.db = sqlite3.connect(str(self.output_base / INDEX_FILENAME), timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS questions (
+            file TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (file, fingerprint)
+        ) WITHOUT ROWID
+        """)
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            file TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            questions INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+        self.db.commit()
+
+    def key(self, md_path: Path) -> str:
+        return Path(md_path).relative_to(self.output_base).as_posix()
+
+    def has_file(self, md_path: Path) -> bool:
+        """索引中是否有这个文件的记录"""
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM questions WHERE file = ? LIMIT 1",
+                                   (self.key(md_path),)).fetchone() is not None
+
+    def contains(self, md_path: Path, fingerprint: str) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM questions WHERE file = ? AND fingerprint = ?",
+                                   (self.key(md_path), fingerprint)).fetchone() is not None
+
+    def fingerprints(self, md_path: Path) -> Set[str]:
+        """文件中已写入的题目指纹集合"""
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT fingerprint FROM questions WHERE file = ?",
+                                                      (self.key(md_path),))}
+
+    def manifest(self, md_path: Path) -> Optional[Tuple[str, int]]:
+        """清单中记录的 (内容哈希, 题目数)，没有记录时返回None"""
+        with self.lock:
+            return self.db.execute("SELECT content_hash, questions FROM files WHERE file = ?",
+                                   (self.key(md_path),)).fetchone()
+
+    def manifest_files(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT file FROM files ORDER BY file")]
+
+    def update_manifest(self, md_path: Path, file_hash: str, questions: int):
+        with self.lock:
+            self.db.execute("""
+            INSERT INTO files (file, content_hash, questions, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(file) DO UPDATE SET content_hash = excluded.content_hash, questions = excluded.questions,
+                updated_at = excluded.updated_at
+            """, (self.key(md_path), file_hash, questions, time.time()))
+
+    def invalidate(self, md_path: Path):
+        """文件被逐题追加修改后，清单中的记录不再准确，下次 --incremental 时会重写"""
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE file = ?", (self.key(md_path),))
+
+    def add_many(self, md_path: Path, fingerprints: Iterable[str]):
+        """记录已经写入文件的题目并马上提交，由文件句柄在刷盘之后调用"""
+        key = self.key(md_path)
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO questions (file, fingerprint) VALUES (?, ?)",
+                                ((key, fingerprint) for fingerprint in fingerprints))
+            self.commit()
+
+    def replace_file(self, md_path: Path, fingerprints: Iterable[str]):
+        """文件被整体重写后，用新的指纹集合替换原来的记录"""
+        key = self.key(md_path)
+        with self.lock:
+            self.db.execute("DELETE FROM questions WHERE file = ?", (key,))
+            self.db.executemany("INSERT OR IGNORE INTO questions (file, fingerprint) VALUES (?, ?)",
+                                ((key, fingerprint) for fingerprint in fingerprints))
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
@@ -1,24 +1,38 @@
 import asyncio
-import random
 import time
 import aiohttp
 import aiofiles
 import redis.asyncio as redis
 import json
 import re
+import io
 import os
-import atexit
+import argparse
+import tempfile
+import queue
+import zlib
+import hashlib
+import tarfile
+import zipfile
+import posixpath
+import multiprocessing
 from pathlib import Path
-from typing import List, Dict, Optional
-from urllib.parse import urlparse
-from collections import defaultdict
+from typing import List, Dict, Optional, AsyncIterator, Set, Tuple, Callable
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
 import logging
+import html_sanitizer
+from image_cache import ImageStore, get_with_retry
+from md_index import MarkdownIndex, question_fingerprint, source_digest, content_hash
 from config import (
     # Redis配置
     REDIS_HOST,
     REDIS_PORT,
     REDIS_DB,
     REDIS_PARAMS,
+    # 图片缓存
+    IMAGE_CACHE_DIR,
 )
 import sys
 # 配置日志
@@ -29,44 +43,423 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 文件名和目录名中不允许出现的字符
+_UNSAFE_CHARS_RE = re.compile(r'[<>:"|?*]')
+
+
+@lru_cache(maxsize=65536)
+def safe_name(part: str) -> str:
+    """把路径中的一层转换为安全的文件/目录名"""
+    part = part.replace('/', '_').replace('\\', '_')
+    return _UNSAFE_CHARS_RE.sub('', part)
+
+
+class BufferedHandle:
+    """以a+打开的md文件，带写缓冲
+
+    写入的内容先攒在内存中，超过buffer_size或flush()时才写入文件；缓冲区中题目的指纹记在pending中，
+    写入文件后才交给on_flush记录到索引。中途崩溃时索引里不会有文件中没有的题目，
+    最坏情况是文件中有、索引中没有，下次运行时重复追加一次
+    """
+
+    def __init__(self, path: Path, buffer_size: int,
+                 on_flush: Optional[Callable[[Path, Set[str]], None]] = None):
+        self.path = path
+        self.file = open(path, 'a+', encoding='utf-8', errors='replace')
+        self.buffer_size = buffer_size
+        self.on_flush = on_flush
+        self.chunks: List[str] = []
+        self.buffered = 0
+        self.pending: Set[str] = set()
+        # a+打开时位置在文件末尾，位置为0说明是空文件
+        self.empty = self.file.tell() == 0
+        # 打开时文件不存在或为空：索引中这个文件的记录已经失效，第一次写入前要清掉
+        self.stale_index = self.empty
+
+    def write(self, text: str, fingerprint: Optional[str] = None):
+        """写入一段内容；fingerprint是这段内容对应的题目，写入文件后才记录到索引"""
+        if text:
+            self.chunks.append(text)
+            self.buffered += len(text)
+            self.empty = False
+        if fingerprint:
+            self.pending.add(fingerprint)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def read_all(self) -> str:
+        """读回整个文件（之后的写入仍然追加到末尾）"""
+        self.flush()
+        self.file.seek(0)
+        return self.file.read()
+
+    def flush(self):
+        """先把缓冲区写入文件，再记录其中的题目指纹"""
+        if self.chunks:
+            self.file.write(''.join(self.chunks))
+            self.chunks, self.buffered = [], 0
+        self.file.flush()
+        if self.pending:
+            pending, self.pending = self.pending, set()
+            if self.on_flush:
+                self.on_flush(self.path, pending)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
 
 class FileWriteQueue:
-    """基于文件路径的任务队列"""
+    """文件写入池：固定数量的写入worker，按文件路径的哈希分片
+
+    同一个文件总是由同一个worker按提交顺序写入；每个worker用LRU缓存最多max_open个打开的文件，
+    同一章节的题目连续写入时不需要反复打开关闭文件。打开、写入、刷新和关闭文件都在线程池中执行
+    （每个分片同时只有一个任务在跑），不会阻塞事件循环里的图片下载和Redis读取；
+    统计只在事件循环线程中更新
+
+    on_flush(文件路径, 指纹集合) 在文件句柄刷盘后调用（在写入线程中），用来记录索引
+    """
+
+    def __init__(self, shards: int = 8, queue_size: int = 1000, max_open: int = 32,
+                 buffer_size: int = 64 * 1024):
+        self.shards = shards
+        self.queue_size = queue_size
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.on_flush: Optional[Callable[[Path, Set[str]], None]] = None
+        self.queues: List[asyncio.Queue] = []
+        self.handles: List[OrderedDict] = []
+        self.tasks: List[asyncio.Task] = []
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+        # 统计
+        self.stats = {'writes': 0, 'failed': 0, 'handle_hits': 0, 'handle_misses': 0, 'max_queue_depth': 0}
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.shards, thread_name_prefix='md-writer')
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.shards)]
+        self.handles = [OrderedDict() for _ in range(self.shards)]
+        self.tasks = [asyncio.create_task(self._worker(shard)) for shard in range(self.shards)]
+
+    async def enqueue_write(self, file_path: Path, write_func):
+        """将写入任务加入队列，write_func(handle) 是同步函数，参数是该文件的BufferedHandle"""
+        if not self.tasks:
+            self.start()
+        queue = self.queues[hash(file_path) % self.shards]
+        await queue.put((file_path, write_func))
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], queue.qsize())
+
+    def _get_handle(self, shard: int, file_path: Path) -> Tuple[BufferedHandle, bool]:
+        """返回 (文件句柄, 是否命中已打开的句柄)"""
+        handles = self.handles[shard]
+        handle = handles.get(file_path)
+        if handle:
+            handles.move_to_end(file_path)
+            return handle, True
+
+        if len(handles) >= self.max_open:
+            # 关闭最久没有写入的文件
+            _, oldest = handles.popitem(last=False)
+            oldest.close()
+        handle = BufferedHandle(file_path, self.buffer_size, self.on_flush)
+        handles[file_path] = handle
+        return handle, False
+
+    def _write(self, shard: int, file_path: Path, write_func) -> bool:
+        """在写入线程中执行，返回是否命中已打开的句柄"""
+        handle, hit = self._get_handle(shard, file_path)
+        write_func(handle)
+        return hit
+
+    def _flush_all(self, close: bool = False):
+        for handles in self.handles:
+            for handle in handles.values():
+                handle.close() if close else handle.flush()
+
+    async def _worker(self, shard: int):
+        """处理一个分片的所有写入任务"""
+        queue = self.queues[shard]
+        loop = asyncio.get_running_loop()
+        while True:
+            file_path, write_func = await queue.get()
+            try:
+                hit = await loop.run_in_executor(self.executor, self._write, shard, file_path, write_func)
+                self.stats['writes'] += 1
+                self.stats['handle_hits' if hit else 'handle_misses'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                print(f"写入文件 {file_path} 失败: {e}")
+            finally:
+                queue.task_done()
+
+    def queue_depths(self) -> List[int]:
+        return [queue.qsize() for queue in self.queues]
+
+    def hit_rate(self) -> float:
+        total = self.stats['handle_hits'] + self.stats['handle_misses']
+        return self.stats['handle_hits'] / total if total else 0.0
+
+    async def drain(self):
+        """等待已提交的写入全部完成，并把缓冲写到文件"""
+        for queue in self.queues:
+            await queue.join()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._flush_all)
+
+    async def close(self):
+        """写完后停止worker并关闭所有文件"""
+        if not self.tasks:
+            return
+        await self.drain()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._flush_all, True)
+        self.executor.shutdown()
+        self.queues, self.handles, self.tasks, self.executor = [], [], [], None
 
-    def __init__(self):
-        self.queues = defaultdict(asyncio.Queue)
-        self.processing = set()
 
-    async def enqueue_write(self, file_path, write_func):
-        """将写入任务加入队列"""
-        queue = self.queues[file_path]
-        await queue.put(write_func)
+write_queue = FileWriteQueue()
+
+
+class ImageFetchPool:
+    """共享的图片下载worker池
+
+    固定数量的worker从有界队列中取任务，submit返回Future；
+    队列满时submit会等待，不会无限制地堆积下载任务
+    """
 
-        # 如果该文件没有正在处理的任务，启动处理
-        if file_path not in self.processing:
-            self.processing.add(file_path)
-            asyncio.create_task(self._process_queue(file_path))
+    def __init__(self, handler, workers: int = 10, queue_size: int = 200):
+        # handler(img_url, img_dir) -> 本地相对路径或None
+        self.handler = handler
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks: List[asyncio.Task] = []
 
-    async def _process_queue(self, file_path):
-        """处理特定文件的所有写入任务"""
-        queue = self.queues[file_path]
+    def start(self):
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self._worker()))
 
-        while not queue.empty():
-            write_func = await queue.get()
+    async def submit(self, img_url: str, img_dir: Path) -> asyncio.Future:
+        """提交下载任务，返回的Future完成时得到本地路径（失败为None）"""
+        if not self.tasks:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img_url, img_dir, future))
+        return future
+
+    async def _worker(self):
+        while True:
+            img_url, img_dir, future = await self.queue.get()
             try:
-                await write_func()
+                result = await self.handler(img_url, img_dir)
             except Exception as e:
-                print(f"写入文件 {file_path} 失败: {e}")
+                logger.warning(f"图片下载失败 {img_url}: {e}")
+                result = None
             finally:
-                queue.task_done()
+                self.queue.task_done()
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """等待队列中的任务完成后停止worker"""
+        if not self.tasks:
+            return
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+
+class ArchiveWriter:
+    """把导出结果按目录结构顺序写入一个tar或zip文件（.tar / .tar.gz / .tgz / .zip）
+
+    tar使用流式写入（w|），zip也是顺序追加，都不需要临时文件；
+    内容相同的图片只存一份：tar中后面的副本是指向第一份的硬链接，zip中md直接引用第一份的相对路径
+    """
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        lower = archive_path.lower()
+        self.is_zip = lower.endswith('.zip')
+        if self.is_zip:
+            self.archive = zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            mode = 'w|gz' if lower.endswith(('.tar.gz', '.tgz')) else 'w|'
+            self.archive = tarfile.open(archive_path, mode)
+        # 图片内容的sha256 -> 第一次写入的成员名
+        self.images: Dict[str, str] = {}
+        self.names: Set[str] = set()
+
+        # 统计
+        self.stats = {'files': 0, 'images': 0, 'duplicate_images': 0}
+
+    def add_file(self, name: str, data: bytes):
+        """写入一个文件成员，name是归档内的相对路径"""
+        if self.is_zip:
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+        self.names.add(name)
+        self.stats['files'] += 1
+
+    def add_image(self, name: str, data: bytes) -> str:
+        """写入一张图片，返回md中应该引用的成员名"""
+        if name in self.names:
+            return name
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        first = self.images.get(sha256)
+        if first is None:
+            self.add_file(name, data)
+            self.images[sha256] = name
+            self.stats['images'] += 1
+            return name
+
+        self.stats['duplicate_images'] += 1
+        if self.is_zip:
+            # zip没有链接，直接引用第一份
+            return first
+
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.LNKTYPE
+        info.linkname = first
+        info.mtime = time.time()
+        self.archive.addfile(info)
+        self.names.add(name)
+        return name
+
+    def close(self):
+        self.archive.close()
+
+
+class GroupBufferExceeded(Exception):
+    """不允许落盘时（归档模式），聚合的题目超过了内存上限"""
+
+
+class MarkdownGrouper:
+    """按md文件聚合题目，全部读完后每个文件一次性顺序写入
+
+    渲染好的题目先缓存在内存中，超过max_buffer_bytes时把最大的分组追加到磁盘临时文件，
+    写入时依次拼接：文件头 -> 临时文件中的题目 -> 内存中剩余的题目
+
+    所有分组共用一个只追加的临时文件，每个md文件记录自己的 (偏移, 长度) 片段，
+    几千个文件落盘也只占一个文件描述符
+
+    allow_spill=False时（归档模式）不使用临时文件，超过max_buffer_bytes时抛出GroupBufferExceeded
+    """
+
+    def __init__(self, spill_dir: Optional[str] = None, max_buffer_bytes: int = 256 * 1024 * 1024,
+                 allow_spill: bool = True):
+        self.spill_dir = spill_dir
+        self.max_buffer_bytes = max_buffer_bytes
+        self.allow_spill = allow_spill
+        self.headers: Dict[Path, str] = {}
+        self.groups: Dict[Path, List[str]] = defaultdict(list)
+        self.group_bytes: Dict[Path, int] = defaultdict(int)
+        self.seen: Dict[Path, set] = defaultdict(set)
+        self.digests: Dict[Path, List[bytes]] = defaultdict(list)
+        self.spill_file = None
+        self.spills: Dict[Path, List[Tuple[int, int]]] = defaultdict(list)
+        self.buffered_bytes = 0
+
+        # 统计
+        self.stats = {'questions': 0, 'duplicates': 0, 'spilled_bytes': 0, 'files': 0}
+
+    def add(self, md_path: Path, header: str, fingerprint: str, block: str, digest: bytes = b'') -> bool:
+        """加入一道题，同一个文件中指纹重复的题目会被跳过；digest用于计算文件的内容哈希"""
+        seen = self.seen[md_path]
+        if fingerprint in seen:
+            self.stats['duplicates'] += 1
+            return False
+        seen.add(fingerprint)
+        self.digests[md_path].append(digest)
+
+        self.headers.setdefault(md_path, header)
+        self.groups[md_path].append(block)
+        size = len(block)
+        self.group_bytes[md_path] += size
+        self.buffered_bytes += size
+        self.stats['questions'] += 1
+
+        if self.buffered_bytes > self.max_buffer_bytes:
+            if not self.allow_spill:
+                raise GroupBufferExceeded(f"聚合的题目超过了 {self.max_buffer_bytes / 1024 / 1024:.0f} MB，"
+                                          f"归档模式不使用临时文件，请调大 --group-buffer-mb")
+            self.spill()
+        return True
+
+    def spill(self):
+        """从最大的分组开始写到临时文件，直到内存占用降到一半以下"""
+        for md_path in sorted(self.group_bytes, key=self.group_bytes.get, reverse=True):
+            if self.buffered_bytes <= self.max_buffer_bytes // 2:
+                break
+
+            if self.spill_file is None:
+                self.spill_file = tempfile.NamedTemporaryFile('w+b', suffix='.spill', dir=self.spill_dir,
+                                                              delete=False)
+            data = ''.join(self.groups.pop(md_path)).encode('utf-8', errors='replace')
+            offset = self.spill_file.seek(0, os.SEEK_END)
+            self.spill_file.write(data)
+            self.spills[md_path].append((offset, len(data)))
+
+            size = self.group_bytes.pop(md_path)
+            self.buffered_bytes -= size
+            self.stats['spilled_bytes'] += size
+
+    def read_spilled(self, md_path: Path, chunk_size: int = 1024 * 1024):
+        """按落盘顺序读出某个文件的题目（bytes）"""
+        segments = self.spills.pop(md_path, None)
+        if not segments:
+            return
+        self.spill_file.flush()
+        for offset, length in segments:
+            self.spill_file.seek(offset)
+            while length > 0:
+                data = self.spill_file.read(min(chunk_size, length))
+                length -= len(data)
+                yield data
+
+    def write_all(self, archive: Optional[ArchiveWriter] = None, output_base: Optional[Path] = None) -> int:
+        """每个文件一次性写入（覆盖已有文件），返回写入的文件数；指定archive时写入归档文件"""
+        for md_path, header in self.headers.items():
+            tail = ''.join(self.groups.pop(md_path, [])).encode('utf-8', errors='replace')
+            if archive:
+                parts = [header.encode('utf-8', errors='replace'), *self.read_spilled(md_path), tail]
+                archive.add_file(md_path.relative_to(output_base).as_posix(), b''.join(parts))
+                self.stats['files'] += 1
+                continue
+
+            md_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(md_path, 'wb', buffering=1024 * 1024) as f:
+                f.write(header.encode('utf-8', errors='replace'))
+                for data in self.read_spilled(md_path):
+                    f.write(data)
+                f.write(tail)
+            self.stats['files'] += 1
+
+        self.headers.clear()
+        self.group_bytes.clear()
+        self.buffered_bytes = 0
+        self.discard()
+        return self.stats['files']
+
+    def discard(self):
+        """删除临时文件"""
+        if self.spill_file is not None:
+            self.spill_file.close()
+            os.remove(self.spill_file.name)
+            self.spill_file = None
+        self.spills.clear()
 
-        self.processing.remove(file_path)
 
-write_queue = FileWriteQueue()
 class AsyncMDExporter:
     """异步保存到Markdown文件"""
 
-    def __init__(self, redis_host=REDIS_HOST, redis_port=REDIS_PORT, redis_db=REDIS_DB):
+    def __init__(self, redis_host=REDIS_HOST, redis_port=REDIS_PORT, redis_db=REDIS_DB, image_workers: int = 10):
         # Redis连接将在异步上下文中初始化
         self.redis_host = redis_host
         self.redis_port = redis_port
@@ -80,12 +473,43 @@ class AsyncMDExporter:
         # 会话管理
         self.session: Optional[aiohttp.ClientSession] = None
 
-        # 限制并发数 - 减小并发以降低文件句柄压力
-        self.semaphore = asyncio.Semaphore(10)  # 从30减小到10
-        self.file_semaphore = asyncio.Semaphore(20)  # 专门用于文件操作的信号量
+        # 图片缓存，None时每次都直接下载
+        self.image_store: Optional[ImageStore] = None
+
+        # 图片下载：固定数量的worker，同一个域名最多同时per_host个连接，失败最多重试retries次
+        self.image_workers = image_workers
+        self.image_per_host = image_workers
+        self.image_retries = 3
+        self.fetch_pool = ImageFetchPool(self.download_image, workers=self.image_workers)
+
+        # 同时处理的题目数：一道题处理完马上开始下一道
+        self.max_in_flight = 50
+        self.page_size = 500  # 每次LRANGE读取的条数
+
+        # 聚合模式（--group）：不再逐题追加，读完后每个文件一次性写入
+        self.grouper: Optional[MarkdownGrouper] = None
+
+        # 路径 -> (保存目录, 文件名) 的缓存，以及已经创建过的目录
+        self.path_cache: Dict[Tuple[Path, Tuple[str, ...]], Tuple[Path, str]] = {}
+        self.created_dirs: Set[Path] = set()
+
+        # 去重索引：None时按旧方式读回整个文件检查
+        self.md_index: Optional[MarkdownIndex] = None
+        # 本次运行中遇到的、索引里没有记录的旧文件
+        self.legacy_files: Dict[Path, bool] = {}
+        # 本次运行中逐题追加过的文件（清单记录已失效）
+        self.appended_files: Set[Path] = set()
+        # --incremental：只处理这些文件中的题目，None表示全部处理
+        self.only_files: Optional[Set[Path]] = None
 
-        # 添加批处理控制
-        self.batch_size = 50  # 每次处理的批次大小
+        # 归档模式（--archive）：图片和md文件都写入一个tar/zip文件，output_base只作为归档内的根目录
+        self.archive: Optional[ArchiveWriter] = None
+        self.output_base: Optional[Path] = None
+
+        # 数据来源：None时从Redis读取；多进程模式下由父进程通过队列分发
+        self.source: Optional[Callable[[], AsyncIterator[Dict]]] = None
+        # run()中断时的异常，多进程模式下子进程据此返回非0退出码
+        self.error: Optional[BaseException] = None
 
         # 统计
         self.stats = {
@@ -93,7 +517,8 @@ class AsyncMDExporter:
             'success': 0,
             'failed': 0,
             'images_downloaded': 0,
-            'images_failed': 0
+            'images_failed': 0,
+            'skipped': 0
         }
 
     async def init_redis(self):
@@ -118,10 +543,19 @@ class AsyncMDExporter:
     async def init_session(self):
         """初始化aiohttp会话"""
         timeout = aiohttp.ClientTimeout(total=30)
-        self.session = aiohttp.ClientSession(timeout=timeout)
+        # 连接复用：连接数和worker数一致，空闲连接保持30秒，DNS结果缓存5分钟
+        connector = aiohttp.TCPConnector(
+            limit=self.image_workers,
+            limit_per_host=self.image_per_host,
+            keepalive_timeout=30,
+            ttl_dns_cache=300,
+        )
+        self.session = aiohttp.ClientSession(timeout=timeout, connector=connector)
 
     async def close(self):
         """关闭所有连接"""
+        await self.fetch_pool.close()
+
         if self.redis:
             await self.redis.close()
             logger.info("Redis连接已关闭")
@@ -130,8 +564,14 @@ class AsyncMDExporter:
             await self.session.close()
             logger.info("HTTP会话已关闭")
 
-    async def get_valid_data(self, limit: Optional[int] = None) -> List[Dict]:
-        """从Redis获取有效数据（异步版本）"""
+        if self.image_store:
+            self.image_store.close()
+
+    async def iter_valid_data(self, limit: Optional[int] = None) -> AsyncIterator[Dict]:
+        """从Redis分页读取有效数据（异步生成器）
+
+        每次LRANGE读取page_size条，处理当前页时预取下一页；内存中最多只有两页数据
+        """
         if not self.redis:
             await self.init_redis()
 
@@ -143,30 +583,46 @@ class AsyncMDExporter:
         if limit:
             total = min(total, limit)
 
-        valid_data = []
-        for i in range(total):
-            try:
-                item_json = await self.redis.lindex(self.redis_key, i)
-                if not item_json:
-                    continue
-
-                item = json.loads(item_json)
-
-                # 过滤无效数据
-                if not item.get('content') or not item.get('textAnalysis'):
-                    continue
+        def fetch(start):
+            end = min(start + self.page_size, total) - 1
+            return asyncio.ensure_future(self.redis.lrange(self.redis_key, start, end))
 
-                if not item.get('path'):
-                    continue
-
-                valid_data.append(item)
-
-            except Exception as e:
-                logger.warning(f"第{i}条数据解析失败: {e}")
-                continue
+        valid_count = 0
+        next_page = fetch(0) if total > 0 else None
+        try:
+            for start in range(0, total, self.page_size):
+                page = await next_page
+                next_start = start + self.page_size
+                next_page = fetch(next_start) if next_start < total else None
+
+                for offset, item_json in enumerate(page):
+                    if not item_json:
+                        continue
+
+                    try:
+                        item = json.loads(item_json)
+                    except Exception as e:
+                        logger.warning(f"第{start + offset}条数据解析失败: {e}")
+                        continue
+
+                    # 过滤无效数据
+                    if not item.get('content') or not item.get('textAnalysis'):
+                        continue
+
+                    if not item.get('path'):
+                        continue
+
+                    valid_count += 1
+                    yield item
+
+                # 列表被截断（比如被清空），后面没有数据了
+                if len(page) < min(self.page_size, total - start):
+                    break
+        finally:
+            if next_page and not next_page.done():
+                next_page.cancel()
 
-        logger.info(f"✅ 获取到 {len(valid_data)} 条有效数据")
-        return valid_data
+        logger.info(f"✅ 共读取 {valid_count} 条有效数据")
 
     def extract_img_urls(self, text: str) -> List[str]:
         """提取文本中的图片URL"""
@@ -197,23 +653,28 @@ class AsyncMDExporter:
 
             save_path = save_dir / filename
 
-            async with self.semaphore:
-                try:
-                    async with self.session.get(img_url) as response:
-                        if response.status == 200:
-                            content = await response.read()
-                            async with aiofiles.open(save_path, 'wb') as f:
-                                await f.write(content)
+            if self.archive:
+                return await self.archive_image(img_url, save_path, save_dir)
 
-                            self.stats['images_downloaded'] += 1
-                            if self.stats['images_downloaded'] % 10 == 0:
-                                logger.info(f"📸 已下载 {self.stats['images_downloaded']} 张图片...")
+            if self.image_store:
+                return await self.link_cached_image(img_url, save_path, save_dir)
 
-                            return str(save_path.relative_to(save_dir.parent))
-                        else:
-                            logger.warning(f"图片下载失败 {img_url}: 状态码 {response.status}")
-                except Exception as e:
-                    logger.warning(f"图片下载失败 {img_url}: {e}")
+            try:
+                status, _, content = await get_with_retry(self.session, img_url, retries=self.image_retries)
+                if status == 200:
+                    self.ensure_dir(save_dir)
+                    async with aiofiles.open(save_path, 'wb') as f:
+                        await f.write(content)
+
+                    self.stats['images_downloaded'] += 1
+                    if self.stats['images_downloaded'] % 10 == 0:
+                        logger.info(f"📸 已下载 {self.stats['images_downloaded']} 张图片...")
+
+                    return str(save_path.relative_to(save_dir.parent))
+                else:
+                    logger.warning(f"图片下载失败 {img_url}: 状态码 {status}")
+            except Exception as e:
+                logger.warning(f"图片下载失败 {img_url}: {e}")
 
         except Exception as e:
             logger.warning(f"处理图片URL失败 {img_url}: {e}")
@@ -221,6 +682,52 @@ class AsyncMDExporter:
         self.stats['images_failed'] += 1
         return None
 
+    async def link_cached_image(self, img_url: str, save_path: Path, save_dir: Path) -> Optional[str]:
+        """从图片缓存获取图片（没有时下载一次），链接到导出目录"""
+        blob = await self.image_store.fetch(self.session, img_url)
+
+        if blob:
+            try:
+                self.ensure_dir(save_dir)
+                self.image_store.link(blob, save_path)
+                self.stats['images_downloaded'] += 1
+                if self.stats['images_downloaded'] % 10 == 0:
+                    logger.info(f"📸 已获取 {self.stats['images_downloaded']} 张图片...")
+                return str(save_path.relative_to(save_dir.parent))
+            except OSError as e:
+                logger.warning(f"图片保存失败 {img_url}: {e}")
+
+        self.stats['images_failed'] += 1
+        return None
+
+    async def archive_image(self, img_url: str, save_path: Path, save_dir: Path) -> Optional[str]:
+        """归档模式：下载（或从缓存读取）图片后直接写入归档文件，返回相对md文件的路径"""
+        content = None
+        if self.image_store:
+            blob = await self.image_store.fetch(self.session, img_url)
+            if blob:
+                content = blob.read_bytes()
+        else:
+            try:
+                status, _, body = await get_with_retry(self.session, img_url, retries=self.image_retries)
+                if status == 200:
+                    content = body
+                else:
+                    logger.warning(f"图片下载失败 {img_url}: 状态码 {status}")
+            except Exception as e:
+                logger.warning(f"图片下载失败 {img_url}: {e}")
+
+        if content is None:
+            self.stats['images_failed'] += 1
+            return None
+
+        member = self.archive.add_image(save_path.relative_to(self.output_base).as_posix(), content)
+        self.stats['images_downloaded'] += 1
+        if self.stats['images_downloaded'] % 10 == 0:
+            logger.info(f"📸 已获取 {self.stats['images_downloaded']} 张图片...")
+        # zip中重复的图片引用第一份，可能在别的目录
+        return posixpath.relpath(member, save_dir.parent.relative_to(self.output_base).as_posix())
+
     async def replace_img_urls(self, text: str, img_dir: Path) -> str:
         """替换文本中的图片URL为本地路径"""
         img_urls = self.extract_img_urls(text)
@@ -228,18 +735,13 @@ class AsyncMDExporter:
         if not img_urls:
             return text
 
-        # 下载所有图片
-        download_tasks = []
-        for img_url in img_urls:
-            task = self.download_image(img_url, img_dir)
-            download_tasks.append((img_url, task))
+        # 所有图片一起提交给下载池，同一道题中重复的URL只下载一次
+        unique_urls = list(dict.fromkeys(img_urls))
+        futures = [await self.fetch_pool.submit(img_url, img_dir) for img_url in unique_urls]
 
         # 等待所有下载完成
-        results = {}
-        for img_url, task in download_tasks:
-            local_path = await task
-            if local_path:
-                results[img_url] = local_path
+        local_paths = await asyncio.gather(*futures)
+        results = {img_url: local_path for img_url, local_path in zip(unique_urls, local_paths) if local_path}
 
         # 替换URL
         if results:
@@ -288,19 +790,7 @@ class AsyncMDExporter:
 
     def clean_html_for_markdown(self, html: str) -> str:
         """清理HTML，转换为Markdown友好格式"""
-        if not html:
-            return ""
-
-        # 保留img标签
-        html = html.replace('<p>', '').replace('</p>', '')
-
-        # 保留换行
-        html = html.replace('<br>', '\n').replace('<br/>', '\n').replace('<br />', '\n')
-
-        # 清理多余的空白
-        html = re.sub(r'\s+', ' ', html).strip()
-
-        return html
+        return html_sanitizer.clean_html_for_markdown(html)
 
     def format_question_content(self, content: str) -> str:
         """格式化题目内容，添加高亮效果"""
@@ -350,6 +840,48 @@ class AsyncMDExporter:
 """
         return header
 
+    def resolve_target(self, path: List[str], output_base: Path) -> Tuple[Path, str]:
+        """路径 -> (保存目录, md文件名)：目录是除最后一层外的所有层，文件名是最后一层"""
+        key = (output_base, tuple(path))
+        target = self.path_cache.get(key)
+        if target:
+            return target
+
+        # 文件名：最后一层
+        filename = path[-1].replace('/', '_').replace('\\', '_')
+        if len(filename) > 50:  # 增加文件名长度限制
+            filename = filename[:50]
+        filename = _UNSAFE_CHARS_RE.sub('', filename) + '.md'
+
+        # 保存路径：除最后一层的所有层
+        save_dir = output_base.joinpath(*(safe_name(part) for part in path[:-1]))
+
+        target = self.path_cache[key] = (save_dir, filename)
+        return target
+
+    def ensure_dir(self, directory: Path):
+        """创建目录，每个目录只调用一次mkdir"""
+        if directory not in self.created_dirs:
+            directory.mkdir(parents=True, exist_ok=True)
+            self.created_dirs.add(directory)
+
+    def render_header_block(self, path: List[str]) -> str:
+        """文件开头：标题、分类和保存时间"""
+        header = self.create_markdown_header(path)
+        return f"{header}\n*题目保存时间: {self.get_current_time()}*\n\n---"
+
+    def render_question(self, formatted_content: str, formatted_options: str, answer: str,
+                        formatted_analysis: str) -> str:
+        """渲染一道题：题目、选项、答案、解析"""
+        parts = ['\n\n\n---\n', formatted_content]
+        if formatted_options:
+            parts.append(f'<p>{formatted_options}</p><p style="white-space: normal;">')
+        if answer:
+            parts.append(f'{answer},')
+        if formatted_analysis:
+            parts.append(f"{formatted_analysis}<br>")
+        return ''.join(parts)
+
     async def save_single_md(self, item: Dict, output_base: Path):
         """保存单个题目为Markdown文件"""
         try:
@@ -359,34 +891,26 @@ class AsyncMDExporter:
                 logger.warning(f"路径太短: {path}")
                 return False
 
-            # 文件名：最后一层
-            filename = path[-1].replace('/', '_').replace('\\', '_')
-            if len(filename) > 50:  # 增加文件名长度限制
-                filename = filename[:50]
-            filename = re.sub(r'[<>:"|?*]', '', filename) + '.md'
-
-            # 保存路径：除最后一层的所有层
-            save_dir = output_base
-            for part in path[:-1]:
-                safe_part = part.replace('/', '_').replace('\\', '_')
-                safe_part = re.sub(r'[<>:"|?*]', '', safe_part)
-                save_dir = save_dir / safe_part
+            save_dir, filename = self.resolve_target(path, output_base)
+            md_path = save_dir / filename
+            if self.only_files is not None and md_path not in self.only_files:
+                # 增量模式下没有变化的文件，不下载图片也不渲染
+                self.stats['skipped'] += 1
+                return True
 
-            # 图片文件夹
+            # 图片文件夹：下载第一张图片时才创建
             img_dir = save_dir / f"{filename.replace('.md', '_img')}"
 
-            # 创建目录
-            save_dir.mkdir(parents=True, exist_ok=True)
-            img_dir.mkdir(parents=True, exist_ok=True)
-
             # 2. 处理数据
             content = item.get('content', '')
             options = item.get('options', [])
             analysis = item.get('textAnalysis', '')
 
-            # 下载并替换图片
-            content = await self.replace_img_urls(content, img_dir)
-            analysis = await self.replace_img_urls(analysis, img_dir)
+            # 下载并替换图片（题目和解析中的图片同时下载）
+            content, analysis = await asyncio.gather(
+                self.replace_img_urls(content, img_dir),
+                self.replace_img_urls(analysis, img_dir),
+            )
 
             # 处理答案
             answer, clean_analysis = self.process_answer(analysis)
@@ -396,47 +920,46 @@ class AsyncMDExporter:
             formatted_options = self.format_options(options)
             formatted_analysis = self.format_analysis(clean_analysis)
 
-            # 3. 写入Markdown文件 - 使用文件信号量控制并发
-            md_path = save_dir / filename
+            # 3. 写入Markdown文件
+            question = self.render_question(formatted_content, formatted_options, answer, formatted_analysis)
+            fingerprint = question_fingerprint(item)
 
-            async def actual_write():
-                async with self.file_semaphore:  # 控制同时打开的文件数量
-                    async with aiofiles.open(md_path, 'a+', encoding='utf-8', errors='replace') as f:
-                        # 第一步：将文件指针移到文件开头（解决a+默认指针在末尾的问题）
-                        await f.seek(0)
-                        # 第二步：异步读取文件内容
-                        file_content = await f.read()
-                        # time.sleep(random.randint(1, 5))
-                        # 第三步：判断内容是否存在，不存在则追加
-                        header = self.create_markdown_header(path)
-                        if header not in file_content:
-                            # 写入文件头部和文件生成时间
-                            await f.write(header)
-                            await f.write(f"\n*题目保存时间: {self.get_current_time()}*\n")
-                            # 添加分隔线和时间戳
-                            await f.write("\n")
-                            await f.write('---')
-
-                        # 检查内容是否已存在
-                        content_check = formatted_content[:100]  # 只检查前100个字符
-                        if content_check not in file_content:
-                            # 写入题目部分
-                            await f.write('\n\n\n---\n')
-                            await f.write(f'{formatted_content}')
-
-                            # 写入选项部分
-                            if formatted_options:
-                                await f.write(f'<p>{formatted_options}</p><p style="white-space: normal;">')
-
-                            # 写入答案部分
-                            if answer:
-                                await f.write(f'{answer},')
-
-                            # 写入解析部分
-                            if formatted_analysis:
-                                await f.write(f"{formatted_analysis}<br>")
-
-            await write_queue.enqueue_write(md_path, actual_write)
+            if self.grouper:
+                # 聚合模式：只缓存，最后统一写入
+                self.grouper.add(md_path, self.render_header_block(path), fingerprint, question, source_digest(item))
+            else:
+                def actual_write(handle: BufferedHandle):
+                    if self.md_index and not self.is_legacy_file(md_path):
+                        if handle.stale_index:
+                            # 文件被删除或清空后重新创建：索引中的题目都要重新写入
+                            self.md_index.replace_file(md_path, [])
+                            handle.stale_index = False
+                        # 查索引（和还没刷盘的缓冲区）判断是否重复，不需要读文件
+                        if fingerprint in handle.pending or self.md_index.contains(md_path, fingerprint):
+                            return
+                        # 新文件先写文件头
+                        if handle.empty:
+                            handle.write(self.render_header_block(path))
+                        handle.write(question, fingerprint)
+                        self.invalidate_manifest(md_path)
+                        return
+
+                    # 没有索引的旧文件：读回整个文件，检查内容是否已存在（只检查前100个字符）
+                    content_check = formatted_content[:100]
+                    file_content = handle.read_all()
+                    header = self.create_markdown_header(path)
+                    if header not in file_content:
+                        # 写入文件头部、文件生成时间和分隔线
+                        handle.write(self.render_header_block(path))
+
+                    # 刷盘后记录到索引，下次运行时这个文件就不需要再读回了
+                    handle.write(question if content_check not in file_content else '',
+                                 fingerprint if self.md_index else None)
+                    if self.md_index:
+                        self.invalidate_manifest(md_path)
+
+                self.ensure_dir(save_dir)
+                await write_queue.enqueue_write(md_path, actual_write)
 
             self.stats['success'] += 1
             if self.stats['success'] % 100 == 0:
@@ -444,63 +967,183 @@ class AsyncMDExporter:
 
             return True
 
+        except GroupBufferExceeded:
+            # 不是单道题的问题，中止整个导出
+            raise
         except Exception as e:
             logger.error(f"保存文件失败: {e}")
             self.stats['failed'] += 1
             return False
 
+    def is_legacy_file(self, md_path: Path) -> bool:
+        """文件已存在但索引里没有记录（建立索引之前导出的），本次运行中按旧方式去重"""
+        legacy = self.legacy_files.get(md_path)
+        if legacy is None:
+            legacy = md_path.exists() and md_path.stat().st_size > 0 and not self.md_index.has_file(md_path)
+            self.legacy_files[md_path] = legacy
+        return legacy
+
+    def invalidate_manifest(self, md_path: Path):
+        """逐题追加过的文件从清单中删除，每个文件只删除一次"""
+        if md_path not in self.appended_files:
+            self.appended_files.add(md_path)
+            self.md_index.invalidate(md_path)
+
+    async def plan_incremental(self, limit: Optional[int], output_base: Path, dry_run: bool = False) -> Set[Path]:
+        """第一遍只读取数据：计算每个文件的题目指纹和内容哈希，和清单比较，返回需要重写的文件"""
+        logger.info("🔍 对比清单，计算需要更新的文件...")
+        files: Dict[Path, Dict[str, bytes]] = defaultdict(dict)
+        async for item in self.iter_valid_data(limit):
+            path = item.get('path', [])
+            if len(path) < 3:
+                continue
+            save_dir, filename = self.resolve_target(path, output_base)
+            # 同一个文件中指纹重复的题目只保留第一道，和写入时一致
+            files[save_dir / filename].setdefault(question_fingerprint(item), source_digest(item))
+
+        new_files, changed_files = [], []
+        for md_path, questions in files.items():
+            manifest = self.md_index.manifest(md_path)
+            if not md_path.exists():
+                new_files.append(md_path)
+            elif manifest is None or manifest[0] != content_hash(questions.values()):
+                changed_files.append(md_path)
+
+        unchanged = len(files) - len(new_files) - len(changed_files)
+        logger.info(f"📋 新文件 {len(new_files)} 个，需要重写 {len(changed_files)} 个，未变化 {unchanged} 个")
+
+        if dry_run:
+            for md_path in sorted(new_files):
+                print(f"  + {md_path.relative_to(output_base)}  ({len(files[md_path])} 道题)")
+            for md_path in sorted(changed_files):
+                current = set(files[md_path])
+                written = self.md_index.fingerprints(md_path)
+                added, removed = len(current - written), len(written - current)
+                if added or removed:
+                    detail = f"+{added} -{removed} 道题"
+                elif self.md_index.manifest(md_path) is None:
+                    detail = "清单中没有记录（逐题追加写入过）"
+                else:
+                    detail = "题目内容有修改"
+                print(f"  ~ {md_path.relative_to(output_base)}  ({detail})")
+            if limit is None:
+                # 清单中有、但这次没有任何题目的文件（不会被删除）
+                seen = {self.md_index.key(md_path) for md_path in files}
+                stale = [name for name in self.md_index.manifest_files() if name not in seen]
+                for name in stale:
+                    print(f"  ? {name}  (Redis中已没有这个文件的题目，保留不动)")
+
+        return set(new_files) | set(changed_files)
+
     def get_current_time(self):
         """获取当前时间"""
         from datetime import datetime
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    async def process_batch(self, data: List[Dict], output_base: Path):
-        """批量处理数据 - 分批处理避免打开太多文件"""
-        logger.info(f"🚀 开始处理 {len(data)} 条数据...")
-
-        # 分批处理
-        for i in range(0, len(data), self.batch_size):
-            batch = data[i:i + self.batch_size]
-            logger.info(
-                f"📦 处理批次 {i // self.batch_size + 1}/{(len(data) - 1) // self.batch_size + 1} (共 {len(batch)} 条)")
+    async def process_batch(self, items: AsyncIterator[Dict], output_base: Path):
+        """滑动窗口处理数据：max_in_flight个worker各自从队列中取题目，处理完一道马上取下一道
 
-            # 创建任务
-            tasks = []
-            for item in batch:
-                task = self.save_single_md(item, output_base)
-                tasks.append(task)
+        一张图片超时只占住一个位置，不会拖住其它题目；图片下载和文件写入分别由下载池和写入池限流
+        """
+        logger.info(f"🚀 开始处理数据（同时处理 {self.max_in_flight} 道题）...")
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_in_flight * 2)
+        start_time = time.time()
 
-            # 并发执行但等待批次完成
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            # 每批处理完后稍作休息
-            await asyncio.sleep(0.1)
-
-        logger.info(f"🎉 批量处理完成!")
-
-    async def run(self, limit: Optional[int] = None, output_dir: str = '../results/q_all'):
-        """运行完整流程"""
+        async def producer():
+            try:
+                async for item in items:
+                    self.stats['total'] += 1
+                    await queue.put(item)
+            finally:
+                # 每个worker一个结束标记
+                for _ in range(self.max_in_flight):
+                    await queue.put(None)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                await self.save_single_md(item, output_base)
+
+        producer_task = asyncio.create_task(producer())
+        workers = [asyncio.create_task(worker()) for _ in range(self.max_in_flight)]
+        try:
+            await asyncio.gather(*workers)
+            await producer_task
+        finally:
+            # 有worker出错中止时，停止读取和其它worker
+            for task in (producer_task, *workers):
+                task.cancel()
+
+        elapsed = time.time() - start_time
+        logger.info(f"🎉 处理完成! 共 {self.stats['total']} 条，{self.stats['total'] / max(elapsed, 1e-9):.1f} 条/秒")
+
+    async def run(self, limit: Optional[int] = None, output_dir: str = '../results/q_all', group: bool = False,
+                  spill_dir: Optional[str] = None, group_buffer_mb: int = 256,
+                  image_cache: Optional[str] = str(IMAGE_CACHE_DIR), image_cache_mb: int = 2048,
+                  revalidate_days: float = 7, incremental: bool = False, dry_run: bool = False,
+                  archive: Optional[str] = None):
+        """运行完整流程
+
+        incremental：先对比清单，只重写题目有变化的文件（按文件聚合写入）
+        dry_run：只列出 --incremental 会更新哪些文件，不写入
+        archive：写入tar/zip文件而不是目录（按文件聚合写入）
+        """
         logger.info("🚀 开始异步导出到Markdown")
+        if image_cache:
+            self.image_store = ImageStore(image_cache, max_bytes=image_cache_mb * 1024 * 1024,
+                                          revalidate_after=revalidate_days * 24 * 3600 if revalidate_days > 0 else None)
+        if archive:
+            self.archive = ArchiveWriter(archive)
+        if group or incremental or archive:
+            # 归档模式下只在内存中聚合，不往磁盘写临时文件
+            self.grouper = MarkdownGrouper(spill_dir=spill_dir, max_buffer_bytes=group_buffer_mb * 1024 * 1024,
+                                           allow_spill=not archive)
 
         try:
             # 初始化连接
-            await self.init_redis()
+            if not self.source:
+                await self.init_redis()
             await self.init_session()
 
-            # 获取数据
-            data = await self.get_valid_data(limit)
-            if not data:
+            # 创建输出目录（归档模式下不创建任何目录）
+            output_base = self.output_base = Path(output_dir)
+            if not self.archive:
+                output_base.mkdir(parents=True, exist_ok=True)
+                self.md_index = MarkdownIndex(output_base)
+                # 文件句柄刷盘后才把其中的题目记录到索引
+                write_queue.on_flush = self.md_index.add_many
+
+            if incremental or dry_run:
+                self.only_files = await self.plan_incremental(limit, output_base, dry_run=dry_run)
+                if dry_run:
+                    return
+                if not self.only_files:
+                    logger.info("✅ 所有文件都是最新的")
+                    return
+
+            # 边读取边处理数据
+            items = self.source() if self.source else self.iter_valid_data(limit)
+            await self.process_batch(items, output_base)
+            if write_queue.tasks:
+                logger.info(f"📝 写入队列深度: {write_queue.queue_depths()}，最大 {write_queue.stats['max_queue_depth']}，"
+                            f"文件句柄命中率 {write_queue.hit_rate():.1%}")
+            await write_queue.close()
+            if not self.stats['total']:
                 logger.warning("⚠️ 没有获取到有效数据")
                 return
 
-            self.stats['total'] = len(data)
-
-            # 创建输出目录
-            output_base = Path(output_dir)
-            output_base.mkdir(parents=True, exist_ok=True)
-
-            # 处理数据
-            await self.process_batch(data, output_base)
+            if self.grouper:
+                logger.info(f"📝 聚合完成，开始写入文件（已落盘 {self.grouper.stats['spilled_bytes'] / 1024 / 1024:.1f} MB）...")
+                files = await asyncio.to_thread(self.grouper.write_all, self.archive, output_base)
+                # 文件被整体重写，索引和清单同步替换
+                for md_path, fingerprints in (self.grouper.seen.items() if self.md_index else []):
+                    self.md_index.update_manifest(md_path, content_hash(self.grouper.digests[md_path]),
+                                                  len(fingerprints))
+                    self.md_index.replace_file(md_path, fingerprints)
+                logger.info(f"✅ 写入 {files} 个文件，{self.grouper.stats['questions']} 道题，"
+                            f"跳过重复 {self.grouper.stats['duplicates']} 道")
 
             # 打印统计
             logger.info("=" * 50)
@@ -508,26 +1151,173 @@ class AsyncMDExporter:
             logger.info(f"  处理总数: {self.stats['total']}")
             logger.info(f"  成功保存: {self.stats['success']}")
             logger.info(f"  保存失败: {self.stats['failed']}")
+            if self.only_files is not None:
+                logger.info(f"  未变化跳过: {self.stats['skipped']}")
             logger.info(f"  图片下载: {self.stats['images_downloaded']}")
             logger.info(f"  图片失败: {self.stats['images_failed']}")
+            if self.archive:
+                logger.info(f"  归档文件: {self.archive.archive_path}，图片 {self.archive.stats['images']} 张，"
+                            f"去重 {self.archive.stats['duplicate_images']} 张")
+            if self.image_store:
+                cache_stats = self.image_store.stats
+                logger.info(f"  图片缓存: 命中 {cache_stats['hits']}，下载 {cache_stats['downloads']}，"
+                            f"304 {cache_stats['revalidated']}，淘汰 {cache_stats['evicted']}")
             logger.info("=" * 50)
 
         except Exception as e:
             logger.error(f"❌ 运行失败: {e}")
+            self.error = e
         finally:
+            if self.grouper:
+                self.grouper.discard()
+            # 出错时也要把已提交的写入写完
+            await write_queue.close()
+            if self.md_index:
+                self.md_index.close()
+            if self.archive:
+                self.archive.close()
+                if self.error:
+                    # 不完整的归档文件没有用处，删掉以免被当成完整的导出结果
+                    os.remove(self.archive.archive_path)
+                    logger.error(f"❌ 已删除不完整的归档文件 {self.archive.archive_path}")
             # 关闭所有连接
             await self.close()
 
 
-# @atexit.register
-def remove_empty_folders_pathlib(path):
-    path_obj = Path(path)
-    for folder in sorted(path_obj.rglob('*'), key=lambda p: len(p.parts), reverse=True):
-        if folder.is_dir() and not any(folder.iterdir()):
-            folder.rmdir()
-            # print(f"已删除空文件夹: {folder}")
+async def queue_source(item_queue, parent_pid: int, timeout: float = 1.0) -> AsyncIterator[Dict]:
+    """从进程队列中读取父进程分发的题目，每次一批，None表示结束
 
-    print("存储结束")
+    每次最多等待timeout秒，父进程已经退出（当前进程被过继，父进程id变了）时抛出异常，子进程不会一直阻塞
+    """
+    while True:
+        try:
+            chunk = await asyncio.to_thread(item_queue.get, True, timeout)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                raise RuntimeError(f"父进程 {parent_pid} 已退出，停止导出")
+            continue
+        if chunk is None:
+            return
+        for item in chunk:
+            yield item
+
+
+def shard_of(item: Dict, processes: int) -> int:
+    """题目分给哪个子进程：按考试类别（path[0]）的crc32取模，同一类别总在同一个进程中"""
+    return zlib.crc32(item['path'][0].encode('utf-8')) % processes
+
+
+def shard_worker(shard: int, item_queue, result_queue, output_dir: str, options: Dict, run_kwargs: Dict):
+    """子进程：用自己的事件循环运行AsyncMDExporter，结束后把统计和错误发回父进程，失败时退出码为1"""
+    exporter = AsyncMDExporter(image_workers=options['image_workers'])
+    exporter.max_in_flight = options['max_in_flight']
+    parent_pid = os.getppid()
+    exporter.source = lambda: queue_source(item_queue, parent_pid)
+
+    try:
+        asyncio.run(exporter.run(output_dir=output_dir, **run_kwargs))
+    except Exception as e:
+        exporter.error = e
+        raise
+    finally:
+        cache_stats = exporter.image_store.stats if exporter.image_store else {}
+        error = f"{type(exporter.error).__name__}: {exporter.error}" if exporter.error else None
+        result_queue.put((shard, exporter.stats, cache_stats, error))
+    if exporter.error:
+        sys.exit(1)
+
+
+def put_until_alive(item_queue, chunk, process):
+    """队列满时等待；子进程已经退出时抛出异常，避免父进程一直阻塞"""
+    while True:
+        try:
+            item_queue.put(chunk, timeout=1)
+            return
+        except queue.Full:
+            if not process.is_alive():
+                raise RuntimeError(f"子进程 {process.name} 已退出（exitcode={process.exitcode}）")
+
+
+async def run_sharded(processes: int, limit: Optional[int], output_dir: str, options: Dict, run_kwargs: Dict,
+                      chunk_size: int = 200):
+    """多进程导出：父进程读取Redis，按考试类别（path[0]）分发给processes个子进程
+
+    同一类别的题目总在同一个子进程中，各子进程写入互不重叠的子目录；
+    图片缓存和去重索引是WAL模式的SQLite，可以共用；
+    有子进程失败（报告了错误或退出码不为0）时汇总后抛出RuntimeError
+    """
+    ctx = multiprocessing.get_context('spawn')
+    item_queues = [ctx.Queue(maxsize=8) for _ in range(processes)]
+    result_queue = ctx.Queue()
+    workers = [
+        ctx.Process(target=shard_worker, name=f"md-shard-{shard}",
+                    args=(shard, item_queues[shard], result_queue, output_dir, options, run_kwargs))
+        for shard in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"🚀 启动 {processes} 个导出进程")
+
+    reader = AsyncMDExporter()
+    chunks: List[List[Dict]] = [[] for _ in range(processes)]
+    try:
+        async for item in reader.iter_valid_data(limit):
+            shard = shard_of(item, processes)
+            chunks[shard].append(item)
+            if len(chunks[shard]) >= chunk_size:
+                await asyncio.to_thread(put_until_alive, item_queues[shard], chunks[shard], workers[shard])
+                chunks[shard] = []
+    finally:
+        for shard, worker in enumerate(workers):
+            if worker.is_alive():
+                if chunks[shard]:
+                    await asyncio.to_thread(put_until_alive, item_queues[shard], chunks[shard], worker)
+                await asyncio.to_thread(put_until_alive, item_queues[shard], None, worker)
+        await reader.close()
+
+    # 先收集结果再join，异常退出的进程不会发回结果
+    results = []
+    while len(results) < processes:
+        try:
+            results.append(await asyncio.to_thread(result_queue.get, True, 1))
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+    for worker in workers:
+        await asyncio.to_thread(worker.join)
+
+    # 汇总各进程的统计
+    totals: Dict[str, int] = defaultdict(int)
+    cache_totals: Dict[str, int] = defaultdict(int)
+    errors = {}
+    for shard, stats, cache_stats, error in sorted(results, key=lambda result: result[0]):
+        logger.info(f"  进程 {shard}: {stats}")
+        if error:
+            errors[shard] = error
+        for key, value in stats.items():
+            totals[key] += value
+        for key, value in cache_stats.items():
+            cache_totals[key] += value
+
+    logger.info("=" * 50)
+    logger.info("📊 全部进程汇总:")
+    logger.info(f"  处理总数: {totals['total']}")
+    logger.info(f"  成功保存: {totals['success']}")
+    logger.info(f"  保存失败: {totals['failed']}")
+    logger.info(f"  图片下载: {totals['images_downloaded']}")
+    logger.info(f"  图片失败: {totals['images_failed']}")
+    if cache_totals:
+        logger.info(f"  图片缓存: 命中 {cache_totals['hits']}，下载 {cache_totals['downloads']}，"
+                    f"304 {cache_totals['revalidated']}，淘汰 {cache_totals['evicted']}")
+    failed_workers = [worker.name for shard, worker in enumerate(workers) if worker.exitcode != 0 or shard in errors]
+    for shard, error in errors.items():
+        logger.error(f"❌ 进程 {shard} 失败: {error}")
+    if failed_workers:
+        logger.error(f"❌ 异常退出的进程: {failed_workers}")
+    logger.info("=" * 50)
+    if failed_workers:
+        raise RuntimeError(f"{len(failed_workers)} 个导出进程失败，输出不完整: {failed_workers}")
+    return dict(totals)
 
 
 # 快速测试函数
@@ -550,22 +1340,12 @@ async def test_single_item():
     # 测试保存
     output_base = Path('../results/test_q')
     result = await exporter.save_single_md(test_item, output_base)
+    await write_queue.close()
 
     # 预览生成的内容
     if result:
         # 构建正确的文件路径
-        safe_filename = test_item['path'][-1].replace('/', '_').replace('\\', '_')
-        if len(safe_filename) > 50:
-            safe_filename = safe_filename[:50]
-        safe_filename = re.sub(r'[<>:"|?*]', '', safe_filename) + '.md'
-
-        # 构建目录路径
-        save_dir = output_base
-        for part in test_item['path'][:-1]:
-            safe_part = part.replace('/', '_').replace('\\', '_')
-            safe_part = re.sub(r'[<>:"|?*]', '', safe_part)
-            save_dir = save_dir / safe_part
-
+        save_dir, safe_filename = exporter.resolve_target(test_item['path'], output_base)
         md_path = save_dir / safe_filename
 
         if md_path.exists():
@@ -587,27 +1367,71 @@ async def main():
 
 
     # 解析参数
-    limit = None
-    output_dir = '../results/q_all'
-    atexit.register(remove_empty_folders_pathlib, output_dir)
-    if len(sys.argv) > 1:
-        try:
-            limit = int(sys.argv[1])
-            print(f"将处理前 {limit} 条数据")
-        except ValueError:
-            print(f"无效的限制参数: {sys.argv[1]}")
-
-    if len(sys.argv) > 2:
-        output_dir = sys.argv[2]
+    parser = argparse.ArgumentParser(description='把Redis中的题目导出为Markdown文件')
+    parser.add_argument('limit', nargs='?', type=int, default=None, help='只处理前N条数据，默认全部')
+    parser.add_argument('output_dir', nargs='?', default='../results/q_all', help='输出目录')
+    parser.add_argument('--group', action='store_true',
+                        help='按文件聚合后每个文件一次性写入（重新生成整个目录，覆盖已有文件）')
+    parser.add_argument('--incremental', action='store_true',
+                        help='对比输出目录中的清单，只重写题目有变化的文件（按文件聚合写入）')
+    parser.add_argument('--dry-run', action='store_true', help='只列出 --incremental 会更新哪些文件，不写入')
+    parser.add_argument('--archive', default=None,
+                        help='写入一个归档文件（.tar/.tar.gz/.zip）而不是目录，归档内的目录结构和导出到output_dir时相同')
+    parser.add_argument('--spill-dir', default=None, help='--group模式下临时文件的目录，默认系统临时目录')
+    parser.add_argument('--group-buffer-mb', type=int, default=256,
+                        help='--group模式下内存中最多缓存多少MB，超过后写到临时文件；--archive模式下超过时报错退出')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='导出进程数，大于1时按考试类别（path的第一层）分给多个进程')
+    parser.add_argument('--max-in-flight', type=int, default=50, help='同时处理的题目数')
+    parser.add_argument('--image-workers', type=int, default=10, help='同时下载图片的worker数')
+    parser.add_argument('--image-cache', default=str(IMAGE_CACHE_DIR), help='图片缓存目录')
+    parser.add_argument('--no-image-cache', action='store_true', help='不使用图片缓存，每次都重新下载')
+    parser.add_argument('--image-cache-mb', type=int, default=2048, help='图片缓存大小上限（MB），超过后淘汰最久未使用的图片')
+    parser.add_argument('--revalidate-days', type=float, default=7,
+                        help='缓存超过多少天后用ETag/Last-Modified重新验证，0表示不验证')
+    args = parser.parse_args()
+    if args.processes > 1 and (args.incremental or args.dry_run):
+        parser.error('--incremental/--dry-run 需要读取两遍数据，不能和 --processes 一起使用')
+    if args.archive and (args.processes > 1 or args.incremental or args.dry_run):
+        parser.error('--archive 不能和 --processes/--incremental/--dry-run 一起使用')
+
+    limit = args.limit
+    output_dir = args.output_dir
+    if limit:
+        print(f"将处理前 {limit} 条数据")
 
     print(f"输出目录: {output_dir}")
+    if args.group:
+        print("写入方式: 聚合后一次性写入")
+    if args.archive:
+        print(f"写入方式: 归档文件 {args.archive}")
+    if args.incremental or args.dry_run:
+        print("写入方式: 增量更新" + ("（只列出变化，不写入）" if args.dry_run else ""))
+    if limit and (args.group or args.incremental):
+        print("⚠️ 聚合/增量模式会整体重写文件，配合limit使用时文件中只会保留前limit条中的题目")
     print("=" * 50)
 
-    # 创建导出器
-    exporter = AsyncMDExporter()
+    run_kwargs = dict(group=args.group, spill_dir=args.spill_dir, group_buffer_mb=args.group_buffer_mb,
+                      image_cache=None if args.no_image_cache else args.image_cache,
+                      image_cache_mb=args.image_cache_mb, revalidate_days=args.revalidate_days)
 
-    # 运行导出
-    await exporter.run(limit=limit, output_dir=output_dir)
+    if args.processes > 1:
+        options = {'image_workers': args.image_workers, 'max_in_flight': args.max_in_flight}
+        try:
+            await run_sharded(args.processes, limit, output_dir, options, run_kwargs)
+        except RuntimeError as e:
+            logger.error(f"❌ {e}")
+            sys.exit(1)
+    else:
+        # 创建导出器
+        exporter = AsyncMDExporter(image_workers=args.image_workers)
+        exporter.max_in_flight = args.max_in_flight
+
+        # 运行导出
+        await exporter.run(limit=limit, output_dir=output_dir, incremental=args.incremental,
+                           dry_run=args.dry_run, archive=args.archive, **run_kwargs)
+        if exporter.error:
+            sys.exit(1)
 
     print("\n🎉 导出完成！")
 
@@ -1,8 +1,20 @@
 import redis
 import json
 import re
+import os
+import sys
+import time
+import uuid
+import queue
+import hashlib
+import tempfile
+import argparse
+import threading
 import pymysql
-from typing import List, Dict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Iterator, Optional, Tuple
+import html_sanitizer
 from config import (
     # Redis配置
     REDIS_HOST,
@@ -13,24 +25,585 @@ from config import (
     MYSQL_CONFIG
 )
 
+
+def extract_answer(analysis: str) -> str:
+    """从解析中提取答案"""
+    if not analysis:
+        return ""
+
+    # 找<p>前面的字母或数字
+    # 比如 "B<p>..." 或 "1<p>..."
+    match = re.match(r'^([A-Z0-9]+)<p>', analysis)
+    if match:
+        answer = match.group(1)
+        # 如果是数字，处理判断题
+        if answer.isdigit():
+            if answer == '1':
+                return '正确'
+            elif answer == '0':
+                return '错误'
+        return answer
+
+    # 如果没有<p>标签，直接取开头的字母或数字
+    match = re.match(r'^([A-Z0-9]+)', analysis)
+    if match:
+        answer = match.group(1)
+        if answer.isdigit():
+            if answer == '1':
+                return '正确'
+            elif answer == '0':
+                return '错误'
+        return answer
+
+    return ""
+
+
+def process_item(item: Dict) -> Dict:
+    """处理单个数据（模块级函数，可以在worker进程中执行）"""
+    result = {}
+
+    # 1. 处理path：用->连接（path_list留给normalized模式查paths维表）
+    path_list = item.get('path', [])
+    result['path'] = '->'.join(path_list) if path_list else ''
+    result['path_list'] = path_list
+
+    # 2. 处理content：去掉HTML标签但保留img
+    content = item.get('content', '')
+    result['content'] = html_sanitizer.clean_content(content)
+
+    # 3. 处理options：原样保存（JSON格式）
+    options = item.get('options', [])
+    result['options'] = json.dumps(options, ensure_ascii=False) if options else '[]'
+
+    # 4. 处理textAnalysis
+    analysis = item.get('textAnalysis', '')
+    # 提取答案
+    result['answer'] = extract_answer(analysis)
+    # 清理解析（保留img）
+    result['analysis'] = html_sanitizer.clean_analysis(analysis)
+
+    # 5. 内容哈希：同一路径下的同一道题只保存一行
+    result['content_hash'] = content_hash(result['path'], result['content'], result['options'])
+
+    return result
+
+
+def content_hash(path: str, content: str, options: str) -> str:
+    """题目的内容哈希，与MySQL中 SHA1(CONCAT_WS(CHAR(31), path, content, options)) 的结果一致"""
+    return hashlib.sha1('\x1f'.join((path, content, options)).encode('utf-8')).hexdigest()
+
+
+def iter_redis_items(client, redis_key: str, start: int = 0, limit: Optional[int] = None, chunk_size: int = 500,
+                     pipeline_pages: int = 4) -> Iterator[Tuple[int, str]]:
+    """分页流式读取Redis列表，返回(下标, 原始JSON)
+
+    LINDEX在list上是O(n)的，逐条读取整体是O(n²)；这里用LRANGE按chunk_size分页，
+    每次pipeline打包pipeline_pages个LRANGE，内存和往返次数都与列表长度无关
+    """
+    total = client.llen(redis_key)
+    end = total if limit is None else min(total, start + limit)
+
+    pos = start
+    while pos < end:
+        pipe = client.pipeline(transaction=False)
+        pages = []
+        for _ in range(pipeline_pages):
+            if pos >= end:
+                break
+            page_end = min(pos + chunk_size, end)
+            pipe.lrange(redis_key, pos, page_end - 1)
+            pages.append((pos, page_end))
+            pos = page_end
+
+        truncated = False
+        for (page_start, page_end), chunk in zip(pages, pipe.execute()):
+            for offset, item_json in enumerate(chunk):
+                yield page_start + offset, item_json
+            if len(chunk) < page_end - page_start:
+                truncated = True
+
+        # 列表在读取过程中被截断时提前结束
+        if truncated:
+            break
+
+
+def transform_chunk(chunk: List[Tuple[int, str]]) -> List[Tuple[int, str, object]]:
+    """解析并清洗一批数据，返回[(下标, 状态, 结果)]
+
+    状态为 ok（结果是清洗后的数据）、discard（无效数据）、skip（空数据）或 error（结果是错误信息）
+    """
+    results = []
+    for i, item_json in chunk:
+        try:
+            if not item_json:
+                results.append((i, 'skip', None))
+                continue
+
+            item = json.loads(item_json)
+
+            # 跳过无效数据（没有content或textAnalysis）
+            if not item.get('content') or not item.get('textAnalysis'):
+                results.append((i, 'discard', None))
+                continue
+
+            results.append((i, 'ok', process_item(item)))
+        except Exception as e:
+            results.append((i, 'error', str(e)))
+
+    return results
+
+
+def path_hash(parts: List[str]) -> str:
+    """路径的哈希，paths维表按它唯一"""
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def upsert_sql(columns: Tuple[str, ...]) -> str:
+    """content_hash重复时只更新答案和解析，重复导出不会产生重复数据"""
+    return f"""
+    INSERT INTO questions ({', '.join(columns)})
+    VALUES ({', '.join(['%s'] * len(columns))})
+    ON DUPLICATE KEY UPDATE answer = VALUES(answer), analysis = VALUES(analysis)
+    """
+
+
+# 写入questions表的列，BatchWriter按这个顺序组装每一行
+INSERT_COLUMNS = ('path', 'content', 'options', 'answer', 'analysis', 'content_hash')
+# normalized模式：path换成paths维表的id
+NORMALIZED_COLUMNS = ('path_id', 'content', 'options', 'answer', 'analysis', 'content_hash')
+UPSERT_SQL = upsert_sql(INSERT_COLUMNS)
+
+
+class BatchWriter:
+    """批量写入MySQL：缓冲清洗后的数据，攒够batch_size条或超过flush_interval秒就用executemany写一次
+
+    每批一个事务，只commit一次；某一批写入失败时对半拆分重试，把坏数据隔离出来，
+    而不是整批回滚丢弃
+
+    传入checkpoint时，已经写入的Redis下标会和数据在同一个事务中记录下来，
+    任何时候中断，下次都能从记录的位置继续
+    """
+
+    def __init__(self, db, batch_size: int = 500, flush_interval: float = 5.0,
+                 checkpoint: Optional['ExportCheckpoint'] = None, columns: Tuple[str, ...] = INSERT_COLUMNS):
+        self.db = db
+        self.cursor = db.cursor()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.columns = columns
+        self.sql = upsert_sql(columns)
+        self.checkpoint = checkpoint
+
+        self.buffer: List[Tuple] = []
+        self.last_flush = time.time()
+
+        # 已处理完的下标区间 {起点: 终点}，用来计算连续的水位线
+        self.watermark = checkpoint.offset if checkpoint else 0
+        self.saved_watermark = self.watermark
+        self.done_ranges: Dict[int, int] = {}
+
+        # 统计
+        self.success = 0
+        self.failed = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+
+    def add(self, data: Dict):
+        """加入一条清洗后的数据，满足条件时自动刷盘"""
+        self.buffer.append(tuple(data[col] for col in self.columns))
+
+        if len(self.buffer) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def mark_done(self, start: int, end: int):
+        """标记Redis下标区间[start, end)已经全部交给了writer（乱序完成也没关系）"""
+        self.done_ranges[start] = end
+        while self.watermark in self.done_ranges:
+            self.watermark = self.done_ranges.pop(self.watermark)
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """把缓冲区写入MySQL"""
+        rows, self.buffer = self.buffer, []
+        self.last_flush = time.time()
+        # 水位线之前的数据都已经在rows里或者已经写入
+        watermark = self.watermark if self.checkpoint and self.watermark != self.saved_watermark else None
+        if not rows and watermark is None:
+            return
+
+        start = time.time()
+        if not rows:
+            self._save_checkpoint(watermark)
+        else:
+            if not self._write(rows, watermark) and watermark is not None:
+                # 拆分重试后，坏数据已经被跳过，单独记录水位线
+                self._save_checkpoint(watermark)
+            self.batches += 1
+        self.write_seconds += time.time() - start
+
+    def _save_checkpoint(self, watermark: int):
+        """单独提交一次水位线"""
+        try:
+            self.checkpoint.save(self.cursor, watermark)
+            self.db.commit()
+            self.saved_watermark = watermark
+        except Exception as e:
+            print(f"❌ 保存导出进度失败: {e}")
+            self.db.rollback()
+
+    def _write(self, rows: List[Tuple], watermark: Optional[int] = None) -> bool:
+        """写入一批数据，失败时对半拆分直到定位到出错的单行
+
+        返回这批数据（连同水位线）是否在同一个事务中整体写入成功
+        """
+        try:
+            self.cursor.executemany(self.sql, rows)
+            if watermark is not None:
+                self.checkpoint.save(self.cursor, watermark)
+            self.db.commit()
+            self.success += len(rows)
+            if watermark is not None:
+                self.saved_watermark = watermark
+            return True
+        except Exception as e:
+            self.db.rollback()
+            if len(rows) == 1:
+                print(f"❌ 保存失败: {e}")
+                self.failed += 1
+                return False
+
+            mid = len(rows) // 2
+            self._write(rows[:mid])
+            self._write(rows[mid:])
+            return False
+
+    def close(self):
+        """写入剩余数据并关闭游标"""
+        self.flush()
+        self.cursor.close()
+
+
+# LOAD DATA默认格式（FIELDS TERMINATED BY '\t' ESCAPED BY '\\' LINES TERMINATED BY '\n'）需要转义的字符
+_TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+# 服务端或客户端禁止LOCAL INFILE时的错误码
+LOCAL_INFILE_ERRORS = {
+    1148,  # ER_NOT_ALLOWED_COMMAND
+    2068,  # CR_LOAD_DATA_LOCAL_INFILE_REJECTED
+    3948,  # ER_CLIENT_LOCAL_FILES_DISABLED
+    3950,  # ER_LOAD_DATA_INFILE_LOCAL_DISABLED
+}
+
+
+def tsv_field(value) -> str:
+    """把一个值转成LOAD DATA能原样读回的TSV字段"""
+    if value is None:
+        return '\\N'
+    return str(value).translate(_TSV_ESCAPES)
+
+
+class LocalInfileDisabled(Exception):
+    """MySQL不允许LOAD DATA LOCAL INFILE"""
+
+
+# --disable-keys导入期间删除、导入后重建的索引：索引名 -> (依赖的列, 定义)
+BULK_SECONDARY_KEYS = {
+    'uk_content_hash': ('content_hash', 'UNIQUE KEY uk_content_hash (content_hash)'),
+    'idx_path_id': ('path_id', 'KEY idx_path_id (path_id)'),
+}
+
+# 没有唯一索引时LOAD DATA REPLACE不会替换旧行，重建前按REPLACE的语义保留每组id最大（最后导入）的一行
+DEDUP_BEFORE_UNIQUE_SQL = """
+DELETE q FROM questions q
+JOIN (SELECT content_hash, MAX(id) AS keep_id FROM questions
+      WHERE content_hash IS NOT NULL GROUP BY content_hash HAVING COUNT(*) > 1) d
+ON q.content_hash = d.content_hash AND q.id < d.keep_id
+"""
+
+
+def existing_keys(cursor) -> set:
+    """questions表上现有的索引名"""
+    cursor.execute("""
+    SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'questions'
+    """)
+    return {row[0] for row in cursor.fetchall()}
+
+
+def bulk_keys(columns: Tuple[str, ...]) -> List[str]:
+    """当前表结构中可以在导入期间删除的索引"""
+    return [name for name, (column, _) in BULK_SECONDARY_KEYS.items() if column in columns]
+
+
+def restore_keys(db, cursor, columns: Tuple[str, ...]) -> List[str]:
+    """补上缺失的二级索引，唯一索引重建前先删除重复行；返回补上的索引名
+
+    --disable-keys导入结束时调用；导入中途崩溃时，下次启动创建表后也会调用一次
+    """
+    missing = [name for name in bulk_keys(columns) if name not in existing_keys(cursor)]
+    if not missing:
+        return []
+
+    start = time.time()
+    if 'uk_content_hash' in missing:
+        cursor.execute(DEDUP_BEFORE_UNIQUE_SQL)
+        if cursor.rowcount:
+            print(f"🧹 删除了 {cursor.rowcount} 行重复题目（保留最后导入的一行）")
+        db.commit()
+    cursor.execute("ALTER TABLE questions " + ", ".join(f"ADD {BULK_SECONDARY_KEYS[name][1]}" for name in missing))
+    print(f"✅ 重建索引 {', '.join(missing)}，耗时 {time.time() - start:.1f} 秒")
+    return missing
+
+
+class BulkLoader(BatchWriter):
+    """LOAD DATA批量导入：清洗后的数据顺序写入临时TSV文件，每batch_size行执行一次LOAD DATA LOCAL INFILE
+
+    和BatchWriter一样，每次LOAD与导出进度在同一个事务中提交
+
+    disable_keys=True时第一次LOAD前删除content_hash唯一索引和path_id索引，全部导入后去重并一次性重建：
+    InnoDB的DISABLE KEYS不起作用，逐行维护索引是LOAD DATA的主要开销；
+    中途崩溃时下次启动create_table会同样去重并补上索引（restore_keys）
+
+    REPLACE遇到content_hash重复时先删除旧行再插入，重复题目的id和created_at会变成新的
+    """
+
+    def __init__(self, db, batch_size: int = 100000, checkpoint: Optional['ExportCheckpoint'] = None,
+                 spool_dir: Optional[str] = None, disable_keys: bool = False,
+                 columns: Tuple[str, ...] = INSERT_COLUMNS):
+        # 只按行数触发LOAD，不按时间
+        super().__init__(db, batch_size=batch_size, flush_interval=float('inf'), checkpoint=checkpoint,
+                         columns=columns)
+        self.load_sql = f"""
+        LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE questions
+        CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+        LINES TERMINATED BY '\\n'
+        ({', '.join(columns)})
+        """
+        self.spool_dir = spool_dir
+        self.disable_keys = disable_keys
+        self.keys_disabled = False
+        self.spool = None
+        self.spooled = 0
+
+    def add(self, data: Dict):
+        """追加一行到TSV文件"""
+        if self.spool is None:
+            self.spool = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv',
+                                                     prefix='questions_', dir=self.spool_dir, delete=False)
+        self.spool.write('\t'.join(tsv_field(data[col]) for col in self.columns))
+        self.spool.write('\n')
+        self.spooled += 1
+
+        if self.spooled >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """把当前的TSV文件导入MySQL"""
+        watermark = self.watermark if self.checkpoint and self.watermark != self.saved_watermark else None
+        if not self.spooled:
+            if watermark is not None:
+                self._save_checkpoint(watermark)
+            return
+
+        spool, rows = self.spool, self.spooled
+        self.spool, self.spooled = None, 0
+        spool.close()
+
+        start = time.time()
+        try:
+            if self.disable_keys and not self.keys_disabled:
+                self.drop_keys()
+
+            self.cursor.execute(self.load_sql, (spool.name,))
+            if watermark is not None:
+                self.checkpoint.save(self.cursor, watermark)
+            self.db.commit()
+            self.success += rows
+            self.batches += 1
+            if watermark is not None:
+                self.saved_watermark = watermark
+            print(f"📦 LOAD DATA 导入 {rows} 行，耗时 {time.time() - start:.1f} 秒")
+        except pymysql.err.MySQLError as e:
+            self.db.rollback()
+            if e.args and e.args[0] in LOCAL_INFILE_ERRORS:
+                raise LocalInfileDisabled(str(e)) from e
+            raise
+        finally:
+            self.write_seconds += time.time() - start
+            os.remove(spool.name)
+
+    def drop_keys(self):
+        """删除二级索引，导入时不再逐行维护"""
+        existing = existing_keys(self.cursor)
+        names = [name for name in bulk_keys(self.columns) if name in existing]
+        if names:
+            self.cursor.execute("ALTER TABLE questions " + ", ".join(f"DROP INDEX {name}" for name in names))
+            print(f"🔧 导入期间删除索引: {', '.join(names)}")
+        self.keys_disabled = True
+
+    def restore_keys(self):
+        """重建导入期间删除的索引"""
+        self.keys_disabled = False
+        restore_keys(self.db, self.cursor, self.columns)
+
+    def abort(self):
+        """放弃还没导入的TSV文件；索引已删除时先恢复，改用INSERT导出时要靠唯一索引去重"""
+        if self.spool is not None:
+            self.spool.close()
+            os.remove(self.spool.name)
+            self.spool, self.spooled = None, 0
+        if self.keys_disabled:
+            self.restore_keys()
+
+    def close(self):
+        """导入剩余数据，恢复索引"""
+        try:
+            self.flush()
+        finally:
+            if self.keys_disabled:
+                self.restore_keys()
+            self.cursor.close()
+
+
+class PathDictionary:
+    """paths维表：每个路径前缀一行，lineage是从根到自己的id序列（如 /1/5/9/）
+
+    查询某个前缀下的所有题目只需要 lineage LIKE '/1/5/%'，可以走索引；
+    内存中缓存 路径 -> (id, lineage)，同一个路径只查一次库
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.cursor = db.cursor()
+        self.cache: Dict[Tuple[str, ...], Tuple[int, str]] = {}
+
+    def create_table(self):
+        """创建paths表"""
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS paths (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            parent_id INT COMMENT '上一层路径id',
+            depth TINYINT NOT NULL COMMENT '层级，从1开始',
+            name VARCHAR(255) NOT NULL COMMENT '这一层的名称',
+            full_path TEXT COMMENT '完整路径，用->连接',
+            path_hash CHAR(40) NOT NULL COMMENT '完整路径的哈希',
+            lineage VARCHAR(255) CHARACTER SET ascii NOT NULL DEFAULT '' COMMENT '祖先id序列，如 /1/5/9/',
+            UNIQUE KEY uk_path_hash (path_hash),
+            KEY idx_lineage (lineage),
+            KEY idx_parent_id (parent_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """)
+
+    def resolve(self, parts: List[str]) -> Optional[int]:
+        """返回路径对应的id，不存在时逐层创建"""
+        if not parts:
+            return None
+
+        key = tuple(parts)
+        cached = self.cache.get(key)
+        if cached:
+            return cached[0]
+
+        parent_id, lineage = None, '/'
+        for depth in range(1, len(key) + 1):
+            prefix = key[:depth]
+            if prefix in self.cache:
+                parent_id, lineage = self.cache[prefix]
+                continue
+
+            # 已存在时通过LAST_INSERT_ID拿到原来的id
+            self.cursor.execute("""
+            INSERT INTO paths (parent_id, depth, name, full_path, path_hash) VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+            """, (parent_id, depth, prefix[-1][:255], '->'.join(prefix), path_hash(list(prefix))))
+            path_id = self.cursor.lastrowid
+            lineage = f"{lineage}{path_id}/"
+            self.cursor.execute("UPDATE paths SET lineage = %s WHERE id = %s", (lineage, path_id))
+            self.cache[prefix] = (path_id, lineage)
+            parent_id = path_id
+
+        # 维表单独提交，不跟随数据批次回滚，保证缓存里的id一定存在
+        self.db.commit()
+        return parent_id
+
+    def lineage_of(self, parts: List[str]) -> Optional[str]:
+        """查询路径的lineage"""
+        self.cursor.execute("SELECT lineage FROM paths WHERE path_hash = %s", (path_hash(parts),))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+
+class ExportCheckpoint:
+    """导出进度：记录某个Redis列表已经导出到的下标和本次运行的run_id"""
+
+    def __init__(self, redis_key: str):
+        self.redis_key = redis_key
+        self.run_id = uuid.uuid4().hex
+        self.offset = 0
+        self.last_run_id = None
+
+    def create_table(self, cursor):
+        """创建进度表"""
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS export_checkpoint (
+            redis_key VARCHAR(191) PRIMARY KEY COMMENT 'Redis列表的key',
+            last_offset BIGINT NOT NULL DEFAULT 0 COMMENT '已导出到的下标（不含）',
+            run_id CHAR(32) COMMENT '最后一次写入进度的运行id',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """)
+
+    def load(self, cursor) -> int:
+        """读取上次的进度"""
+        cursor.execute("SELECT last_offset, run_id FROM export_checkpoint WHERE redis_key = %s", (self.redis_key,))
+        row = cursor.fetchone()
+        if row:
+            self.offset, self.last_run_id = int(row[0]), row[1]
+        return self.offset
+
+    def save(self, cursor, offset: int):
+        """写入进度（不提交，由调用方和数据放在同一个事务里提交）"""
+        cursor.execute("""
+        INSERT INTO export_checkpoint (redis_key, last_offset, run_id) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE last_offset = VALUES(last_offset), run_id = VALUES(run_id)
+        """, (self.redis_key, offset, self.run_id))
+        self.offset = offset
+
+
 class SimpleMySQLStorage:
 
-    def __init__(self):
+    def __init__(self, local_infile: bool = False, schema: str = 'flat'):
         # Redis连接
         self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT,password=REDIS_PARAMS['password'], db=REDIS_DB, decode_responses=True)
         self.redis_key = 'questions:items'
+        # 每次LRANGE读取的条数，以及一次pipeline中打包的LRANGE数量
+        self.chunk_size = 500
+        self.pipeline_pages = 4
 
         # MySQL连接配置
         self.mysql_config = MYSQL_CONFIG
         # 创建MySQL连接
-        self.db = pymysql.connect(**self.mysql_config)
+        # --bulk模式需要客户端允许LOAD DATA LOCAL INFILE
+        self.db = pymysql.connect(**self.mysql_config, local_infile=local_infile)
         self.cursor = self.db.cursor()
+        # 导出进度
+        self.checkpoint = ExportCheckpoint(self.redis_key)
+        # 表结构：flat（path直接存文本）或 normalized（path_id关联paths维表）
+        self.schema = schema
+        self.paths = PathDictionary(self.db) if schema == 'normalized' else None
+        self.columns = NORMALIZED_COLUMNS if self.paths else INSERT_COLUMNS
 
         # 创建表
         self.create_table()
 
     def create_table(self):
         """创建数据库表"""
+        if self.paths:
+            return self.create_normalized_tables()
+
         sql = """
         CREATE TABLE IF NOT EXISTS questions (
             id INT AUTO_INCREMENT PRIMARY KEY,
@@ -39,169 +612,153 @@ class SimpleMySQLStorage:
             options TEXT COMMENT '选项，JSON格式',
             answer VARCHAR(50) COMMENT '答案',
             analysis TEXT COMMENT '答案解析（保留img标签）',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            content_hash CHAR(40) COMMENT '内容哈希：SHA1(path, content, options)',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uk_content_hash (content_hash)
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
         """
 
         try:
             self.cursor.execute(sql)
+            self.checkpoint.create_table(self.cursor)
             self.db.commit()
             print("✅ 表创建成功")
         except Exception as e:
             print(f"❌ 创建表失败: {e}")
             self.db.rollback()
 
-    def clean_content(self, html: str) -> str:
-        """清理题目内容：去掉HTML标签但保留img标签"""
-        if not html:
-            return ""
-
-        # 去掉<p>标签，但保留内容
-        html = html.replace('<p>', '').replace('</p>', '')
-
-        # 去掉除了img之外的所有HTML标签
-        # 这个方法保留img标签及其属性
-        result = ''
-        i = 0
-        while i < len(html):
-            if html[i] == '<':
-                # 检查是否是img标签
-                if html[i:i + 4].lower() == '<img':
-                    # 保留完整的img标签
-                    end = html.find('>', i)
-                    if end != -1:
-                        result += html[i:end + 1]
-                        i = end + 1
-                    else:
-                        i += 1
-                else:
-                    # 跳过其他标签
-                    end = html.find('>', i)
-                    if end != -1:
-                        i = end + 1
-                    else:
-                        i += 1
-            else:
-                result += html[i]
-                i += 1
+        self.migrate_content_hash()
+        self.repair_keys()
 
-        # 清理多余的空格
-        result = re.sub(r'\s+', ' ', result).strip()
+    def create_normalized_tables(self):
+        """normalized模式：paths维表 + 通过path_id关联的questions表"""
+        sql = """
+        CREATE TABLE IF NOT EXISTS questions (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            path_id INT COMMENT '路径id，关联paths.id',
+            content TEXT COMMENT '题目内容（保留img标签）',
+            options TEXT COMMENT '选项，JSON格式',
+            answer VARCHAR(50) COMMENT '答案',
+            analysis TEXT COMMENT '答案解析（保留img标签）',
+            content_hash CHAR(40) COMMENT '内容哈希：SHA1(path, content, options)',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uk_content_hash (content_hash),
+            KEY idx_path_id (path_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """
 
-        return result
+        try:
+            self.paths.create_table()
+            self.cursor.execute(sql)
+            self.checkpoint.create_table(self.cursor)
+            self.db.commit()
+            print("✅ 表创建成功（normalized）")
+        except Exception as e:
+            print(f"❌ 创建表失败: {e}")
+            self.db.rollback()
 
-    def extract_answer(self, analysis: str) -> str:
-        """从解析中提取答案"""
-        if not analysis:
-            return ""
-
-        # 找<p>前面的字母或数字
-        # 比如 "B<p>..." 或 "1<p>..."
-        match = re.match(r'^([A-Z0-9]+)<p>', analysis)
-        if match:
-            answer = match.group(1)
-            # 如果是数字，处理判断题
-            if answer.isdigit():
-                if answer == '1':
-                    return '正确'
-                elif answer == '0':
-                    return '错误'
-            return answer
-
-        # 如果没有<p>标签，直接取开头的字母或数字
-        match = re.match(r'^([A-Z0-9]+)', analysis)
-        if match:
-            answer = match.group(1)
-            if answer.isdigit():
-                if answer == '1':
-                    return '正确'
-                elif answer == '0':
-                    return '错误'
-            return answer
+        self.migrate_content_hash()
+        self.migrate_path_id()
+        self.repair_keys()
 
-        return ""
+    def repair_keys(self):
+        """补上缺失的content_hash唯一索引和path_id索引
 
-    def clean_analysis(self, analysis: str) -> str:
-        """清理答案解析：保留img标签"""
-        if not analysis:
-            return ""
-
-        # 去掉开头的答案部分
-        # 比如 "B<p>内容..." 变成 "内容..."
-        analysis = re.sub(r'^[A-Z0-9]+<p>', '', analysis)
-
-        # 去掉<p>标签，但保留内容
-        analysis = analysis.replace('<p>', '').replace('</p>', '')
-
-        # 保留img标签（和方法clean_content一样）
-        result = ''
-        i = 0
-        while i < len(analysis):
-            if analysis[i] == '<':
-                # 检查是否是img标签
-                if analysis[i:i + 4].lower() == '<img':
-                    # 保留完整的img标签
-                    end = analysis.find('>', i)
-                    if end != -1:
-                        result += analysis[i:end + 1]
-                        i = end + 1
-                    else:
-                        i += 1
-                else:
-                    # 跳过其他标签
-                    end = analysis.find('>', i)
-                    if end != -1:
-                        i = end + 1
-                    else:
-                        i += 1
-            else:
-                result += analysis[i]
-                i += 1
+        --disable-keys导入中途崩溃、或旧表有重复行没能建唯一索引时，表上会缺少索引，
+        这时按restore_keys的方式先删除重复行（保留最后导入的一行）再建索引
+        """
+        try:
+            restore_keys(self.db, self.cursor, self.columns)
+        except Exception as e:
+            print(f"❌ 重建索引失败: {e}")
+            self.db.rollback()
 
-        result = result.strip()
+    def migrate_path_id(self):
+        """flat模式创建的questions表：加上path_id列和索引，并按已有的path文本回填
 
-        return result
+        列已存在但索引被删除（--disable-keys导入中途崩溃）时，由repair_keys补上索引
+        """
+        self.cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'questions' AND COLUMN_NAME = 'path_id'
+        """)
+        if self.cursor.fetchone()[0]:
+            return
 
-    def process_single(self, item: Dict) -> Dict:
-        """处理单个数据"""
-        result = {}
+        print("🔧 questions表缺少path_id列，开始迁移...")
+        try:
+            self.cursor.execute("ALTER TABLE questions ADD COLUMN path_id INT COMMENT '路径id，关联paths.id', "
+                                "ADD KEY idx_path_id (path_id)")
+            self.db.commit()
 
-        # 1. 处理path：用->连接
-        path_list = item.get('path', [])
-        result['path'] = '->'.join(path_list) if path_list else ''
+            self.cursor.execute("SELECT DISTINCT path FROM questions WHERE path_id IS NULL AND path <> ''")
+            legacy_paths = [row[0] for row in self.cursor.fetchall()]
+            for path in legacy_paths:
+                path_id = self.paths.resolve(path.split('->'))
+                self.cursor.execute("UPDATE questions SET path_id = %s WHERE path_id IS NULL AND path = %s",
+                                    (path_id, path))
+                self.db.commit()
+            print(f"✅ path_id迁移完成，回填了 {len(legacy_paths)} 个路径")
+        except Exception as e:
+            print(f"❌ path_id迁移失败: {e}")
+            self.db.rollback()
+
+    def find_under(self, prefix: str, limit: int = 20) -> Tuple[int, List[Tuple]]:
+        """查询某个路径前缀（如 税务师->税法二）下的题目数量和前limit道题，只能在normalized模式下使用"""
+        lineage = self.paths.lineage_of(prefix.split('->'))
+        if not lineage:
+            return 0, []
+
+        # lineage前缀匹配走idx_lineage，再按idx_path_id关联questions
+        self.cursor.execute("""
+        SELECT COUNT(*) FROM paths p JOIN questions q ON q.path_id = p.id WHERE p.lineage LIKE %s
+        """, (lineage + '%',))
+        count = self.cursor.fetchone()[0]
+        self.cursor.execute("""
+        SELECT q.id, p.full_path, q.content FROM paths p JOIN questions q ON q.path_id = p.id
+        WHERE p.lineage LIKE %s ORDER BY q.id LIMIT %s
+        """, (lineage + '%', limit))
+        return count, list(self.cursor.fetchall())
 
-        # 2. 处理content：去掉HTML标签但保留img
-        content = item.get('content', '')
-        result['content'] = self.clean_content(content)
+    def migrate_content_hash(self):
+        """旧版本创建的questions表没有content_hash列，补上列并回填哈希，唯一索引由repair_keys创建"""
+        self.cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'questions' AND COLUMN_NAME = 'content_hash'
+        """)
+        if self.cursor.fetchone()[0]:
+            return
 
-        # 3. 处理options：原样保存（JSON格式）
-        options = item.get('options', [])
-        result['options'] = json.dumps(options, ensure_ascii=False) if options else '[]'
+        print("🔧 questions表缺少content_hash列，开始迁移...")
+        try:
+            self.cursor.execute("ALTER TABLE questions ADD COLUMN content_hash CHAR(40) COMMENT '内容哈希：SHA1(path, content, options)'")
+            self.cursor.execute("UPDATE questions SET content_hash = SHA1(CONCAT_WS(CHAR(31), path, content, options))")
+            self.db.commit()
+            print("✅ content_hash迁移完成")
+        except Exception as e:
+            print(f"❌ 添加content_hash列失败: {e}")
+            self.db.rollback()
 
-        # 4. 处理textAnalysis
-        analysis = item.get('textAnalysis', '')
-        # 提取答案
-        result['answer'] = self.extract_answer(analysis)
-        # 清理解析（保留img）
-        result['analysis'] = self.clean_analysis(analysis)
+    def clean_content(self, html: str) -> str:
+        """清理题目内容：去掉HTML标签但保留img标签"""
+        return html_sanitizer.clean_content(html)
 
-        return result
+    def extract_answer(self, analysis: str) -> str:
+        """从解析中提取答案"""
+        return extract_answer(analysis)
+
+    def clean_analysis(self, analysis: str) -> str:
+        """清理答案解析：保留img标签"""
+        return html_sanitizer.clean_analysis(analysis)
+
+    def process_single(self, item: Dict) -> Dict:
+        """处理单个数据"""
+        return process_item(item)
 
     def save_to_mysql(self, data: Dict):
         """保存到MySQL"""
-        sql = """
-        INSERT INTO questions (path, content, options, answer, analysis)
-        VALUES (%s, %s, %s, %s, %s)
-        """
-
         try:
-            self.cursor.execute(sql, (
-                data['path'],
-                data['content'],
-                data['options'],
-                data['answer'],
-                data['analysis']
-            ))
+            self.cursor.execute(UPSERT_SQL, tuple(data[col] for col in INSERT_COLUMNS))
             self.db.commit()
             return True
         except Exception as e:
@@ -209,56 +766,181 @@ class SimpleMySQLStorage:
             self.db.rollback()
             return False
 
-    def process_all(self, limit=None):
+    def iter_items(self, start: int = 0, limit: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+        """分页流式读取Redis列表，返回(下标, 原始JSON)"""
+        return iter_redis_items(self.redis, self.redis_key, start=start, limit=limit, chunk_size=self.chunk_size,
+                                pipeline_pages=self.pipeline_pages)
+
+    def read_chunks(self, out_queue: queue.Queue, start: int, limit: Optional[int], chunk_size: int):
+        """读取线程：把Redis数据按chunk_size分组放入有界队列，队列满时阻塞（背压）"""
+        try:
+            chunk = []
+            for i, item_json in self.iter_items(start=start, limit=limit):
+                chunk.append((i, item_json))
+                if len(chunk) >= chunk_size:
+                    out_queue.put(chunk)
+                    chunk = []
+            if chunk:
+                out_queue.put(chunk)
+        except Exception as e:
+            out_queue.put(e)
+        finally:
+            out_queue.put(None)
+
+    def iter_transformed(self, start: int, limit: Optional[int], workers: int, chunk_size: int,
+                         ordered: bool) -> Iterator[List[Tuple[int, str, object]]]:
+        """三段流水线：读取线程 -> worker进程池清洗 -> 调用方（写入MySQL）
+
+        各段之间都是有界的：读取队列最多workers*2批，进程池中同时最多workers*2批，
+        MySQL写得慢时调用方消费变慢，背压一直传到读取线程
+        """
+        max_pending = max(workers, 1) * 2
+        chunks: queue.Queue = queue.Queue(maxsize=max_pending)
+        reader = threading.Thread(target=self.read_chunks, args=(chunks, start, limit, chunk_size), daemon=True)
+        reader.start()
+
+        def next_chunk():
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            return chunk
+
+        # workers为0时在当前进程中清洗
+        if workers <= 0:
+            while (chunk := next_chunk()) is not None:
+                yield transform_chunk(chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            exhausted = False
+            while True:
+                # 补满进程池的在途任务
+                while not exhausted and len(pending) < max_pending:
+                    chunk = next_chunk()
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    pending.append(pool.submit(transform_chunk, chunk))
+
+                if not pending:
+                    break
+
+                if ordered:
+                    # 按提交顺序取结果，保持输入顺序
+                    yield pending.popleft().result()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield future.result()
+
+    def resume_offset(self, resume: bool, list_len: int) -> int:
+        """确定本次从哪个下标开始导出"""
+        if not resume:
+            print(f"🆕 忽略导出进度，从头开始（run_id: {self.checkpoint.run_id}）")
+            self.checkpoint.offset = 0
+            return 0
+
+        offset = self.checkpoint.load(self.cursor)
+        if offset > list_len:
+            # Redis列表被清空重建过，旧的下标已经没有意义
+            print(f"⚠️ 上次导出到第{offset}条，但Redis中只有{list_len}条，从头开始")
+            self.checkpoint.offset = 0
+            return 0
+
+        if offset:
+            print(f"⏩ 从上次的进度继续：第{offset}条（上次run_id: {self.checkpoint.last_run_id}，本次run_id: {self.checkpoint.run_id}）")
+        return offset
+
+    def local_infile_enabled(self) -> bool:
+        """服务端是否允许LOAD DATA LOCAL INFILE"""
+        try:
+            self.cursor.execute("SHOW VARIABLES LIKE 'local_infile'")
+            row = self.cursor.fetchone()
+            return bool(row) and str(row[1]).upper() in ('ON', '1')
+        except Exception as e:
+            print(f"⚠️ 无法查询local_infile: {e}")
+            return False
+
+    def process_all(self, limit=None, batch_size=500, flush_interval=5.0, workers=0, worker_chunk_size=200,
+                    ordered=True, resume=True, bulk=False, bulk_rows=100000, spool_dir=None, disable_keys=False):
         """处理所有数据"""
         print("🚀 开始处理数据...")
 
         # 获取数据总数
-        total = self.redis.llen(self.redis_key)
-        print(f"📊 Redis中共有 {total} 条数据")
+        list_len = self.redis.llen(self.redis_key)
+        print(f"📊 Redis中共有 {list_len} 条数据")
 
+        start = self.resume_offset(resume, list_len)
+        total = list_len - start
         if limit:
             total = min(total, limit)
 
-        success_count = 0
-        fail_count = 0
-        discard_count = 0
+        if workers > 0:
+            print(f"⚙️ 使用 {workers} 个worker进程清洗数据，{'保持' if ordered else '不保持'}输入顺序")
 
-        for i in range(total):
-            try:
-                # 读取数据
-                item_json = self.redis.lindex(self.redis_key, i)
-                if not item_json:
-                    continue
+        if bulk and not self.local_infile_enabled():
+            print("⚠️ MySQL服务端未开启local_infile，--bulk改为批量INSERT")
+            bulk = False
 
-                item = json.loads(item_json)
-
-                # 跳过无效数据（没有content或textAnalysis）
-                if not item.get('content') or not item.get('textAnalysis'):
-                    discard_count += 1
-                    continue
+        if bulk:
+            print(f"🚚 使用LOAD DATA批量导入，每 {bulk_rows} 行导入一次")
+            writer = BulkLoader(self.db, batch_size=bulk_rows, checkpoint=self.checkpoint, spool_dir=spool_dir,
+                                disable_keys=disable_keys, columns=self.columns)
+        else:
+            writer = BatchWriter(self.db, batch_size=batch_size, flush_interval=flush_interval,
+                                 checkpoint=self.checkpoint, columns=self.columns)
+        try:
+            self.export_items(writer, start, total, workers, worker_chunk_size, ordered)
+        except LocalInfileDisabled as e:
+            writer.abort()
+            print(f"⚠️ LOAD DATA LOCAL INFILE被拒绝（{e}），改为批量INSERT重新导出")
+            return self.process_all(limit=limit, batch_size=batch_size, flush_interval=flush_interval,
+                                    workers=workers, worker_chunk_size=worker_chunk_size, ordered=ordered,
+                                    resume=resume)
 
-                # 处理数据
-                cleaned_data = self.process_single(item)
+    def export_items(self, writer: BatchWriter, start: int, total: int, workers: int, worker_chunk_size: int,
+                     ordered: bool):
+        """读取、清洗并写入[start, start + total)范围内的数据"""
+        fail_count = 0
+        discard_count = 0
+        processed = 0
+        start_time = time.time()
 
-                # 保存到MySQL
-                if self.save_to_mysql(cleaned_data):
-                    success_count += 1
-                else:
+        for results in self.iter_transformed(start, total, workers, worker_chunk_size, ordered):
+            for i, status, data in results:
+                processed += 1
+                if status == 'ok':
+                    if self.paths:
+                        data['path_id'] = self.paths.resolve(data['path_list'])
+                    # 加入批量写入缓冲区
+                    writer.add(data)
+                elif status == 'discard':
+                    discard_count += 1
+                elif status == 'error':
+                    print(f"❌ 处理第{i}条数据失败: {data}")
                     fail_count += 1
 
                 # 显示进度
-                if (i + 1) % 100 == 0:
-                    print(f"🔄 已处理 {i + 1}/{total} 条，成功: {success_count}，失败: {fail_count},过滤: {discard_count}")
+                if processed % 100 == 0:
+                    speed = processed / max(time.time() - start_time, 1e-6)
+                    print(f"🔄 已处理 {processed}/{total} 条，成功: {writer.success}，失败: {fail_count + writer.failed},过滤: {discard_count}，速度: {speed:.1f} 条/秒")
+
+            # 整批数据都已交给writer，推进水位线
+            writer.mark_done(results[0][0], results[-1][0] + 1)
 
-            except Exception as e:
-                print(f"❌ 处理第{i}条数据失败: {e}")
-                fail_count += 1
+        writer.close()
 
+        elapsed = time.time() - start_time
         print("=" * 50)
         print(f"🎉 处理完成！")
-        print(f"✅ 成功: {success_count} 条")
-        print(f"❌ 失败: {fail_count} 条")
+        print(f"✅ 成功: {writer.success} 条")
+        print(f"❌ 失败: {fail_count + writer.failed} 条")
+        print(f"🗑️ 过滤: {discard_count} 条")
+        print(f"⏱️ 耗时: {elapsed:.1f} 秒，平均 {processed / max(elapsed, 1e-6):.1f} 条/秒")
+        print(f"📍 导出进度: 第{self.checkpoint.offset}条")
+        print(f"💾 写入: {writer.batches} 批，{writer.success / max(elapsed, 1e-6):.1f} 行/秒（纯写入耗时 {writer.write_seconds:.1f} 秒）")
 
     def close(self):
         """关闭连接"""
@@ -306,12 +988,44 @@ if __name__ == '__main__':
     #
     # print("\n" + "=" * 50 + "\n")
 
+    parser = argparse.ArgumentParser(description='把Redis中的题目导出到MySQL')
+    parser.add_argument('--limit', type=int, default=None, help='处理多少条，默认全部')
+    parser.add_argument('--chunk-size', type=int, default=500, help='每次LRANGE读取的条数')
+    parser.add_argument('--pipeline-pages', type=int, default=4, help='一次pipeline打包的LRANGE数量')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批写入MySQL的行数（一个事务）')
+    parser.add_argument('--flush-interval', type=float, default=5.0, help='缓冲区最长多少秒写入一次')
+    parser.add_argument('--workers', type=int, default=0, help='清洗数据的worker进程数，0表示在主进程中清洗')
+    parser.add_argument('--worker-chunk-size', type=int, default=200, help='每次交给worker进程的条数')
+    parser.add_argument('--unordered', action='store_true', help='不保持输入顺序，先清洗完的先写入')
+    parser.add_argument('--from-start', action='store_true', help='忽略上次的导出进度，从第0条开始（已有数据会被更新而不是重复插入）')
+    parser.add_argument('--bulk', action='store_true', help='用LOAD DATA LOCAL INFILE批量导入（适合全量重建），服务端不允许时自动改为批量INSERT')
+    parser.add_argument('--bulk-rows', type=int, default=100000, help='--bulk模式下每个TSV文件的行数（一次LOAD一个事务）')
+    parser.add_argument('--spool-dir', default=None, help='--bulk模式下临时TSV文件的目录，默认系统临时目录')
+    parser.add_argument('--disable-keys', action='store_true', help='--bulk模式下导入期间删除content_hash唯一索引和path_id索引，导入完成后去重并重建')
+    parser.add_argument('--schema', choices=['flat', 'normalized'], default='flat',
+                        help='flat：path以文本存在questions中；normalized：path存到paths维表，questions通过path_id关联')
+    parser.add_argument('--query', default=None, help='只查询某个路径前缀下的题目（如 "税务师->税法二"），需要--schema normalized')
+    args = parser.parse_args()
+
     # 运行实际处理
-    processor = SimpleMySQLStorage()
+    processor = SimpleMySQLStorage(local_infile=args.bulk, schema=args.schema)
+    processor.chunk_size = args.chunk_size
+    processor.pipeline_pages = args.pipeline_pages
+
+    if args.query:
+        if not processor.paths:
+            parser.error('--query 需要 --schema normalized')
+        count, rows = processor.find_under(args.query)
+        print(f"🔍 {args.query} 下共有 {count} 道题")
+        for question_id, full_path, content in rows:
+            print(f"  [{question_id}] {full_path}: {content[:60]}")
+        processor.close()
+        sys.exit(0)
 
-    # 处理数据（参数：处理多少条，None表示全部）
-    # processor.process_all(limit=1000)  # 先测试1000条
-    # 全部
-    processor.process_all(limit=None)  # 存储全部
+    # 处理数据（--limit 1000 先测试1000条，不传表示全部）
+    processor.process_all(limit=args.limit, batch_size=args.batch_size, flush_interval=args.flush_interval,
+                          workers=args.workers, worker_chunk_size=args.worker_chunk_size, ordered=not args.unordered,
+                          resume=not args.from_start, bulk=args.bulk, bulk_rows=args.bulk_rows,
+                          spool_dir=args.spool_dir, disable_keys=args.disable_keys)
     # 关闭连接
     processor.close()
\ No newline at end of file
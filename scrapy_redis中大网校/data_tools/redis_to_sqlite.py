@@ -0,0 +1,475 @@
+"""
+把Redis中的题目导出到本地SQLite数据库，并建立FTS5全文索引
+
+和 redis_to_mysql.py、redis_to_md.py 并列的第三个导出工具，不需要MySQL服务，
+一个文件就能离线查题：
+    questions      题目表，路径的每一级单独一列（level1 ~ level5），方便按考试/科目/章节筛选
+    questions_fts  FTS5索引（trigram分词，中文按任意3个字的子串匹配），覆盖清洗后的题目、选项和解析
+    export_checkpoint 导出进度，再次运行时只导出Redis列表中新增的部分；merge_seq是已经处理过的指纹库合并序号
+
+先运行 dedup_questions.py 再加 --canonical 导出时，每组重复题只保存一条（规范题目），
+paths列中是它出现过的全部路径
+
+用法：
+    python redis_to_sqlite.py build [--limit 1000] [--from-start] [--canonical]
+    python redis_to_sqlite.py query "增值税 进项税额" [--path "税务师->税法一"] [--limit 20]
+"""
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import redis
+
+from redis_to_mysql import transform_chunk, iter_redis_items
+from dedup_questions import DedupIndex
+from config import (
+    # Redis配置
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_DB,
+    REDIS_PARAMS,
+    # 检索数据库和去重指纹库
+    SEARCH_DB_FILE,
+    DEDUP_DB_FILE
+)
+
+# 路径按级别拆成的列数，更深的级别只保存在path中
+PATH_LEVELS = 5
+LEVEL_COLUMNS = tuple(f'level{i}' for i in range(1, PATH_LEVELS + 1))
+# 索引文本中不需要图片标签
+_IMG_RE = re.compile(r'<img[^>]*>', re.IGNORECASE)
+# trigram分词器从SQLite 3.34开始提供
+TRIGRAM_MIN_VERSION = (3, 34, 0)
+
+
+def search_text(text: str) -> str:
+    """写入全文索引的文本：去掉img标签"""
+    return _IMG_RE.sub(' ', text or '').strip()
+
+
+def options_text(options_json: str) -> str:
+    """选项JSON转成逐行的纯文本，避免把JSON的引号和转义写进索引"""
+    try:
+        options = json.loads(options_json or '[]')
+    except ValueError:
+        return search_text(options_json)
+    if not isinstance(options, list):
+        options = [options]
+    return '\n'.join(search_text(str(option)) for option in options)
+
+
+def match_expression(terms: List[str]) -> str:
+    """把用户输入的关键词拼成FTS5查询：每个词加双引号按短语匹配，多个词之间是AND"""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+class SQLiteSearchIndex:
+    """questions:items 的本地SQLite副本和全文索引"""
+
+    def __init__(self, db_file: str = SEARCH_DB_FILE, redis_key: str = 'questions:items'):
+        if sqlite3.sqlite_version_info < TRIGRAM_MIN_VERSION:
+            raise RuntimeError(f"SQLite {sqlite3.sqlite_version} 不支持trigram分词，需要3.34以上（升级Python即可）")
+
+        self.db_file = db_file
+        self.redis_key = redis_key
+        self.redis = None
+        # 每次LRANGE读取的条数，以及一次pipeline中打包的LRANGE数量
+        self.chunk_size = 500
+        self.pipeline_pages = 4
+
+        self.db = sqlite3.connect(db_file)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+        # 统计
+        self.stats = {'total': 0, 'inserted': 0, 'updated': 0, 'merged': 0, 'remerged': 0, 'discarded': 0, 'failed': 0}
+
+    def init_redis(self):
+        """只有导出时才需要Redis，查询时不连接"""
+        self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PARAMS['password'], db=REDIS_DB,
+                                 decode_responses=True)
+
+    def create_tables(self):
+        levels = ',\n            '.join(f'{column} TEXT' for column in LEVEL_COLUMNS)
+        self.db.executescript(f"""
+        CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            {levels},
+            depth INTEGER NOT NULL,
+            content TEXT,
+            options TEXT,
+            answer TEXT,
+            analysis TEXT,
+            content_hash TEXT NOT NULL UNIQUE,
+            canonical_id INTEGER,
+            paths TEXT,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_questions_levels ON questions ({', '.join(LEVEL_COLUMNS[:3])});
+        CREATE INDEX IF NOT EXISTS idx_questions_path ON questions (path);
+        CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+            content, options, analysis, tokenize = 'trigram'
+        );
+        CREATE TABLE IF NOT EXISTS export_checkpoint (
+            redis_key TEXT PRIMARY KEY,
+            last_offset INTEGER NOT NULL DEFAULT 0,
+            merge_seq INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        );
+        """)
+        self.migrate_columns()
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_questions_canonical ON questions (canonical_id)")
+        self.db.commit()
+
+    def migrate_columns(self):
+        """旧版本建的表没有canonical_id、paths和merge_seq列"""
+        checkpoint_columns = {row[1] for row in self.db.execute("PRAGMA table_info(export_checkpoint)")}
+        if 'merge_seq' not in checkpoint_columns:
+            self.db.execute("ALTER TABLE export_checkpoint ADD COLUMN merge_seq INTEGER NOT NULL DEFAULT 0")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(questions)")}
+        if 'canonical_id' not in columns:
+            print("🔧 questions表增加canonical_id列")
+            self.db.execute("ALTER TABLE questions ADD COLUMN canonical_id INTEGER")
+        if 'paths' not in columns:
+            print("🔧 questions表增加paths列")
+            self.db.execute("ALTER TABLE questions ADD COLUMN paths TEXT")
+            self.db.execute("UPDATE questions SET paths = json_array(path)")
+
+    def load_offset(self) -> int:
+        row = self.db.execute("SELECT last_offset FROM export_checkpoint WHERE redis_key = ?",
+                              (self.redis_key,)).fetchone()
+        return row[0] if row else 0
+
+    def save_offset(self, offset: int):
+        """写入进度（不提交，和同一批数据一起提交）"""
+        self.db.execute("""
+        INSERT INTO export_checkpoint (redis_key, last_offset, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(redis_key) DO UPDATE SET last_offset = excluded.last_offset, updated_at = excluded.updated_at
+        """, (self.redis_key, offset, time.time()))
+
+    def load_merge_seq(self) -> int:
+        row = self.db.execute("SELECT merge_seq FROM export_checkpoint WHERE redis_key = ?",
+                              (self.redis_key,)).fetchone()
+        return row[0] if row else 0
+
+    def save_merge_seq(self, seq: int):
+        """记录已经处理到的指纹库合并序号（不提交）"""
+        self.db.execute("""
+        INSERT INTO export_checkpoint (redis_key, merge_seq, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(redis_key) DO UPDATE SET merge_seq = excluded.merge_seq, updated_at = excluded.updated_at
+        """, (self.redis_key, seq, time.time()))
+
+    def iter_items(self, start: int = 0, limit: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+        return iter_redis_items(self.redis, self.redis_key, start=start, limit=limit, chunk_size=self.chunk_size,
+                                pipeline_pages=self.pipeline_pages)
+
+    def row_of(self, data: Dict) -> Tuple:
+        path_list = data['path_list']
+        levels = [path_list[i] if i < len(path_list) else None for i in range(PATH_LEVELS)]
+        return (data['path'], *levels, len(path_list), data['content'], data['options'], data['answer'],
+                data['analysis'], data['content_hash'], data.get('canonical_id'),
+                json.dumps([data['path']], ensure_ascii=False), time.time())
+
+    def write_batch(self, batch: List[Dict], offset: int, canonical: Optional[Dict[int, int]] = None):
+        """一批题目和导出进度在同一个事务中提交
+
+        canonical是 {Redis下标: 规范id}：规范题目正常写入，其余的重复题只把路径合并到规范题目的paths中
+        """
+        if canonical is None:
+            self.upsert(batch)
+        else:
+            primary = []
+            members = defaultdict(list)
+            for data in batch:
+                # 还没有计算过指纹的题目自己就是规范题目
+                data['canonical_id'] = canonical.get(data['index'], data['index'])
+                if data['canonical_id'] == data['index']:
+                    primary.append(data)
+                else:
+                    members[data['canonical_id']].append(data)
+            self.upsert(primary)
+
+            rows = self.canonical_rows(list(members))
+            # 规范题目不在库中（处理失败，或者之前导出时没有加--canonical）时，由第一道重复题代替
+            missing = [group.pop(0) for canonical_id, group in members.items() if canonical_id not in rows]
+            if missing:
+                self.upsert(missing)
+                rows.update(self.canonical_rows([data['canonical_id'] for data in missing]))
+            self.merge_paths(rows, members)
+
+        self.save_offset(offset)
+        self.db.commit()
+
+    def upsert(self, batch: List[Dict]):
+        """写入题目（不提交）
+
+        同一路径下的同一道题（content_hash相同）只保存一行，再次导出时更新答案和解析，
+        全文索引中对应的行先删后插
+        """
+        if not batch:
+            return
+        hashes = list({data['content_hash']: None for data in batch})
+        placeholders = ','.join('?' * len(hashes))
+        existing = {row[0] for row in self.db.execute(
+            f"SELECT content_hash FROM questions WHERE content_hash IN ({placeholders})", hashes)}
+
+        columns = ('path',) + LEVEL_COLUMNS + ('depth', 'content', 'options', 'answer', 'analysis', 'content_hash',
+                                               'canonical_id', 'paths', 'updated_at')
+        self.db.executemany(f"""
+        INSERT INTO questions ({', '.join(columns)}) VALUES ({','.join('?' * len(columns))})
+        ON CONFLICT(content_hash) DO UPDATE SET answer = excluded.answer, analysis = excluded.analysis,
+            canonical_id = COALESCE(excluded.canonical_id, canonical_id), updated_at = excluded.updated_at
+        """, [self.row_of(data) for data in batch])
+
+        ids = dict(self.db.execute(f"SELECT content_hash, id FROM questions WHERE content_hash IN ({placeholders})",
+                                   hashes))
+        latest = {data['content_hash']: data for data in batch}
+        self.db.executemany("DELETE FROM questions_fts WHERE rowid = ?", [(ids[h],) for h in hashes if h in existing])
+        self.db.executemany("INSERT INTO questions_fts (rowid, content, options, analysis) VALUES (?, ?, ?, ?)", [
+            (ids[h], search_text(latest[h]['content']), options_text(latest[h]['options']),
+             search_text(latest[h]['analysis']))
+            for h in hashes
+        ])
+
+        self.stats['inserted'] += len(hashes) - len(existing)
+        self.stats['updated'] += len(existing)
+
+    def canonical_rows(self, canonical_ids: List[int]) -> Dict[int, Tuple[int, str]]:
+        """{规范id: (行id, paths)}"""
+        if not canonical_ids:
+            return {}
+        # 按id倒序，同一个规范id有多行时保留最早的一行
+        return {canonical_id: (row_id, paths) for canonical_id, row_id, paths in self.db.execute(f"""
+        SELECT canonical_id, id, paths FROM questions WHERE canonical_id IN ({','.join('?' * len(canonical_ids))})
+        ORDER BY id DESC
+        """, canonical_ids)}
+
+    def merge_paths(self, rows: Dict[int, Tuple[int, str]], members: Dict[int, List[Dict]]):
+        """把重复题的路径合并到规范题目的paths中"""
+        updates = []
+        for canonical_id, group in members.items():
+            row_id, paths = rows[canonical_id]
+            paths = json.loads(paths or '[]')
+            new_paths = [data['path'] for data in group if data['path'] not in paths]
+            paths += list(dict.fromkeys(new_paths))
+            updates.append((json.dumps(paths, ensure_ascii=False), time.time(), row_id))
+            self.stats['merged'] += len(group)
+        self.db.executemany("UPDATE questions SET paths = ?, updated_at = ? WHERE id = ?", updates)
+
+    def reconcile_canonical(self, dedup: DedupIndex) -> int:
+        """按指纹库当前的并查集重新确定已导出行的规范id
+
+        一组题导出后又被合并进另一组时，旧的规范行还留着自己的canonical_id；这里把同一个新规范id下的行
+        合并成一行（优先保留canonical_id已经是新规范id的行），路径并入保留的行，其余行删除。返回删除的行数
+
+        只处理上次之后被合并的簇（指纹库merges表的seq）和它们现在的根，不需要扫描整个questions表
+        """
+        clusters, seq = dedup.merges_since(self.load_merge_seq())
+        roots = dedup.canonical_of(clusters)
+        affected = list(set(clusters) | set(roots.values()))
+        rows = []
+        for i in range(0, len(affected), 500):
+            chunk = affected[i:i + 500]
+            rows += self.db.execute(f"""
+            SELECT id, canonical_id FROM questions WHERE canonical_id IN ({','.join('?' * len(chunk))})
+            """, chunk).fetchall()
+        rows.sort()
+
+        groups = defaultdict(list)
+        for row_id, canonical_id in rows:
+            groups[roots.get(canonical_id, canonical_id)].append((row_id, canonical_id))
+
+        removed = 0
+        for root, group in groups.items():
+            if len(group) == 1 and group[0][1] == root:
+                continue
+            keep = next((row for row in group if row[1] == root), group[0])
+            stale = [row_id for row_id, _ in group if row_id != keep[0]]
+            paths = json.loads(self.db.execute("SELECT paths FROM questions WHERE id = ?", (keep[0],)).fetchone()[0] or '[]')
+            for row_id in stale:
+                row_paths = self.db.execute("SELECT paths FROM questions WHERE id = ?", (row_id,)).fetchone()[0]
+                paths += [path for path in json.loads(row_paths or '[]') if path not in paths]
+
+            self.db.execute("UPDATE questions SET canonical_id = ?, paths = ?, updated_at = ? WHERE id = ?",
+                            (root, json.dumps(paths, ensure_ascii=False), time.time(), keep[0]))
+            self.db.executemany("DELETE FROM questions WHERE id = ?", [(row_id,) for row_id in stale])
+            self.db.executemany("DELETE FROM questions_fts WHERE rowid = ?", [(row_id,) for row_id in stale])
+            removed += len(stale)
+        self.save_merge_seq(seq)
+        self.db.commit()
+        return removed
+
+    def build(self, limit: Optional[int] = None, resume: bool = True, batch_size: int = 500, canonical: bool = False,
+              dedup_db: str = DEDUP_DB_FILE):
+        """从Redis导出到SQLite，默认从上次的进度继续；canonical为True时按dedup_questions.py的结果合并重复题"""
+        print("🚀 开始导出到SQLite...")
+        self.init_redis()
+        list_len = self.redis.llen(self.redis_key)
+        print(f"📊 Redis中共有 {list_len} 条数据")
+
+        start = self.load_offset() if resume else 0
+        if start > list_len:
+            # Redis列表被清空重建过，旧的下标已经没有意义
+            print(f"⚠️ 上次导出到第{start}条，但Redis中只有{list_len}条，从头开始")
+            start = 0
+        elif start:
+            print(f"⏩ 从上次的进度继续：第{start}条")
+
+        dedup = None
+        if canonical:
+            dedup = DedupIndex(dedup_db, redis_key=self.redis_key)
+            dedup_offset = dedup.load_offset()
+            print(f"🧬 按规范id合并重复题（指纹库: {dedup_db}）")
+            if dedup_offset < list_len:
+                print(f"⚠️ 指纹库只处理到第{dedup_offset}条，之后的题目不会合并，可以先运行 dedup_questions.py")
+
+        def flush(batch: List[Dict]):
+            mapping = dedup.canonical_of([data['index'] for data in batch]) if dedup else None
+            self.write_batch(batch, offset, mapping)
+
+        begin = time.time()
+        batch = []
+        offset = start
+        for index, item_json in self.iter_items(start, limit):
+            self.stats['total'] += 1
+            offset = index + 1
+            # 和MySQL导出用同一个清洗函数，没有content或textAnalysis的题目同样过滤掉
+            (_, status, data), = transform_chunk([(index, item_json)])
+            if status == 'ok':
+                data['index'] = index
+                batch.append(data)
+            elif status == 'discard':
+                self.stats['discarded'] += 1
+            elif status == 'error':
+                print(f"❌ 第{index}条处理失败: {data}")
+                self.stats['failed'] += 1
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+                print(f"📈 进度: {offset}/{list_len}")
+
+        if batch:
+            flush(batch)
+        elif offset != start:
+            # 最后一批全部被过滤或处理失败时也记录进度
+            self.save_offset(offset)
+            self.db.commit()
+        if dedup:
+            self.stats['remerged'] = self.reconcile_canonical(dedup)
+            dedup.close()
+
+        elapsed = time.time() - begin
+        print(f"\n🎉 导出完成！用时 {elapsed:.1f}秒")
+        print(f"   📊 读取: {self.stats['total']} 条")
+        print(f"   🆕 新增: {self.stats['inserted']} 条")
+        print(f"   🔄 更新: {self.stats['updated']} 条")
+        if canonical:
+            print(f"   🧬 合并到规范题目: {self.stats['merged']} 条")
+            if self.stats['remerged']:
+                print(f"   🧬 并入新规范题目的旧规范行: {self.stats['remerged']} 条")
+        print(f"   🗑️ 过滤: {self.stats['discarded']} 条（没有题目内容或解析）")
+        print(f"   ❌ 失败: {self.stats['failed']} 条")
+        print(f"   💾 数据库: {self.db_file}")
+
+    def optimize(self):
+        """合并FTS5的索引段，大批量导入后查询更快"""
+        self.db.execute("INSERT INTO questions_fts (questions_fts) VALUES ('optimize')")
+        self.db.commit()
+
+    def search(self, keywords: str, path_prefix: Optional[str] = None, limit: int = 20) -> List[Tuple]:
+        """全文检索，返回 (id, path, 片段, 答案, paths)，按相关度排序
+
+        trigram分词只能索引3个字及以上的词，更短的词改为在索引表上做LIKE过滤
+        """
+        terms = keywords.split()
+        long_terms = [term for term in terms if len(term) >= 3]
+        short_terms = [term for term in terms if len(term) < 3]
+
+        conditions, params = [], []
+        if long_terms:
+            conditions.append("questions_fts MATCH ?")
+            params.append(match_expression(long_terms))
+        for term in short_terms:
+            pattern = f"%{term}%"
+            conditions.append("(f.content LIKE ? OR f.options LIKE ? OR f.analysis LIKE ?)")
+            params += [pattern] * 3
+        if path_prefix:
+            # 前缀范围查询可以走path索引
+            # paths中的其它路径（--canonical导出）用LIKE匹配
+            conditions.append("(q.path = ? OR (q.path >= ? AND q.path < ?) OR q.paths LIKE ?)")
+            params += [path_prefix, path_prefix + '->', path_prefix + '->\uffff', f'%"{path_prefix}%']
+        if not conditions:
+            return []
+
+        order = "bm25(questions_fts)" if long_terms else "q.id"
+        sql = f"""
+        SELECT q.id, q.path, snippet(questions_fts, -1, '【', '】', '…', 24), q.answer, q.paths
+        FROM questions_fts f JOIN questions q ON q.id = f.rowid
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {order}
+        LIMIT ?
+        """
+        return self.db.execute(sql, params + [limit]).fetchall()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        if self.redis:
+            self.redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把Redis中的题目导出到SQLite并建立全文索引')
+    parser.add_argument('--db', default=SEARCH_DB_FILE, help='SQLite数据库文件')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='从Redis导出（默认从上次的进度继续）')
+    build_parser.add_argument('--limit', type=int, default=None, help='处理多少条，默认全部')
+    build_parser.add_argument('--from-start', action='store_true', help='忽略上次的导出进度，从第0条开始（已有数据会被更新而不是重复插入）')
+    build_parser.add_argument('--batch-size', type=int, default=500, help='每批写入的条数（一个事务）')
+    build_parser.add_argument('--chunk-size', type=int, default=500, help='每次LRANGE读取的条数')
+    build_parser.add_argument('--optimize', action='store_true', help='导出后合并全文索引')
+    build_parser.add_argument('--canonical', action='store_true',
+                              help='每组重复题只保存一条，带上全部路径（需要先运行dedup_questions.py）')
+    build_parser.add_argument('--dedup-db', default=DEDUP_DB_FILE, help='dedup_questions.py的指纹库')
+
+    query_parser = subparsers.add_parser('query', help='全文检索')
+    query_parser.add_argument('keywords', help='关键词，多个词用空格分隔（同时包含）')
+    query_parser.add_argument('--path', default=None, help='只查某个路径前缀下的题目（如 "税务师->税法二"）')
+    query_parser.add_argument('--limit', type=int, default=20, help='最多返回多少条')
+    args = parser.parse_args()
+
+    index = SQLiteSearchIndex(args.db)
+    try:
+        if args.command == 'build':
+            index.chunk_size = args.chunk_size
+            index.build(limit=args.limit, resume=not args.from_start, batch_size=args.batch_size,
+                        canonical=args.canonical, dedup_db=args.dedup_db)
+            if args.optimize:
+                index.optimize()
+            return
+
+        begin = time.perf_counter()
+        rows = index.search(args.keywords, path_prefix=args.path, limit=args.limit)
+        elapsed = (time.perf_counter() - begin) * 1000
+        print(f"🔍 {args.keywords}：{len(rows)} 条结果（{elapsed:.1f}ms）")
+        for question_id, path, snippet, answer, paths in rows:
+            print(f"\n[{question_id}] {path}")
+            for other in json.loads(paths or '[]')[1:]:
+                print(f"  ↳ 也出现在 {other}")
+            print(f"  {snippet}")
+            if answer:
+                print(f"  ✅ 答案: {answer}")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# 测试直接导入 data_tools 下的脚本和 wangxiao_scrapy 包，和在对应目录下运行脚本时一致
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT, ROOT / 'data_tools', ROOT / 'wangxiao_scrapy'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,119 @@
+import json
+
+import fakeredis
+import pytest
+
+import dedup_questions
+from dedup_questions import DedupIndex, band_keys, minhash, normalize_text, similarity
+
+KEY = 'questions:items'
+A = '增值税一般纳税人购进'
+B = '按照买价和扣除率计算进项税额准予从销项税额中抵扣'
+C = '用于简易计税方法计税项目的不得抵扣'
+# X和Y只有B相同，相似度低于阈值；Z同时包含两者，和X、Y都是近似重复
+X, Y, Z = A + B, B + C, A + B + C
+
+
+def item(content):
+    return {'path': ['税务师', '税法一', '第二章增值税'], 'content': f'<p>{content}</p>', 'options': []}
+
+
+def signature(content):
+    return minhash(normalize_text(item(content)))
+
+
+def build(db_file, client, **kwargs):
+    index = DedupIndex(str(db_file), threshold=0.7)
+    index.redis = client
+    index.init_redis = lambda: None
+    index.build(**kwargs)
+    return index
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def push(client, *contents):
+    client.rpush(KEY, *[json.dumps(item(content), ensure_ascii=False) for content in contents])
+
+
+def test_minhash_uses_32_permutations_in_8_bands_of_4():
+    assert (dedup_questions.NUM_PERM, dedup_questions.BANDS, dedup_questions.ROWS) == (32, 8, 4)
+    sig = signature(X)
+    assert len(sig) == 32
+    keys = band_keys(sig)
+    assert len(keys) == 8 and all(len(key) == 4 * sig.itemsize for key in keys)
+    assert b''.join(keys) == sig.tobytes()
+    # 哈希参数固定，不同进程、不同运行之间的签名可以比较
+    assert signature(X) == sig and similarity(sig, sig) == 1
+
+
+def test_lsh_banding_matches_the_documented_candidate_probabilities():
+    def candidate_probability(s):
+        return 1 - (1 - s ** dedup_questions.ROWS) ** dedup_questions.BANDS
+
+    assert round(candidate_probability(0.7), 2) == 0.89
+    assert round(candidate_probability(0.8), 3) == 0.985
+
+
+def test_similarity_of_the_fixture_texts():
+    assert similarity(signature(X), signature(Y)) < 0.7
+    assert similarity(signature(X), signature(Z)) >= 0.7
+    assert similarity(signature(Y), signature(Z)) >= 0.7
+
+
+def test_exact_and_near_duplicates(tmp_path, client):
+    # 标点、空白和全角字符不影响精确指纹
+    push(client, X, Y, A + '，' + B + '　', X.replace('扣除率', '扣除比例'))
+    index = build(tmp_path / 'dedup.sqlite3', client)
+    assert index.canonical_of([0, 1, 2, 3]) == {0: 0, 1: 1, 2: 0, 3: 0}
+    assert (index.stats['exact'], index.stats['near'], index.stats['new']) == (1, 1, 2)
+    index.close()
+
+
+def test_canonical_root_is_stable_across_incremental_merges(tmp_path, client):
+    db_file = tmp_path / 'dedup.sqlite3'
+    push(client, X, Y)
+    index = build(db_file, client)
+    assert index.canonical_of([0, 1]) == {0: 0, 1: 1}
+    assert index.merges_since(0) == ([], 0)
+    index.close()
+
+    # 增量运行：Z把X和Y两个簇连起来，根是最早出现的0
+    push(client, Z)
+    index = build(db_file, client)
+    assert index.stats['total'] == 1 and index.stats['merged'] == 1
+    assert index.canonical_of([0, 1, 2]) == {0: 0, 1: 0, 2: 0}
+    clusters, seq = index.merges_since(0)
+    assert clusters == [1] and seq == 1
+    index.close()
+
+    # 并查集持久化在merges表中：重新打开后，Y的重复题直接归到根0下
+    push(client, Y)
+    index = build(db_file, client)
+    assert index.parent == {1: 0}
+    assert index.canonical_of([3]) == {3: 0}
+    assert index.merges_since(seq) == ([], 1)
+    index.close()
+
+
+def test_threshold_one_only_merges_identical_signatures(tmp_path, client):
+    push(client, X, X.replace('扣除率', '扣除比例'))
+    index = DedupIndex(str(tmp_path / 'dedup.sqlite3'), threshold=1)
+    index.redis = client
+    index.init_redis = lambda: None
+    index.build()
+    assert index.canonical_of([0, 1]) == {0: 0, 1: 1}
+    index.close()
+
+
+def test_merge_sequence_survives_reset(tmp_path, client):
+    db_file = tmp_path / 'dedup.sqlite3'
+    push(client, X, Y, Z)
+    build(db_file, client).close()
+    # --from-start清空指纹库后重新合并，序号继续增长，导出工具不会漏掉这次合并
+    index = build(db_file, client, resume=False)
+    assert index.merges_since(1) == ([1], 2)
+    index.close()
@@ -0,0 +1,36 @@
+import random
+
+import pytest
+
+import html_sanitizer
+from bench_sanitizer import (SAMPLE_ITEMS, legacy_clean_analysis, legacy_clean_content,
+                             legacy_clean_html_for_markdown)
+
+# 随机拼接这些片段，覆盖没有闭合的<、大小写不同的img、各种<br>和Unicode空白
+FRAGMENTS = ['<p>', '</p>', '<br>', '<br/>', '<br />', '<br  />', '<IMG src="a.png">', '<img src="b.png" />',
+             '<iMg', '<span style="x">', '</span>', '<table><tr><td>', '<', '>', '<<', 'B<p>', 'AC<p>', '1<p>',
+             ' ', '\n', '\t', '\r', '\xa0', '　', '\x1c', '题目', '（知识点：税目）', 'img', 'A']
+
+
+def fuzz_payloads(count=3000, seed=20240101):
+    rng = random.Random(seed)
+    return [''.join(rng.choices(FRAGMENTS, k=rng.randint(0, 30))) for _ in range(count)]
+
+
+PAYLOADS = [item['content'] for item in SAMPLE_ITEMS] + [item['textAnalysis'] for item in SAMPLE_ITEMS] \
+    + ['', None] + fuzz_payloads()
+
+
+@pytest.mark.parametrize('legacy, current', [
+    (legacy_clean_content, html_sanitizer.clean_content),
+    (legacy_clean_analysis, html_sanitizer.clean_analysis),
+    (legacy_clean_html_for_markdown, html_sanitizer.clean_html_for_markdown),
+], ids=['clean_content', 'clean_analysis', 'clean_html_for_markdown'])
+def test_matches_legacy_loop(legacy, current):
+    for payload in PAYLOADS:
+        assert current(payload) == legacy(payload), repr(payload)
+
+
+def test_img_tags_are_kept():
+    html = '<p>如图：<IMG src="http://img.wangxiao.cn/a.png"><br /></p><span>完</span>'
+    assert html_sanitizer.clean_content(html) == '如图：<IMG src="http://img.wangxiao.cn/a.png">完'
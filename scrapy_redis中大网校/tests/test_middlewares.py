@@ -0,0 +1,217 @@
+import json
+import os
+import random
+from collections import Counter
+
+import fakeredis
+import pytest
+from scrapy import Request, Spider
+
+from wangxiao_scrapy import middlewares
+from wangxiao_scrapy.middlewares import CookieInjectionMiddleware, UserAgentPoolMiddleware
+
+DATA = [
+    {'useragent': 'chrome-win', 'percent': 6.0, 'browser': 'Chrome', 'type': 'desktop'},
+    {'useragent': 'edge-win', 'percent': 3.0, 'browser': 'Edge', 'type': 'desktop'},
+    {'useragent': 'chrome-android', 'percent': 1.0, 'browser': 'Chrome Mobile', 'type': 'mobile'},
+    {'useragent': 'rare', 'percent': 0.01, 'browser': 'Chrome', 'type': 'desktop'},
+]
+
+
+class FakeUserAgent:
+    data_browsers = DATA
+
+
+@pytest.fixture
+def user_agents(monkeypatch):
+    monkeypatch.setattr(middlewares, 'UserAgent', FakeUserAgent)
+
+
+def test_pool_is_expanded_by_usage_share(user_agents):
+    pool = UserAgentPoolMiddleware.build_pool(None, None, 0.0, 100)
+    counts = Counter(pool)
+    assert counts == {'chrome-win': 60, 'edge-win': 30, 'chrome-android': 10}
+    # 占比不足一个位置的UA不进入池
+    assert 'rare' not in counts
+
+
+def test_pool_filters(user_agents):
+    assert set(UserAgentPoolMiddleware.build_pool(['Chrome', 'Edge'], None, 0.0, 100)) == {'chrome-win', 'edge-win'}
+    assert set(UserAgentPoolMiddleware.build_pool(None, ['mobile'], 0.0, 100)) == {'chrome-android'}
+    assert set(UserAgentPoolMiddleware.build_pool(None, None, 2.0, 100)) == {'chrome-win', 'edge-win'}
+    # 每一项都不足一个位置时保留占比最高的
+    assert UserAgentPoolMiddleware.build_pool(None, None, 0.0, 1) == ['chrome-win']
+    assert UserAgentPoolMiddleware.build_pool(['Firefox'], None, 0.0, 100) == []
+
+
+def test_fallback_when_the_dataset_cannot_be_loaded(monkeypatch):
+    class BrokenUserAgent:
+        def __init__(self):
+            raise OSError('no data')
+
+    monkeypatch.setattr(middlewares, 'UserAgent', BrokenUserAgent)
+    middleware = UserAgentPoolMiddleware(fallback=['fallback-ua'])
+    assert middleware.pool == ['fallback-ua']
+
+
+def test_weighted_pick_follows_usage_share(user_agents):
+    random.seed(1)
+    middleware = UserAgentPoolMiddleware(size=100, sticky=False)
+    counts = Counter()
+    for _ in range(5000):
+        request = Request('https://ks.wangxiao.cn/')
+        middleware.process_request(request, None)
+        counts[request.headers['User-Agent'].decode()] += 1
+    assert counts['chrome-win'] / 5000 == pytest.approx(0.6, abs=0.03)
+    assert counts['edge-win'] / 5000 == pytest.approx(0.3, abs=0.03)
+    assert counts['chrome-android'] / 5000 == pytest.approx(0.1, abs=0.03)
+
+
+def test_sticky_user_agent_per_cookiejar(user_agents):
+    random.seed(2)
+    middleware = UserAgentPoolMiddleware(size=100, sticky=True)
+
+    def user_agent(**meta):
+        request = Request('https://ks.wangxiao.cn/', meta=meta)
+        middleware.process_request(request, None)
+        return request.headers['User-Agent'].decode()
+
+    # 同一个会话（包括没有cookiejar的默认会话）始终是同一个UA
+    for jar in (None, 1, 'account-b'):
+        meta = {} if jar is None else {'cookiejar': jar}
+        assert len({user_agent(**meta) for _ in range(50)}) == 1
+    assert set(middleware.sessions) == {None, 1, 'account-b'}
+    # 不同会话各自随机：会话足够多时不会全部相同
+    assert len({user_agent(cookiejar=jar) for jar in range(100)}) > 1
+
+
+def test_request_user_agent_is_kept(user_agents):
+    middleware = UserAgentPoolMiddleware(size=100)
+    request = Request('https://ks.wangxiao.cn/', headers={'User-Agent': 'retry-ua'})
+    middleware.process_request(request, None)
+    assert request.headers['User-Agent'] == b'retry-ua'
+
+
+def write_cookies(path, cookies, mtime_ns):
+    path.write_text(json.dumps({'cookies': cookies, 'metadata': {}}), encoding='utf-8')
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def cookie_request():
+    return Request('https://ks.wangxiao.cn/practice/listQuestions', meta={'inject_cookies': True})
+
+
+@pytest.fixture
+def spider():
+    return Spider(name='questions')
+
+
+def test_cookie_file_reloads_when_mtime_or_size_changes(tmp_path, spider):
+    cookie_file = tmp_path / 'cookies_latest.json'
+    write_cookies(cookie_file, {'token': 'a'}, 1_000_000_000)
+    middleware = CookieInjectionMiddleware(cookie_file=str(cookie_file), check_interval=0)
+    middleware.spider_opened(spider)
+    assert spider.cookies == {'token': 'a'}
+
+    # 只改内容不改修改时间、大小也不变：不重新读取
+    write_cookies(cookie_file, {'token': 'b'}, 1_000_000_000)
+    request = cookie_request()
+    middleware.process_request(request, spider)
+    assert request.cookies == {'token': 'a'}
+
+    # 修改时间变了
+    os.utime(cookie_file, ns=(2_000_000_000, 2_000_000_000))
+    request = cookie_request()
+    middleware.process_request(request, spider)
+    assert request.cookies == {'token': 'b'}
+
+    # 修改时间没变、大小变了
+    write_cookies(cookie_file, {'token': 'ccc'}, 2_000_000_000)
+    request = cookie_request()
+    middleware.process_request(request, spider)
+    assert request.cookies == {'token': 'ccc'}
+    assert spider.cookies is middleware.cookies
+
+    # 没有标记的请求不注入
+    request = Request('https://ks.wangxiao.cn/')
+    middleware.process_request(request, spider)
+    assert request.cookies == {}
+
+
+def test_cookie_check_interval(tmp_path, spider, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(middlewares.time, 'monotonic', lambda: now[0])
+    cookie_file = tmp_path / 'cookies_latest.json'
+    write_cookies(cookie_file, {'token': 'a'}, 1_000_000_000)
+    middleware = CookieInjectionMiddleware(cookie_file=str(cookie_file), check_interval=30)
+    middleware.spider_opened(spider)
+
+    write_cookies(cookie_file, {'token': 'b'}, 2_000_000_000)
+    now[0] += 29
+    middleware.reload(spider)
+    assert middleware.cookies == {'token': 'a'}
+    now[0] += 1
+    middleware.reload(spider)
+    assert middleware.cookies == {'token': 'b'}
+
+
+def test_redis_cookies_reload_when_version_changes(spider):
+    server = fakeredis.FakeStrictRedis()
+    server.set('cookies', json.dumps({'cookies': {'token': 'a'}}))
+    server.set('cookies:version', 1)
+    middleware = CookieInjectionMiddleware(server=server, redis_key='cookies', check_interval=0)
+    middleware.spider_opened(spider)
+    assert middleware.cookies == {'token': 'a'}
+
+    # 数据变了但版本号没变：不重新读取
+    server.set('cookies', json.dumps({'cookies': {'token': 'b'}}))
+    middleware.reload(spider)
+    assert middleware.cookies == {'token': 'a'}
+
+    server.incr('cookies:version')
+    middleware.reload(spider)
+    assert middleware.cookies == {'token': 'b'}
+    assert middleware.version == 2
+
+
+@pytest.mark.parametrize('bad_content', [
+    '{"cookies": {"token": "b"',  # 文件正在写入，只写了一半
+    '{"cookies": {}}',
+    '',
+])
+def test_bad_cookie_file_keeps_old_cookies(tmp_path, spider, bad_content):
+    cookie_file = tmp_path / 'cookies_latest.json'
+    write_cookies(cookie_file, {'token': 'a'}, 1_000_000_000)
+    middleware = CookieInjectionMiddleware(cookie_file=str(cookie_file), check_interval=0)
+    middleware.spider_opened(spider)
+    old = middleware.cookies
+
+    cookie_file.write_text(bad_content, encoding='utf-8')
+    os.utime(cookie_file, ns=(2_000_000_000, 2_000_000_000))
+    request = cookie_request()
+    middleware.process_request(request, spider)
+    assert request.cookies is old
+    assert spider.cookies is old
+
+    # 写完以后下一次检查时换成新的
+    write_cookies(cookie_file, {'token': 'b'}, 3_000_000_000)
+    middleware.process_request(cookie_request(), spider)
+    assert middleware.cookies == {'token': 'b'}
+
+
+def test_missing_redis_version_keeps_old_cookies(spider):
+    server = fakeredis.FakeStrictRedis()
+    server.set('cookies', json.dumps({'cookies': {'token': 'a'}}))
+    server.set('cookies:version', 1)
+    middleware = CookieInjectionMiddleware(server=server, redis_key='cookies', check_interval=0)
+    middleware.spider_opened(spider)
+
+    server.delete('cookies', 'cookies:version')
+    middleware.reload(spider)
+    assert middleware.cookies == {'token': 'a'}
+
+    # 版本号先写、数据还没写完
+    server.set('cookies:version', 2)
+    middleware.reload(spider)
+    assert middleware.cookies == {'token': 'a'}
+    assert middleware.version == 1
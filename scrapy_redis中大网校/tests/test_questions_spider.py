@@ -0,0 +1,159 @@
+import json
+from pathlib import Path
+
+import fakeredis
+import pytest
+from scrapy import Request
+from scrapy.http import HtmlResponse, TextResponse
+
+from wangxiao_scrapy.items import WangxiaoScrapyItem
+from wangxiao_scrapy.spiders.questions import iter_exam_points
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+def clean(texts):
+    return ''.join(texts).replace(' ', '').replace('\n', '').replace('\t', '').replace('\r', '')
+
+
+def legacy_exam_points(response, first_title, second_title):
+    """改用iterwalk之前parse_third_page的XPath遍历，返回值和iter_exam_points相同"""
+    son_points = response.xpath('/html/body/div//ul[@class="section-point-item"]')
+    if son_points:
+        for son_point in son_points:
+            father_names = [first_title, second_title]
+            for father_point in son_point.xpath('ancestor::ul[@class="section-item" or @class="chapter-item"]'):
+                father_names.append(clean(father_point.xpath('./li[@class="fl"][1]/text()').extract()))
+            father_names.append(clean(son_point.xpath('./li[@class="fl"][1]/text()').extract()))
+            data_number = son_point.xpath('./li[@class="fl"][2]/text()').extract_first().split('/')[1]
+            data_sign = son_point.xpath('./li[@class="fl"]/span/@data_sign').extract_first()
+            data_subsign = son_point.xpath('./li[@class="fl"]/span/@data_subsign').extract_first()
+            yield father_names, data_sign, data_subsign, data_number
+    else:
+        for point in response.xpath('/html/body//div/ul[@class="chapter-item"]'):
+            father_names = [second_title, second_title, clean(point.xpath('./li[@class="fl"][1]/text()').extract())]
+            data_number = point.xpath('./li[@class="fl"][2]/text()').extract_first().split('/')[1]
+            data_sign = point.xpath('./li[@class="fl"]/span/@data_sign').extract_first()
+            data_subsign = point.xpath('./li[@class="fl"]/span/@data_subsign').extract_first()
+            yield father_names, data_sign, data_subsign, data_number
+
+
+def load(name):
+    body = (FIXTURES / name).read_bytes()
+    return HtmlResponse(url='https://ks.wangxiao.cn/practice/chapter', body=body, encoding='utf-8')
+
+
+def collect(points):
+    """收集遍历结果，出错时记录异常类型（旧代码遇到缺少数量的考点会抛出AttributeError）"""
+    result = []
+    try:
+        for point in points:
+            result.append(point)
+    except Exception as e:
+        result.append(type(e))
+    return result
+
+
+@pytest.mark.parametrize('name, expected_count', [
+    ('chapter_tree_nested.html', 5),
+    ('chapter_tree_flat.html', 4),
+    ('chapter_tree_malformed.html', 5),
+    ('chapter_tree_missing_count.html', 1),
+])
+def test_iter_exam_points_matches_legacy_xpath(name, expected_count):
+    response = load(name)
+    expected = collect(legacy_exam_points(response, '税务师', '税法一'))
+    actual = collect(iter_exam_points(response.selector.root, '税务师', '税法一'))
+    assert actual == expected
+    assert len(actual) == expected_count
+
+
+def test_nested_paths_follow_chapter_tree():
+    response = load('chapter_tree_nested.html')
+    points = list(iter_exam_points(response.selector.root, '税务师', '税法一'))
+    assert points[0] == (['税务师', '税法一', '第一章增值税', '第一节征税范围及纳税人', '一、征税范围的一般规定'],
+                         'p111', 'p111-sub', '35')
+    assert points[2][0] == ['税务师', '税法一', '第一章增值税', '第二节税率', '（一）基本税率', '13%税率']
+    # 不在div下面的考点不抓取
+    assert all(sign != 'x1' for _, sign, _, _ in points)
+
+
+def test_flat_pages_use_second_title_twice():
+    response = load('chapter_tree_flat.html')
+    points = list(iter_exam_points(response.selector.root, '税务师', '税法一'))
+    assert [names for names, _, _, _ in points] == [
+        ['税法一', '税法一', '第一章总论'],
+        ['税法一', '税法一', '第二章民事法律行为'],
+        ['税法一', '税法一', '第三章代理'],
+        ['税法一', '税法一', '第四章诉讼时效'],
+    ]
+
+
+def make_spider(server, page_size=20):
+    from scrapy.settings import Settings
+    from wangxiao_scrapy.spiders.questions import QuestionsSpider
+
+    spider = QuestionsSpider()
+    spider.settings = Settings({
+        'LIST_QUESTIONS_PAGE_SIZE': page_size,
+        'LIST_QUESTIONS_PAGE_PARAM': 'pageIndex',
+        'LIST_QUESTIONS_PAGE_START': 1,
+    })
+    spider.server = server
+    return spider
+
+
+def point_requests(spider):
+    """第一个考点（35道题）的listQuestions请求"""
+    response = load('chapter_tree_nested.html')
+    response = response.replace(request=Request(response.url, meta={'first_title': '税务师', 'second_title': '税法一'}))
+    return [request for request in spider.parse_third_page(response) if json.loads(request.body)['sign'] == 'p111']
+
+
+def questions_response(request, numbers):
+    data = {'Data': [{'questions': [{'id': n, 'content': f'第{n}题', 'textAnalysis': '解析'} for n in numbers]}]}
+    return TextResponse(url=request.url, body=json.dumps(data).encode('utf-8'), encoding='utf-8', request=request)
+
+
+def test_pages_are_split_and_forgotten_when_done():
+    spider = make_spider(fakeredis.FakeStrictRedis())
+    requests = point_requests(spider)
+    assert [json.loads(request.body).get('pageIndex') for request in requests] == [1, 2]
+    assert [request.meta['pages'] for request in requests] == [2, 2]
+
+    # 第二页先到
+    second = list(spider.parse_get_json(questions_response(requests[1], range(21, 36))))
+    assert spider.page_heads
+    first = list(spider.parse_get_json(questions_response(requests[0], range(1, 21))))
+    assert len(first) + len(second) == 35
+    assert all(isinstance(item, WangxiaoScrapyItem) for item in first + second)
+    assert spider.page_heads == {}
+    assert not spider.is_paging_ignored()
+
+
+def test_ignored_page_param_is_shared_through_redis():
+    server = fakeredis.FakeStrictRedis()
+    spider = make_spider(server)
+    requests = point_requests(spider)
+
+    # 接口忽略了pageIndex，每页都返回前20道题
+    first = list(spider.parse_get_json(questions_response(requests[0], range(1, 21))))
+    assert len(first) == 20
+    [refetch] = list(spider.parse_get_json(questions_response(requests[1], range(1, 21))))
+    assert isinstance(refetch, Request)
+    assert 'pageIndex' not in json.loads(refetch.body)
+    assert json.loads(refetch.body)['top'] == '35'
+    assert spider.page_heads == {}
+    assert server.get('questions:paging_ignored') == b'pageIndex'
+
+    items = list(spider.parse_get_json(questions_response(refetch, range(1, 36))))
+    assert len(items) == 35
+
+    # 其它worker读到Redis中的标记，不再分页
+    other = make_spider(server)
+    [request] = point_requests(other)
+    assert 'pageIndex' not in json.loads(request.body)
+    # 换了页码参数名之后重新尝试分页
+    other = make_spider(server)
+    other.settings.set('LIST_QUESTIONS_PAGE_PARAM', 'page')
+    assert len(point_requests(other)) == 2
@@ -0,0 +1,368 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import re
+import subprocess
+import sys
+import tarfile
+import textwrap
+import zipfile
+import zlib
+from pathlib import Path
+
+import pytest
+
+from image_cache import ImageStore
+from md_index import MarkdownIndex, question_fingerprint
+from redis_to_md import (AsyncMDExporter, FileWriteQueue, GroupBufferExceeded, MarkdownGrouper, queue_source, shard_of,
+                         shard_worker)
+
+ITEMS = [
+    {'path': ['税务师', '税法二', '第六章车船税', '一、纳税人'], 'content': '<p>车船税的纳税人是？</p>',
+     'options': ['A.所有人', 'B.管理人'], 'textAnalysis': '<p>【答案】A</p>'},
+    {'path': ['税务师', '税法二', '第六章车船税', '一、纳税人'], 'content': '<p>下列属于车船税征税范围的是？</p>',
+     'options': ['A.拖拉机', 'B.客车'], 'textAnalysis': '<p>【答案】B</p>'},
+]
+
+
+def make_items(count):
+    """分布在3个文件中的count道题，每个文件里有一道重复题"""
+    items = []
+    for i in range(count):
+        chapter = f'第{i % 3}章'
+        items.append({'path': ['税务师', '税法二', chapter, '一、纳税人'],
+                      'content': f'<p>题目{i}' + '很长的题干' * (i % 7) + '</p>',
+                      'options': ['A.是', 'B.否'], 'textAnalysis': f'A<p>解析{i}</p>'})
+    items.extend(dict(items[i]) for i in range(3))
+    return items
+
+
+def export(output_dir, items=ITEMS, **run_kwargs):
+    exporter = AsyncMDExporter()
+    exporter.max_in_flight = 2
+    # 文件头中的保存时间固定下来，方便比较两种写入方式的结果
+    exporter.get_current_time = lambda: '2024-01-01 00:00:00'
+
+    async def source():
+        for item in items:
+            yield dict(item)
+
+    exporter.source = source
+    # --incremental的第一遍也从这里读取
+    exporter.iter_valid_data = lambda limit=None: source()
+    run_kwargs.setdefault('image_cache', None)
+    asyncio.run(exporter.run(output_dir=str(output_dir), **run_kwargs))
+    return exporter
+
+
+def read_tree(output_dir):
+    return {path.relative_to(output_dir).as_posix(): path.read_text(encoding='utf-8')
+            for path in sorted(output_dir.rglob('*.md'))}
+
+
+def test_deleted_file_is_rewritten_on_rerun(tmp_path):
+    export(tmp_path)
+    md_path = tmp_path / '税务师' / '税法二' / '第六章车船税' / '一、纳税人.md'
+    first = md_path.read_text(encoding='utf-8')
+    assert '车船税的纳税人是' in first and '征税范围' in first
+
+    # 索引中还有这两道题，但文件已经被删除：重新运行后要完整写回，而不是留下空文件
+    md_path.unlink()
+    export(tmp_path)
+    second = md_path.read_text(encoding='utf-8')
+    assert '车船税的纳税人是' in second and '征税范围' in second
+
+    # 再运行一次：索引生效，不会重复追加
+    export(tmp_path)
+    assert md_path.read_text(encoding='utf-8') == second
+
+
+def test_emptied_file_is_rewritten_on_rerun(tmp_path):
+    export(tmp_path)
+    md_path = tmp_path / '税务师' / '税法二' / '第六章车船税' / '一、纳税人.md'
+    md_path.write_text('', encoding='utf-8')
+
+    export(tmp_path)
+    text = md_path.read_text(encoding='utf-8')
+    assert text.count('车船税的纳税人是') == 1 and text.count('征税范围') == 1
+
+
+def test_grouped_output_with_spills_matches_the_appender(tmp_path):
+    items = make_items(60)
+    export(tmp_path / 'append', items)
+    # group_buffer_mb=0：每道题都会落盘到临时文件
+    exporter = export(tmp_path / 'group', items, group=True, group_buffer_mb=0, spill_dir=str(tmp_path))
+    assert exporter.grouper.stats['spilled_bytes'] > 0
+    assert exporter.grouper.stats['duplicates'] == 3
+
+    appended = read_tree(tmp_path / 'append')
+    assert len(appended) == 3
+    assert read_tree(tmp_path / 'group') == appended
+    # 临时文件已删除
+    assert not list(tmp_path.glob('*.spill'))
+
+
+def test_grouper_interleaves_spilled_and_buffered_blocks_in_order(tmp_path):
+    grouper = MarkdownGrouper(spill_dir=str(tmp_path), max_buffer_bytes=40)
+    md_paths = [tmp_path / 'out' / f'{name}.md' for name in ('a', 'b')]
+    expected = {md_path: 'header\n' for md_path in md_paths}
+    for i in range(30):
+        md_path = md_paths[i % 2]
+        block = f'[{i}]' + '*' * (i % 5) + '\n'
+        grouper.add(md_path, 'header\n', str(i), block)
+        expected[md_path] += block
+
+    # 一部分落盘、一部分还在内存中
+    assert grouper.spills and grouper.buffered_bytes
+    assert grouper.write_all() == 2
+    for md_path in md_paths:
+        assert md_path.read_text(encoding='utf-8') == expected[md_path]
+
+
+CRASH_SCRIPT = textwrap.dedent("""
+    import asyncio, os, sys
+    sys.path.insert(0, sys.argv[2])
+    from redis_to_md import AsyncMDExporter, write_queue
+    from test_redis_to_md import make_items
+
+    # 小缓冲区：崩溃前已经有一部分题目刷到文件里，另一部分还在缓冲区中
+    write_queue.buffer_size = 300
+    exporter = AsyncMDExporter()
+    exporter.max_in_flight = 2
+
+    async def source():
+        for i, item in enumerate(make_items(60)):
+            if i == 40:
+                # 等已提交的写入跑完，然后不做任何清理直接退出
+                await asyncio.sleep(0.5)
+                os._exit(3)
+            yield item
+
+    exporter.source = source
+    asyncio.run(exporter.run(output_dir=sys.argv[1], image_cache=None))
+""")
+
+
+def test_crash_never_leaves_indexed_questions_missing_from_files(tmp_path):
+    tests_dir = Path(__file__).resolve().parent
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, '-c', CRASH_SCRIPT, str(tmp_path), str(tests_dir)], env=env)
+    assert result.returncode == 3
+
+    # 索引中记录的题目一定已经在文件中
+    index = MarkdownIndex(tmp_path)
+    indexed = 0
+    for md_path in tmp_path.rglob('*.md'):
+        text = md_path.read_text(encoding='utf-8')
+        fingerprints = index.fingerprints(md_path)
+        indexed += len(fingerprints)
+        for i, item in enumerate(make_items(60)[:40]):
+            if question_fingerprint(item) in fingerprints:
+                assert f'解析{i}<br>' in text
+    index.close()
+    assert indexed
+
+    # 重新运行后每道题都在，且只出现一次
+    export(tmp_path, make_items(60))
+    text = ''.join(read_tree(tmp_path).values())
+    assert all(text.count(f'解析{i}<br>') == 1 for i in range(60))
+
+
+def test_write_queue_stats_are_counted_on_the_loop_thread(tmp_path):
+    files = [tmp_path / f'{i}.md' for i in range(3)]
+
+    async def main():
+        queue = FileWriteQueue(shards=2, max_open=1)
+        for i in range(30):
+            await queue.enqueue_write(files[i % 3], lambda handle, i=i: handle.write(f'{i}\n'))
+        await queue.close()
+        return queue.stats
+
+    stats = asyncio.run(main())
+    assert stats['writes'] == 30 and stats['failed'] == 0
+    assert stats['handle_hits'] + stats['handle_misses'] == 30
+    assert sum(len(path.read_text().split()) for path in files) == 30
+
+
+def test_process_batch_keeps_a_sliding_window_of_questions(tmp_path):
+    exporter = AsyncMDExporter()
+    exporter.max_in_flight = 4
+    finished, in_flight, peak = [], [0], [0]
+
+    async def save_single_md(item, output_base):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        # 第0道题的图片很慢，其它题目不应该等它
+        await asyncio.sleep(0.3 if item['i'] == 0 else 0.001)
+        in_flight[0] -= 1
+        finished.append(item['i'])
+
+    async def items():
+        for i in range(40):
+            yield {'i': i}
+
+    exporter.save_single_md = save_single_md
+    asyncio.run(exporter.process_batch(items(), tmp_path))
+
+    assert sorted(finished) == list(range(40))
+    assert exporter.stats['total'] == 40
+    assert peak[0] == 4
+    # 慢题目最后完成，其它题目在它之前已经全部处理完
+    assert finished[-1] == 0
+
+
+def test_plan_incremental_counts_added_and_removed_questions(tmp_path, capsys):
+    items = make_items(12)[:12]
+    export(tmp_path, items, group=True)
+    capsys.readouterr()
+
+    changed = [dict(item) for item in items if item['content'] != items[4]['content']]  # 第1章删掉一道
+    changed.append(dict(items[0], content='<p>新题目A</p>'))  # 第0章新增两道
+    changed.append(dict(items[0], content='<p>新题目B</p>'))
+    changed[2] = dict(changed[2], textAnalysis='A<p>修改后的解析</p>')  # 第2章只改解析
+    changed.append(dict(items[0], path=['税务师', '税法二', '第9章', '一、纳税人']))  # 新文件
+
+    exporter = export(tmp_path, changed, dry_run=True)
+    out = capsys.readouterr().out
+    base = tmp_path / '税务师' / '税法二'
+    assert exporter.only_files == {base / f'第{n}章' / '一、纳税人.md' for n in (0, 1, 2, 9)}
+    assert '+ 税务师/税法二/第9章/一、纳税人.md  (1 道题)' in out
+    assert '~ 税务师/税法二/第0章/一、纳税人.md  (+2 -0 道题)' in out
+    assert '~ 税务师/税法二/第1章/一、纳税人.md  (+0 -1 道题)' in out
+    assert '~ 税务师/税法二/第2章/一、纳税人.md  (题目内容有修改)' in out
+    # dry_run不写入
+    assert not (base / '第9章').exists()
+
+    # 真正增量运行后再对比，没有需要更新的文件
+    export(tmp_path, changed, incremental=True)
+    exporter = export(tmp_path, changed, dry_run=True)
+    assert exporter.only_files == set()
+
+
+def test_items_are_routed_by_crc32_of_the_exam_category():
+    categories = ['税务师', '注册会计师', '一级建造师', '中级会计职称', '初级会计职称']
+    for processes in (1, 2, 3, 8):
+        for category in categories:
+            item = {'path': [category, '科目', '章节']}
+            assert shard_of(item, processes) == zlib.crc32(category.encode('utf-8')) % processes
+            # 只看path[0]，同一类别下的题目总在同一个进程中
+            assert shard_of({'path': [category, '别的科目', '别的章节']}, processes) == shard_of(item, processes)
+    # 固定的分片结果：换成别的哈希（比如受PYTHONHASHSEED影响的hash()）时各次运行会写到不同的进程
+    assert [shard_of({'path': [category]}, 4) for category in categories] == [1, 0, 0, 3, 2]
+
+
+def test_queue_source_stops_when_the_parent_is_gone():
+    item_queue = queue.Queue()
+    item_queue.put([{'i': 0}, {'i': 1}])
+
+    async def collect(parent_pid):
+        return [item async for item in queue_source(item_queue, parent_pid, timeout=0.05)]
+
+    # 父进程id和启动时记录的不一致：读完已有的数据后不再一直等待
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(os.getppid() + 1))
+
+    item_queue.put([{'i': 2}])
+    item_queue.put(None)
+    assert asyncio.run(collect(os.getppid())) == [{'i': 2}]
+
+
+def test_failed_shard_reports_the_error_and_exits_with_1(tmp_path):
+    # 输出目录是一个普通文件，导出一开始就失败
+    output_dir = tmp_path / 'not_a_dir'
+    output_dir.write_text('')
+    ctx = multiprocessing.get_context('spawn')
+    item_queue, result_queue = ctx.Queue(), ctx.Queue()
+    item_queue.put(None)
+    process = ctx.Process(target=shard_worker, args=(3, item_queue, result_queue, str(output_dir),
+                                                     {'image_workers': 1, 'max_in_flight': 1},
+                                                     {'image_cache': None}))
+    process.start()
+    shard, stats, cache_stats, error = result_queue.get(timeout=60)
+    process.join(timeout=60)
+
+    assert process.exitcode == 1
+    assert shard == 3 and error and 'Error' in error
+
+
+IMG = 'http://img.wangxiao.cn/bjupload/2020-10-29/'
+IMAGES = {IMG + 'formula.png': b'formula', IMG + 'copy.png': b'formula', IMG + 'table.png': b'table'}
+ARCHIVE_ITEMS = [
+    {'path': ['税务师', '税法二', '第一章', '一、纳税人'], 'options': ['A.是', 'B.否'],
+     'content': f'<p>题目0<img src="{IMG}formula.png"></p>', 'textAnalysis': f'A<p>解析0<img src="{IMG}table.png"></p>'},
+    {'path': ['税务师', '税法二', '第二章', '二、税率'], 'options': ['A.是', 'B.否'],
+     'content': f'<p>题目1<img src="{IMG}copy.png"></p>', 'textAnalysis': 'B<p>解析1</p>'},
+]
+
+
+def export_archive(tmp_path, archive_name, **run_kwargs):
+    cache_dir = tmp_path / 'cache'
+    store = ImageStore(cache_dir)
+    for url, content in IMAGES.items():
+        store.store(url, content)
+    store.close()
+
+    archive_path = tmp_path / archive_name
+    export(tmp_path / 'q_all', ARCHIVE_ITEMS, archive=str(archive_path), image_cache=str(cache_dir), **run_kwargs)
+    return archive_path
+
+
+def check_extracted_tree(root, expected_refs):
+    """每个md中引用的图片都能按相对路径找到，内容正确"""
+    md_files = sorted(root.rglob('*.md'))
+    assert [md.relative_to(root).as_posix() for md in md_files] == [
+        '税务师/税法二/第一章/一、纳税人.md', '税务师/税法二/第二章/二、税率.md']
+    refs = {}
+    for md in md_files:
+        text = md.read_text(encoding='utf-8')
+        for ref in re.findall(r'src="\./([^"]+)"', text):
+            refs[ref] = (md.parent / ref).read_bytes()
+    assert refs == expected_refs
+
+
+def test_tar_archive_round_trip(tmp_path):
+    archive_path = export_archive(tmp_path, 'q_all.tar')
+    assert not (tmp_path / 'q_all').exists()
+
+    with tarfile.open(archive_path) as tar:
+        members = {member.name: member for member in tar.getmembers()}
+        assert set(members) == {
+            '税务师/税法二/第一章/一、纳税人.md', '税务师/税法二/第二章/二、税率.md',
+            '税务师/税法二/第一章/一、纳税人_img/formula.png', '税务师/税法二/第一章/一、纳税人_img/table.png',
+            '税务师/税法二/第二章/二、税率_img/copy.png',
+        }
+        # 内容相同的图片只存一份，第二份是硬链接
+        copy = members['税务师/税法二/第二章/二、税率_img/copy.png']
+        assert copy.islnk() and copy.linkname == '税务师/税法二/第一章/一、纳税人_img/formula.png'
+        tar.extractall(tmp_path / 'out', filter='data')
+    check_extracted_tree(tmp_path / 'out', {'一、纳税人_img/formula.png': b'formula',
+                                            '一、纳税人_img/table.png': b'table',
+                                            '二、税率_img/copy.png': b'formula'})
+
+
+def test_zip_archive_round_trip(tmp_path):
+    archive_path = export_archive(tmp_path, 'q_all.zip')
+
+    with zipfile.ZipFile(archive_path) as archive:
+        assert set(archive.namelist()) == {
+            '税务师/税法二/第一章/一、纳税人.md', '税务师/税法二/第二章/二、税率.md',
+            '税务师/税法二/第一章/一、纳税人_img/formula.png', '税务师/税法二/第一章/一、纳税人_img/table.png',
+        }
+        # zip没有链接，第二章的md直接引用第一章目录下的那一份
+        text = archive.read('税务师/税法二/第二章/二、税率.md').decode('utf-8')
+        assert 'src="./../第一章/一、纳税人_img/formula.png"' in text
+        archive.extractall(tmp_path / 'out')
+    check_extracted_tree(tmp_path / 'out', {'一、纳税人_img/formula.png': b'formula',
+                                            '一、纳税人_img/table.png': b'table',
+                                            '../第一章/一、纳税人_img/formula.png': b'formula'})
+
+
+def test_archive_fails_instead_of_spilling(tmp_path):
+    archive_path = tmp_path / 'q_all.tar'
+    exporter = export(tmp_path / 'q_all', make_items(20), archive=str(archive_path), group_buffer_mb=0,
+                      spill_dir=str(tmp_path))
+    assert isinstance(exporter.error, GroupBufferExceeded)
+    # 没有临时文件，不完整的归档文件也被删除
+    assert not list(tmp_path.glob('*.spill'))
+    assert not archive_path.exists()
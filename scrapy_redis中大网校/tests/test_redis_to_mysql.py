@@ -0,0 +1,436 @@
+import json
+
+import fakeredis
+import pytest
+
+from redis_to_mysql import (BatchWriter, DEDUP_BEFORE_UNIQUE_SQL, ExportCheckpoint, INSERT_COLUMNS, NORMALIZED_COLUMNS,
+                            PathDictionary, SimpleMySQLStorage, iter_redis_items)
+
+KEY = 'questions:items'
+
+
+class FakeCursor:
+    """按事务记录写入的假游标：content为'bad'的行会让整条executemany失败"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def executemany(self, sql, rows):
+        self.db.calls.append(len(rows))
+        if any(row[1] == 'bad' for row in rows):
+            raise ValueError('bad row')
+        self.db.pending.extend(rows)
+
+    def execute(self, sql, params=None):
+        if 'INSERT INTO export_checkpoint' in sql:
+            self.db.pending_offset = params[1]
+        elif 'FROM export_checkpoint' in sql:
+            self.result = (self.db.offset, 'last-run') if self.db.offset is not None else None
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    def __init__(self):
+        self.rows = []
+        self.pending = []
+        self.offset = None
+        self.pending_offset = None
+        self.calls = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.rows.extend(self.pending)
+        if self.pending_offset is not None:
+            self.offset = self.pending_offset
+        self.pending, self.pending_offset = [], None
+        self.commits += 1
+
+    def rollback(self):
+        self.pending, self.pending_offset = [], None
+
+
+def row(content):
+    return dict(zip(INSERT_COLUMNS, ('p', content, '', 'A', '', content)))
+
+
+@pytest.fixture
+def client():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    client.rpush(KEY, *[f'item-{i}' for i in range(23)])
+    return client
+
+
+@pytest.mark.parametrize('chunk_size,pipeline_pages', [(1, 1), (5, 1), (5, 4), (23, 1), (22, 2), (100, 4)])
+def test_lrange_pages_cover_the_whole_list(client, chunk_size, pipeline_pages):
+    items = list(iter_redis_items(client, KEY, chunk_size=chunk_size, pipeline_pages=pipeline_pages))
+    assert items == [(i, f'item-{i}') for i in range(23)]
+
+
+@pytest.mark.parametrize('start,limit,expected', [
+    (0, None, range(23)),
+    (20, None, range(20, 23)),
+    (22, None, range(22, 23)),
+    (23, None, range(0)),
+    (30, None, range(0)),
+    (3, 5, range(3, 8)),
+    (3, 0, range(0)),
+    (18, 10, range(18, 23)),
+])
+def test_start_and_limit(client, start, limit, expected):
+    items = list(iter_redis_items(client, KEY, start=start, limit=limit, chunk_size=5, pipeline_pages=2))
+    assert items == [(i, f'item-{i}') for i in expected]
+
+
+def test_exact_multiple_of_chunk_size(client):
+    client.rpush(KEY, 'item-23')
+    pipe_calls = []
+    pipeline = client.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipe_calls.append(1)
+        return pipeline(*args, **kwargs)
+
+    client.pipeline = counting_pipeline
+    items = list(iter_redis_items(client, KEY, chunk_size=6, pipeline_pages=2))
+    assert [i for i, _ in items] == list(range(24))
+    # 24条正好4页，2页一次pipeline，不会多出一次空的LRANGE
+    assert len(pipe_calls) == 2
+
+
+def test_empty_list():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    assert list(iter_redis_items(client, KEY, chunk_size=5)) == []
+
+
+def test_stops_when_list_is_truncated_while_reading(client):
+    items = []
+    for index, item_json in iter_redis_items(client, KEY, chunk_size=5, pipeline_pages=1):
+        items.append(index)
+        if index == 7:
+            # 读取过程中列表被截断到12条
+            client.ltrim(KEY, 0, 11)
+    assert items == list(range(12))
+
+
+def test_batch_is_written_in_one_transaction():
+    db = FakeDB()
+    writer = BatchWriter(db, batch_size=4, flush_interval=3600)
+    for i in range(4):
+        writer.add(row(f'q{i}'))
+    assert db.calls == [4] and db.commits == 1
+    assert writer.success == 4 and writer.failed == 0
+
+
+def test_failed_batch_is_split_in_half_until_the_bad_row_is_isolated():
+    db = FakeDB()
+    writer = BatchWriter(db, batch_size=8, flush_interval=3600)
+    contents = ['q0', 'q1', 'q2', 'q3', 'q4', 'bad', 'q6', 'q7']
+    for content in contents:
+        writer.add(row(content))
+
+    # 8条失败 -> 前4条成功 -> 后4条失败 -> [q4, bad]失败 -> q4成功、bad失败 -> [q6, q7]成功
+    assert db.calls == [8, 4, 4, 2, 1, 1, 2]
+    assert [r[1] for r in db.rows] == [c for c in contents if c != 'bad']
+    assert writer.success == 7 and writer.failed == 1
+    assert writer.batches == 1
+
+
+def test_every_row_bad():
+    db = FakeDB()
+    writer = BatchWriter(db, batch_size=3, flush_interval=3600)
+    for _ in range(3):
+        writer.add(row('bad'))
+    assert db.rows == []
+    assert writer.success == 0 and writer.failed == 3
+
+
+def make_storage(count):
+    """不连接MySQL的SimpleMySQLStorage，只用来读取和清洗fakeredis中的数据"""
+    storage = SimpleMySQLStorage.__new__(SimpleMySQLStorage)
+    storage.redis = fakeredis.FakeRedis(decode_responses=True)
+    storage.redis_key = KEY
+    storage.chunk_size = 7
+    storage.pipeline_pages = 2
+    items = []
+    for i in range(count):
+        item = {'path': ['税务师', '税法二', f'第{i % 3}章'], 'content': f'<p>题目{i}</p>',
+                'options': [], 'textAnalysis': f'A<p>解析{i}</p>'}
+        if i % 10 == 9:
+            del item['textAnalysis']
+        items.append(json.dumps(item, ensure_ascii=False))
+    storage.redis.rpush(KEY, *items)
+    return storage
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_ordered_pipeline_keeps_input_order(workers):
+    storage = make_storage(60)
+    chunks = list(storage.iter_transformed(0, None, workers, chunk_size=8, ordered=True))
+    assert [len(chunk) for chunk in chunks] == [8] * 7 + [4]
+    indexes = [i for chunk in chunks for i, _, _ in chunk]
+    assert indexes == list(range(60))
+    statuses = {i: status for chunk in chunks for i, status, _ in chunk}
+    assert [i for i, status in statuses.items() if status == 'discard'] == [9, 19, 29, 39, 49, 59]
+
+
+def test_unordered_pipeline_yields_the_same_chunks():
+    storage = make_storage(60)
+    ordered = list(storage.iter_transformed(0, None, 2, chunk_size=8, ordered=True))
+    unordered = list(storage.iter_transformed(0, None, 2, chunk_size=8, ordered=False))
+    # 批次之间可以乱序，但每一批保持原样（mark_done按批推进水位线）
+    key = lambda chunk: chunk[0][0]
+    assert sorted(unordered, key=key) == ordered
+    for chunk in unordered:
+        assert [i for i, _, _ in chunk] == list(range(chunk[0][0], chunk[-1][0] + 1))
+
+
+def test_pipeline_respects_start_and_limit():
+    storage = make_storage(60)
+    for ordered in (True, False):
+        chunks = list(storage.iter_transformed(15, 20, 2, chunk_size=8, ordered=ordered))
+        assert sorted(i for chunk in chunks for i, _, _ in chunk) == list(range(15, 35))
+
+
+def test_watermark_only_advances_over_contiguous_ranges():
+    db = FakeDB()
+    checkpoint = ExportCheckpoint(KEY)
+    writer = BatchWriter(db, batch_size=1000, flush_interval=3600, checkpoint=checkpoint)
+
+    # 乱序完成：[10, 20)和[20, 30)先完成，水位线停在0
+    writer.mark_done(10, 20)
+    writer.mark_done(20, 30)
+    assert writer.watermark == 0
+    writer.flush()
+    assert db.offset is None
+
+    # [0, 10)完成后一次推进到30
+    writer.mark_done(0, 10)
+    assert writer.watermark == 30 and writer.done_ranges == {}
+    writer.flush()
+    assert db.offset == 30
+
+    # [40, 50)还没接上
+    writer.mark_done(40, 50)
+    writer.close()
+    assert db.offset == 30
+
+
+def test_watermark_is_committed_with_the_rows():
+    db = FakeDB()
+    writer = BatchWriter(db, batch_size=1000, flush_interval=3600, checkpoint=ExportCheckpoint(KEY))
+    writer.add(row('q0'))
+    writer.add(row('q1'))
+    writer.mark_done(0, 2)
+    writer.flush()
+    # 数据和水位线在同一个事务中提交
+    assert db.commits == 1
+    assert len(db.rows) == 2 and db.offset == 2
+
+    # 拆分重试跳过坏数据后，水位线仍然单独记录下来
+    writer.add(row('bad'))
+    writer.add(row('q3'))
+    writer.mark_done(2, 4)
+    writer.flush()
+    assert len(db.rows) == 3 and db.offset == 4
+
+
+def export_into(storage, db, resume, limit=None):
+    storage.db = db
+    storage.cursor = db.cursor()
+    storage.paths = None
+    storage.columns = INSERT_COLUMNS
+    storage.checkpoint = ExportCheckpoint(KEY)
+    list_len = storage.redis.llen(KEY)
+    start = storage.resume_offset(resume, list_len)
+    total = list_len - start if limit is None else min(list_len - start, limit)
+    writer = BatchWriter(db, batch_size=5, flush_interval=3600, checkpoint=storage.checkpoint)
+    storage.export_items(writer, start, total, workers=0, worker_chunk_size=8, ordered=True)
+    return start
+
+
+def test_resume_continues_from_the_saved_watermark():
+    storage = make_storage(40)
+    db = FakeDB()
+
+    # 第一次只导出前20条，相当于中途被中断
+    assert export_into(storage, db, resume=True, limit=20) == 0
+    assert db.offset == 20
+    first = len(db.rows)
+
+    # 第二次从第20条继续，不会重新写入前20条
+    assert export_into(storage, db, resume=True) == 20
+    assert db.offset == 40
+    contents = [r[1] for r in db.rows]
+    assert len(contents) == len(set(contents)) == first + 18
+
+    # --from-start 忽略进度
+    assert export_into(storage, db, resume=False) == 0
+
+
+def test_resume_restarts_when_the_list_was_rebuilt():
+    storage = make_storage(10)
+    db = FakeDB()
+    db.offset = 500
+    assert export_into(storage, db, resume=True) == 0
+    assert db.offset == 10
+
+
+class PathsCursor:
+    """模拟paths表：path_hash唯一，重复插入时lastrowid返回原来的id（LAST_INSERT_ID(id)）"""
+
+    def __init__(self, table):
+        self.table = table
+        self.lastrowid = None
+        self.result = None
+
+    def execute(self, sql, params):
+        self.table.queries += 1
+        if sql.strip().startswith('INSERT INTO paths'):
+            parent_id, depth, name, full_path, hash_ = params
+            if hash_ not in self.table.by_hash:
+                row_id = len(self.table.rows) + 1
+                self.table.rows[row_id] = {'parent_id': parent_id, 'depth': depth, 'name': name,
+                                           'full_path': full_path, 'lineage': ''}
+                self.table.by_hash[hash_] = row_id
+            self.lastrowid = self.table.by_hash[hash_]
+        elif sql.startswith('UPDATE paths'):
+            lineage, row_id = params
+            self.table.rows[row_id]['lineage'] = lineage
+        elif sql.startswith('SELECT lineage'):
+            row_id = self.table.by_hash.get(params[0])
+            self.result = (self.table.rows[row_id]['lineage'],) if row_id else None
+
+    def fetchone(self):
+        return self.result
+
+
+class PathsTable:
+    def __init__(self):
+        self.rows = {}
+        self.by_hash = {}
+        self.queries = 0
+
+    def cursor(self):
+        return PathsCursor(self)
+
+    def commit(self):
+        pass
+
+
+def test_path_lineage_lists_every_ancestor():
+    table = PathsTable()
+    paths = PathDictionary(table)
+
+    leaf = paths.resolve(['税务师', '税法二', '第六章车船税', '一、纳税人'])
+    assert leaf == 4
+    assert [table.rows[i]['lineage'] for i in (1, 2, 3, 4)] == ['/1/', '/1/2/', '/1/2/3/', '/1/2/3/4/']
+    assert [table.rows[i]['parent_id'] for i in (1, 2, 3, 4)] == [None, 1, 2, 3]
+    assert table.rows[4]['full_path'] == '税务师->税法二->第六章车船税->一、纳税人'
+
+    # 兄弟节点复用缓存中的祖先，只新建最后一层
+    queries = table.queries
+    sibling = paths.resolve(['税务师', '税法二', '第六章车船税', '二、征税范围'])
+    assert table.queries - queries == 2
+    assert table.rows[sibling]['lineage'] == '/1/2/3/5/'
+    assert paths.lineage_of(['税务师', '税法二', '第六章车船税', '二、征税范围']) == '/1/2/3/5/'
+
+    # 已缓存的完整路径不再查库
+    queries = table.queries
+    assert paths.resolve(['税务师', '税法二', '第六章车船税', '一、纳税人']) == leaf
+    assert table.queries == queries
+    assert paths.resolve([]) is None
+
+
+def test_new_dictionary_reuses_existing_ids():
+    table = PathsTable()
+    first = PathDictionary(table).resolve(['注册会计师', '会计', '第一章'])
+
+    # 另一个进程（空缓存）拿到同一个id和lineage，不会重复建行
+    second = PathDictionary(table)
+    assert second.resolve(['注册会计师', '会计', '第一章']) == first
+    assert len(table.rows) == 3
+    assert second.resolve(['注册会计师', '审计']) == 4
+    assert table.rows[4]['lineage'] == '/1/4/'
+
+
+class SchemaCursor:
+    """模拟information_schema：列都已存在，索引只有keys中的这些"""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.statements = []
+        self.result = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        self.rowcount = 0
+        if 'information_schema.COLUMNS' in sql:
+            self.result = [(1,)]
+        elif 'information_schema.STATISTICS' in sql:
+            self.result = [(name,) for name in self.keys]
+        elif sql == DEDUP_BEFORE_UNIQUE_SQL:
+            self.rowcount = 2
+        elif sql.startswith('ALTER TABLE questions ADD'):
+            self.keys.update(name for name in ('uk_content_hash', 'idx_path_id') if name in sql)
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+class SchemaDB:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def startup(keys, schema):
+    cursor = SchemaCursor(keys)
+    storage = SimpleMySQLStorage.__new__(SimpleMySQLStorage)
+    storage.db = SchemaDB(cursor)
+    storage.cursor = cursor
+    storage.checkpoint = ExportCheckpoint(KEY)
+    storage.paths = PathDictionary(storage.db) if schema == 'normalized' else None
+    storage.columns = NORMALIZED_COLUMNS if storage.paths else INSERT_COLUMNS
+    storage.create_table()
+    return cursor
+
+
+def test_startup_restores_keys_dropped_by_a_crashed_bulk_import():
+    cursor = startup({'PRIMARY'}, schema='normalized')
+    assert cursor.keys == {'PRIMARY', 'uk_content_hash', 'idx_path_id'}
+    # 先按REPLACE的语义删除重复行，再建唯一索引
+    dedup = cursor.statements.index(DEDUP_BEFORE_UNIQUE_SQL)
+    alter = next(i for i, sql in enumerate(cursor.statements) if sql.startswith('ALTER TABLE questions ADD'))
+    assert dedup < alter
+    assert 'ADD KEY idx_path_id' in cursor.statements[alter]
+
+
+def test_startup_recreates_a_dropped_path_index_without_dedup():
+    cursor = startup({'PRIMARY', 'uk_content_hash'}, schema='normalized')
+    assert 'idx_path_id' in cursor.keys
+    assert DEDUP_BEFORE_UNIQUE_SQL not in cursor.statements
+
+
+def test_startup_leaves_complete_tables_alone():
+    cursor = startup({'PRIMARY', 'uk_content_hash'}, schema='flat')
+    assert not any(sql.startswith('ALTER') for sql in cursor.statements)
@@ -0,0 +1,139 @@
+import json
+
+import fakeredis
+import pytest
+
+from dedup_questions import DedupIndex
+from redis_to_sqlite import SQLiteSearchIndex
+from test_dedup_questions import X, Y, Z
+
+KEY = 'questions:items'
+ITEMS = [
+    {'path': ['税务师', '税法一', '第二章增值税'], 'content': '<p>下列关于增值税进项税额抵扣的说法正确的是</p>',
+     'options': ['A.购进免税农产品可以抵扣', 'B.用于集体福利的不得抵扣'],
+     'textAnalysis': 'B<p>用于集体福利的购进货物，其进项税额不得抵扣<img src="http://img.wangxiao.cn/a.png"></p>'},
+    {'path': ['税务师', '税法二', '第六章车船税'], 'content': '<p>车船税的纳税义务发生时间为</p>',
+     'options': ['A.取得车船所有权的当月', 'B.取得车船所有权的次月'], 'textAnalysis': 'A<p>当月</p>'},
+    {'path': ['注册会计师', '税法', '第二章增值税'], 'content': '<p>增值税一般纳税人销售自产货物的税率</p>',
+     'options': ['A.13%', 'B.9%'], 'textAnalysis': 'A<p>适用13%税率</p>'},
+    # 没有解析，导出时过滤掉
+    {'path': ['税务师', '税法一', '第二章增值税'], 'content': '<p>增值税没有解析的题</p>', 'options': []},
+]
+
+
+def build(tmp_path, items=ITEMS, **kwargs):
+    index = SQLiteSearchIndex(str(tmp_path / 'questions.sqlite3'))
+    client = fakeredis.FakeRedis(decode_responses=True)
+    client.rpush(KEY, *[json.dumps(item, ensure_ascii=False) for item in items])
+    index.redis = client
+    index.init_redis = lambda: None
+    index.build(**kwargs)
+    return index
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = build(tmp_path)
+    yield index
+    index.close()
+
+
+def ids(rows):
+    return sorted(row[0] for row in rows)
+
+
+def test_trigram_matches_any_three_character_substring(index):
+    assert index.stats['inserted'] == 3 and index.stats['discarded'] == 1
+    # 词中间的子串也能匹配，不需要分词
+    assert len(index.search('进项税额')) == 1
+    assert len(index.search('值税进')) == 1
+    assert len(index.search('增值税')) == 2
+    assert index.search('营业税') == []
+
+
+def test_terms_are_anded_and_short_terms_fall_back_to_like(index):
+    assert len(index.search('增值税 税率')) == 1
+    assert len(index.search('增值税 福利')) == 1
+    # 少于3个字的词trigram索引不到，改用LIKE过滤
+    assert len(index.search('当月')) == 1
+    assert len(index.search('车船税 次月')) == 1
+    assert index.search('增值税 次月') == []
+
+
+def test_options_and_analysis_are_indexed_without_markup(index):
+    assert len(index.search('集体福利')) == 1
+    assert len(index.search('免税农产品')) == 1
+    # img标签和选项JSON的引号不进入索引
+    assert index.search('wangxiao') == []
+    assert index.search('["A') == []
+
+
+def test_path_prefix_filter(index):
+    rows = index.search('增值税', path_prefix='税务师')
+    assert [row[1] for row in rows] == ['税务师->税法一->第二章增值税']
+    assert len(index.search('增值税', path_prefix='注册会计师->税法')) == 1
+    assert index.search('增值税', path_prefix='税务师->税法二') == []
+    # 只有路径条件也可以查询
+    assert len(index.search('', path_prefix='税务师')) == 2
+
+
+def test_snippet_highlights_the_match(index):
+    (row,) = index.search('进项税额')
+    assert '【进项税额】' in row[2]
+
+
+def test_rebuild_replaces_fts_rows_instead_of_duplicating(tmp_path):
+    build(tmp_path).close()
+    changed = [dict(ITEMS[0], textAnalysis='B<p>修改后的解析：不得抵扣进项税额</p>')] + ITEMS[1:]
+    index = build(tmp_path, changed, resume=False)
+    assert index.stats['updated'] == 3 and index.stats['inserted'] == 0
+    assert len(index.search('修改后的解析')) == 1
+    assert index.search('购进货物') == []
+    assert index.db.execute("SELECT COUNT(*) FROM questions_fts").fetchone()[0] == 3
+    index.close()
+
+
+def test_reconcile_only_touches_roots_merged_since_the_last_build(tmp_path):
+    dedup_db = str(tmp_path / 'dedup.sqlite3')
+    client = fakeredis.FakeRedis(decode_responses=True)
+
+    def push(content, chapter):
+        item = {'path': ['税务师', '税法一', chapter], 'content': f'<p>{content}</p>', 'options': [],
+                'textAnalysis': 'A<p>解析</p>'}
+        client.rpush(KEY, json.dumps(item, ensure_ascii=False))
+
+    def run():
+        dedup = DedupIndex(dedup_db, threshold=0.7)
+        dedup.redis = client
+        dedup.init_redis = lambda: None
+        dedup.build()
+        dedup.close()
+
+        index = SQLiteSearchIndex(str(tmp_path / 'questions.sqlite3'))
+        index.redis = client
+        index.init_redis = lambda: None
+        statements = []
+        index.db.set_trace_callback(statements.append)
+        index.build(canonical=True, dedup_db=dedup_db)
+        index.db.set_trace_callback(None)
+        rows = index.db.execute("SELECT canonical_id, paths FROM questions ORDER BY id").fetchall()
+        stats = index.stats
+        index.close()
+        return rows, stats, statements
+
+    push(X, '第一节')
+    push(Y, '第二节')
+    rows, stats, _ = run()
+    assert [row[0] for row in rows] == [0, 1]
+
+    # Z把两组合并：Y那一行并入规范行0
+    push(Z, '第三节')
+    rows, stats, _ = run()
+    assert stats['remerged'] == 1
+    assert len(rows) == 1 and rows[0][0] == 0
+    assert json.loads(rows[0][1]) == ['税务师->税法一->第一节', '税务师->税法一->第三节', '税务师->税法一->第二节']
+
+    # 没有新的合并：不再扫描questions表
+    rows, stats, statements = run()
+    assert stats['remerged'] == 0 and len(rows) == 1
+    assert not any('canonical_id IN' in sql or 'canonical_id IS NOT NULL' in sql for sql in statements)
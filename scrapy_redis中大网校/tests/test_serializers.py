@@ -0,0 +1,111 @@
+import pickle
+
+import fakeredis
+import pytest
+from scrapy import Request
+from scrapy.utils.request import request_from_dict
+from scrapy.utils.test import get_crawler
+
+from wangxiao_scrapy import serializers
+from wangxiao_scrapy.scheduler import Scheduler
+from wangxiao_scrapy.serializers import InternTable, RequestCodec
+from wangxiao_scrapy.spiders.questions import QuestionsSpider
+
+KEY = 'questions:intern'
+
+
+def list_questions_request(subsign, path_tail='一、征税范围的一般规定'):
+    return Request(
+        url=f'https://ks.wangxiao.cn/practice/listQuestions?subsign={subsign}',
+        method='POST',
+        body=b'{"sign":"p111","top":"35"}',
+        headers={'x-requested-with': 'XMLHttpRequest', 'Content-Type': 'application/json; charset=UTF-8'},
+        cookies={'token': 'secret'},
+        meta={'first_title': '税务师', 'second_title': '税法一', 'page': None, 'top': '35',
+              'father_names': ['税务师', '税法一', '第一章增值税', path_tail]},
+        priority=200,
+    )
+
+
+def round_trip(codec, request):
+    spider = QuestionsSpider()
+    raw = codec.dumps(request.to_dict(spider=spider))
+    return raw, request_from_dict(codec.loads(raw), spider=spider)
+
+
+@pytest.mark.parametrize('use_msgpack, compression', [(True, 'zlib'), (False, 'zlib'), (True, 'none'), (False, 'none')])
+def test_round_trip(use_msgpack, compression):
+    server = fakeredis.FakeStrictRedis()
+    codec = RequestCodec(InternTable(server, KEY), compression=compression, use_msgpack=use_msgpack)
+    request = list_questions_request('a')
+    raw, restored = round_trip(codec, request)
+
+    assert raw[0] & 0x0F == (serializers.FORMAT_MSGPACK if use_msgpack else serializers.FORMAT_JSON)
+    for attr in ('url', 'method', 'body', 'priority', 'dont_filter'):
+        assert getattr(restored, attr) == getattr(request, attr)
+    assert restored.headers == request.headers
+    assert restored.meta == {**request.meta, serializers.COOKIE_FLAG: True}
+    # Cookie不入队
+    assert restored.cookies == {}
+    assert b'secret' not in raw
+
+    # 另一个进程（新的本地缓存）从Redis中的intern表解码
+    other = RequestCodec(InternTable(server, KEY), compression=compression, use_msgpack=use_msgpack)
+    assert other.loads(raw)['meta']['father_names'] == request.meta['father_names']
+
+
+def test_only_reused_values_are_interned():
+    server = fakeredis.FakeStrictRedis()
+    codec = RequestCodec(InternTable(server, KEY))
+    for subsign in range(50):
+        raw, restored = round_trip(codec, list_questions_request(subsign, path_tail=f'考点{subsign}'))
+        assert restored.url.endswith(f'subsign={subsign}')
+
+    values = {field.decode() for field in server.hkeys(KEY) if field.startswith(b'v:')}
+    # 请求头、路径前缀、两个标题各登记一次，URL和考点名不进入intern表
+    assert len(values) == 4
+    assert not any('listQuestions' in value or '考点' in value for value in values)
+
+
+def test_legacy_pickle_entries_still_load():
+    codec = RequestCodec(InternTable(fakeredis.FakeStrictRedis(), KEY))
+    legacy = list_questions_request('old').to_dict(spider=QuestionsSpider())
+    raw = pickle.dumps(legacy, protocol=-1)
+    assert codec.loads(raw) == legacy
+
+
+def test_legacy_interned_url_still_loads():
+    server = fakeredis.FakeStrictRedis()
+    table = InternTable(server, KEY)
+    codec = RequestCodec(table)
+    obj = list_questions_request('old').to_dict(spider=QuestionsSpider())
+    record = codec.compact(obj)
+    # 旧版本的记录中URL是intern id
+    record[serializers.FIELDS.index('url')] = table.id_of(obj['url'])
+    assert codec.expand(record)['url'] == obj['url']
+
+
+def test_scheduler_uses_crawler_settings_and_clears_intern_table_on_flush(monkeypatch):
+    server = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('scrapy_redis.connection.from_settings', lambda settings: server)
+    monkeypatch.setattr('scrapy_redis.dupefilter.get_redis_from_settings', lambda settings: server)
+    monkeypatch.setattr(serializers, '_codec', None)
+    crawler = get_crawler(QuestionsSpider, settings_dict={
+        'SCHEDULER_SERIALIZER': 'wangxiao_scrapy.serializers',
+        'DUPEFILTER_CLASS': 'scrapy_redis.dupefilter.RFPDupeFilter',
+        # 相当于 -s 或者爬虫的custom_settings
+        'SERIALIZER_INTERN_KEY': 'run:intern',
+        'SERIALIZER_USE_MSGPACK': False,
+        'SCHEDULER_FLUSH_ON_START': True,
+    })
+    scheduler = Scheduler.from_crawler(crawler)
+    codec = serializers.get_codec()
+    assert codec.intern.key == 'run:intern'
+    assert not codec.use_msgpack
+
+    serializers.dumps(list_questions_request('a').to_dict(spider=QuestionsSpider()))
+    assert server.exists('run:intern')
+
+    scheduler.open(crawler._create_spider())
+    assert not server.exists('run:intern')
+    assert codec.intern.ids == {}
@@ -3,10 +3,13 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import json
+import time
+import random
+
 from scrapy import signals
 
-# useful for handling different item types with a single interface
-from itemadapter import ItemAdapter
 from fake_useragent import UserAgent
 
 class WangxiaoScrapySpiderMiddleware:
@@ -66,7 +69,7 @@ class WangxiaoScrapyDownloaderMiddleware:
         return s
 
     def process_request(self, request, spider):
-        request.headers["User-Agent"] = UserAgent().random
+        # User-Agent由UserAgentPoolMiddleware设置
         return None
 
     def process_response(self, request, response, spider):
@@ -90,3 +93,178 @@ class WangxiaoScrapyDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class UserAgentPoolMiddleware:
+    """从预先加载的User-Agent池中选择UA
+
+    UserAgent()每次创建都会重新读取并解析整个浏览器数据集，所以只在启动时加载一次，
+    按使用占比展开成一个加权数组，每个请求只需要随机取一个下标；
+    开启USER_AGENT_POOL_STICKY时同一个Cookie会话（meta['cookiejar']，没有时是默认会话）始终使用同一个UA，
+    登录后的会话不会中途换浏览器
+    """
+
+    def __init__(self, browsers=None, platforms=None, min_percentage=0.0, size=1000, sticky=True, fallback=None):
+        self.pool = self.build_pool(browsers, platforms, min_percentage, size) or list(fallback or [])
+        self.sticky = sticky
+        # {cookiejar: UA}
+        self.sessions = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        s = cls(
+            browsers=settings.getlist('USER_AGENT_POOL_BROWSERS'),
+            platforms=settings.getlist('USER_AGENT_POOL_PLATFORMS'),
+            min_percentage=settings.getfloat('USER_AGENT_POOL_MIN_PERCENTAGE', 0.0),
+            size=settings.getint('USER_AGENT_POOL_SIZE', 1000),
+            sticky=settings.getbool('USER_AGENT_POOL_STICKY', True),
+            fallback=settings.getlist('USER_AGENT_POOL_FALLBACK'),
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    @staticmethod
+    def build_pool(browsers, platforms, min_percentage, size):
+        """读取fake_useragent的数据集，按占比展开成加权数组（总长度不超过约size，占比太低、不足一个位置的UA不进入池）"""
+        try:
+            data = UserAgent().data_browsers
+        except Exception:
+            return []
+
+        candidates = [
+            entry for entry in data
+            if (not browsers or entry['browser'] in browsers)
+            and (not platforms or entry['type'] in platforms)
+            and entry['percent'] >= min_percentage
+        ]
+        total = sum(entry['percent'] for entry in candidates)
+        if not total:
+            return []
+
+        pool = []
+        for entry in sorted(candidates, key=lambda entry: entry['percent'], reverse=True):
+            pool.extend([entry['useragent']] * round(entry['percent'] / total * size))
+        # 数据集很分散时每一项都不足一个位置，至少保留占比最高的
+        return pool or [max(candidates, key=lambda entry: entry['percent'])['useragent']]
+
+    def choose(self, request):
+        if not self.sticky:
+            return random.choice(self.pool)
+
+        session = request.meta.get('cookiejar')
+        user_agent = self.sessions.get(session)
+        if user_agent is None:
+            user_agent = self.sessions[session] = random.choice(self.pool)
+        return user_agent
+
+    def process_request(self, request, spider):
+        # 请求自己指定了UA（包括重试时保留下来的）时不覆盖
+        if self.pool and b'User-Agent' not in request.headers:
+            request.headers['User-Agent'] = self.choose(request)
+        return None
+
+    def spider_opened(self, spider):
+        spider.logger.info(f"User-Agent池: {len(self.pool)} 项（去重后 {len(set(self.pool))} 个），"
+                           f"{'每个Cookie会话固定一个UA' if self.sticky else '每个请求随机'}")
+
+
+class CookieInjectionMiddleware:
+    """给带有inject_cookies标记的请求注入当前的Cookie，并在Cookie更新后热替换
+
+    Cookie不随请求进入scrapy_redis队列（见serializers.py），出队后在这里补上；
+    必须排在Scrapy的CookiesMiddleware（700）之前
+
+    Cookie来源是COOKIE_FILE（cookie_get.py写的cookies_latest.json，按修改时间判断），
+    设置了COOKIE_REDIS_KEY时改为读Redis（按 <key>:version 版本号判断）；
+    每COOKIE_CHECK_INTERVAL秒最多检查一次，新Cookie完整读取后整体替换字典引用，
+    已经在队列中和正在下载的请求都不需要重新入队，之后出队的请求直接用新Cookie
+    """
+
+    def __init__(self, cookie_file=None, server=None, redis_key=None, check_interval=30.0):
+        self.cookie_file = cookie_file
+        self.server = server
+        self.redis_key = redis_key
+        self.check_interval = check_interval
+        self.cookies = {}
+        # 文件的 (mtime_ns, size) 或 Redis中的版本号
+        self.version = None
+        self.next_check = 0.0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        redis_key = settings.get('COOKIE_REDIS_KEY')
+        server = None
+        if redis_key:
+            from scrapy_redis import connection
+            server = connection.from_settings(settings)
+        s = cls(
+            cookie_file=settings.get('COOKIE_FILE'),
+            server=server,
+            redis_key=redis_key,
+            check_interval=settings.getfloat('COOKIE_CHECK_INTERVAL', 30.0),
+        )
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def current_version(self):
+        if self.server:
+            version = self.server.get(f"{self.redis_key}:version")
+            return int(version) if version is not None else None
+        try:
+            stat = os.stat(self.cookie_file)
+        except (OSError, TypeError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read_cookies(self):
+        """读取完整的Cookie数据，格式和cookies_latest.json相同：{"cookies": {...}, "metadata": {...}}"""
+        if self.server:
+            # 数据和版本号放在同一个事务里读，保证两者对应
+            pipe = self.server.pipeline(transaction=True)
+            pipe.get(self.redis_key)
+            pipe.get(f"{self.redis_key}:version")
+            raw, version = pipe.execute()
+            version = int(version) if version is not None else None
+        else:
+            version = self.current_version()
+            with open(self.cookie_file, 'r', encoding='utf-8') as f:
+                raw = f.read()
+        return json.loads(raw).get('cookies', {}), version
+
+    def reload(self, spider, force=False):
+        """版本变化时读取新Cookie，读取失败（比如文件正在写入）时继续用旧的，下次再试"""
+        now = time.monotonic()
+        if not force and now < self.next_check:
+            return
+        self.next_check = now + self.check_interval
+
+        try:
+            version = self.current_version()
+            if version is None or version == self.version:
+                return
+            cookies, version = self.read_cookies()
+        except Exception as e:
+            spider.logger.warning(f"读取Cookie失败，继续使用旧的Cookie: {e}")
+            return
+
+        if not cookies:
+            spider.logger.warning("新的Cookie为空，继续使用旧的Cookie")
+            return
+        # 只替换引用，正在使用旧字典的请求不受影响
+        self.cookies = cookies
+        self.version = version
+        spider.cookies = cookies
+        spider.logger.info(f"🍪 已加载 {len(cookies)} 条Cookie（{self.redis_key or self.cookie_file}）")
+
+    def process_request(self, request, spider):
+        if request.meta.get('inject_cookies'):
+            self.reload(spider)
+            request.cookies = self.cookies
+        return None
+
+    def spider_opened(self, spider):
+        self.reload(spider, force=True)
+        if not self.cookies:
+            spider.logger.warning(f"Cookie不存在或加载失败（{self.redis_key or self.cookie_file}）")
@@ -0,0 +1,26 @@
+"""
+scrapy_redis调度器（settings.py 中 SCHEDULER = 'wangxiao_scrapy.scheduler.Scheduler'）
+
+在scrapy_redis.scheduler.Scheduler的基础上：
+    - 按crawler.settings创建serializers的编码器，爬虫的custom_settings和命令行 -s 的设置都会生效
+    - 清空队列时（SCHEDULER_FLUSH_ON_START，或者SCHEDULER_PERSIST = False时关闭爬虫）一起删除intern表，
+      intern表不会比引用它的请求活得更久
+"""
+from scrapy_redis import scheduler
+
+from . import serializers
+
+
+class Scheduler(scheduler.Scheduler):
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        instance = super().from_crawler(crawler)
+        if instance.serializer is serializers:
+            serializers.configure(crawler.settings, instance.server)
+        return instance
+
+    def flush(self):
+        super().flush()
+        if self.serializer is serializers:
+            serializers.get_codec().intern.clear()
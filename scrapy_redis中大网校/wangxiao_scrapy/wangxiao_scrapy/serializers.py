@@ -0,0 +1,261 @@
+"""
+scrapy_redis调度队列的请求序列化（settings.py 中 SCHEDULER_SERIALIZER = 'wangxiao_scrapy.serializers'）
+
+默认的picklecompat把整个请求字典pickle后放进Redis，每个listQuestions请求都带着完整的Cookie、
+请求头和路径，几十万个待处理请求会占用几个G。这里改为：
+    - 请求字典按固定字段顺序编码成列表，有msgpack时用msgpack（requirements.txt中已列出），
+      没有安装时自动改用紧凑的JSON，只是体积稍大
+    - 会被大量请求重复使用的值：请求头集合、路径前缀（father_names去掉最后一级）、first_title/second_title
+      在Redis哈希（SERIALIZER_INTERN_KEY）中登记一次，队列里只存一个整数id；URL每个请求都不同，直接存在队列中
+    - Cookie不入队，只留一个标记，下载前由CookieInjectionMiddleware换成spider.cookies
+    - 超过COMPRESS_MIN_BYTES的数据按SERIALIZER_COMPRESSION压缩（zlib，装了zstandard时可以用zstd）
+
+每条数据的第一个字节是格式标记；旧版本pickle的数据以0x80开头，照常用pickle读取，
+升级后队列中已有的请求不受影响。含有无法编码的meta的请求也会退回pickle
+
+intern表的生命周期和调度队列相同：wangxiao_scrapy.scheduler.Scheduler按爬虫的settings（包括custom_settings和-s）
+创建编码器，SCHEDULER_FLUSH_ON_START清空队列时一起删除intern表；队列中还有请求时不要手动删除SERIALIZER_INTERN_KEY
+"""
+import json
+import base64
+import pickle
+import zlib
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 格式标记：低4位是编码，高4位是压缩方式；pickle协议2以上的数据第一个字节是0x80，不会冲突
+FORMAT_MSGPACK = 0x01
+FORMAT_JSON = 0x02
+COMPRESS_ZLIB = 0x10
+COMPRESS_ZSTD = 0x20
+PICKLE_PREFIX = 0x80
+
+# 编码后超过这个大小才压缩，太小的数据压缩后反而更大
+COMPRESS_MIN_BYTES = 256
+
+# 请求字典按这个顺序编码成列表，其它字段放在最后的extra中
+FIELDS = ('url', 'callback', 'errback', 'headers', 'method', 'body', 'meta', 'priority', 'dont_filter', 'flags',
+          'cb_kwargs', 'encoding')
+# meta中登记到intern表的字段
+INTERNED_META = ('first_title', 'second_title')
+# 请求原本带有Cookie的标记，CookieInjectionMiddleware看到后注入spider.cookies
+COOKIE_FLAG = 'inject_cookies'
+# 编码后的meta中路径前缀的key
+PATH_PREFIX_KEY = '_path_prefix'
+
+
+class InternTable:
+    """字符串 <-> 整数id，保存在Redis哈希中，多个爬虫进程共用
+
+    v:<字符串> -> id，i:<id> -> 字符串，__next__ 是id计数器
+    """
+
+    def __init__(self, server, key):
+        self.server = server
+        self.key = key
+        self.ids = {}
+        self.values = {}
+
+    @staticmethod
+    def text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def id_of(self, value):
+        if value in self.ids:
+            return self.ids[value]
+
+        found = self.server.hget(self.key, 'v:' + value)
+        if found is None:
+            new_id = self.server.hincrby(self.key, '__next__', 1)
+            self.server.hset(self.key, f'i:{new_id}', value)
+            # 其它进程同时登记了同一个字符串时以先写入的为准，自己的id也仍然可以解码
+            if self.server.hsetnx(self.key, 'v:' + value, new_id):
+                found = new_id
+            else:
+                found = self.server.hget(self.key, 'v:' + value)
+
+        intern_id = int(found)
+        self.ids[value] = intern_id
+        self.values[intern_id] = value
+        return intern_id
+
+    def clear(self):
+        """删除整个intern表（只能在队列也被清空时调用）"""
+        self.server.delete(self.key)
+        self.ids.clear()
+        self.values.clear()
+
+    def value_of(self, intern_id):
+        if intern_id not in self.values:
+            value = self.server.hget(self.key, f'i:{intern_id}')
+            if value is None:
+                raise KeyError(f"intern表 {self.key} 中没有id {intern_id}，可能已被删除")
+            self.values[intern_id] = self.text(value)
+        return self.values[intern_id]
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {'__b64__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"无法编码 {type(value).__name__}")
+
+
+def _json_hook(obj):
+    if len(obj) == 1 and '__b64__' in obj:
+        return base64.b64decode(obj['__b64__'])
+    return obj
+
+
+def headers_key(headers):
+    """请求头集合的规范文本（key排序），作为intern的字符串"""
+    pairs = sorted([key.decode('latin-1'), [value.decode('latin-1') for value in values]]
+                   for key, values in headers.items())
+    return json.dumps(pairs, ensure_ascii=False, separators=(',', ':'))
+
+
+def headers_from_key(text):
+    return {key.encode('latin-1'): [value.encode('latin-1') for value in values] for key, values in json.loads(text)}
+
+
+class RequestCodec:
+
+    def __init__(self, intern_table, compression='zlib', use_msgpack=True):
+        self.intern = intern_table
+        self.use_msgpack = use_msgpack and msgpack is not None
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("没有安装zstandard，请求序列化改用zlib压缩")
+            compression = 'zlib'
+        self.compression = compression if compression in ('zlib', 'zstd') else None
+
+    def compact(self, obj):
+        """请求字典 -> 按FIELDS排列的列表，可以intern的字段换成id"""
+        meta = dict(obj.get('meta') or {})
+        if obj.get('cookies'):
+            meta[COOKIE_FLAG] = True
+
+        path = meta.get('father_names')
+        if isinstance(path, list) and len(path) > 1 and all(isinstance(name, str) for name in path):
+            meta[PATH_PREFIX_KEY] = self.intern.id_of(json.dumps(path[:-1], ensure_ascii=False))
+            meta['father_names'] = path[-1]
+        for key in INTERNED_META:
+            if isinstance(meta.get(key), str):
+                meta['_' + key] = self.intern.id_of(meta.pop(key))
+
+        record = []
+        for field in FIELDS:
+            value = obj.get(field)
+            if field == 'headers':
+                value = self.intern.id_of(headers_key(value or {}))
+            elif field == 'meta':
+                value = meta
+            record.append(value)
+        record.append({key: value for key, value in obj.items() if key not in FIELDS and key != 'cookies'})
+        return record
+
+    def expand(self, record):
+        """compact的逆操作"""
+        obj = dict(zip(FIELDS, record))
+        obj.update(record[len(FIELDS)])
+        # 旧版本把URL也登记到intern表，队列中剩下的这种请求照常解码
+        if isinstance(obj['url'], int):
+            obj['url'] = self.intern.value_of(obj['url'])
+        obj['headers'] = headers_from_key(self.intern.value_of(obj['headers']))
+
+        meta = obj['meta']
+        if PATH_PREFIX_KEY in meta:
+            meta['father_names'] = json.loads(self.intern.value_of(meta.pop(PATH_PREFIX_KEY))) + [meta['father_names']]
+        for key in INTERNED_META:
+            if '_' + key in meta:
+                meta[key] = self.intern.value_of(meta.pop('_' + key))
+        # Cookie由CookieInjectionMiddleware在下载前注入
+        obj['cookies'] = {}
+        return obj
+
+    def dumps(self, obj):
+        try:
+            record = self.compact(obj)
+            if self.use_msgpack:
+                fmt, data = FORMAT_MSGPACK, msgpack.packb(record, use_bin_type=True)
+            else:
+                fmt, data = FORMAT_JSON, json.dumps(record, ensure_ascii=False, separators=(',', ':'),
+                                                    default=_json_default).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            logger.debug(f"请求无法紧凑编码，改用pickle: {e}")
+            return pickle.dumps(obj, protocol=-1)
+
+        if self.compression and len(data) > COMPRESS_MIN_BYTES:
+            if self.compression == 'zstd':
+                compressed, flag = zstandard.ZstdCompressor().compress(data), COMPRESS_ZSTD
+            else:
+                compressed, flag = zlib.compress(data), COMPRESS_ZLIB
+            if len(compressed) < len(data):
+                fmt, data = fmt | flag, compressed
+        return bytes([fmt]) + data
+
+    def loads(self, raw):
+        if raw[0] == PICKLE_PREFIX:
+            return pickle.loads(raw)
+
+        fmt, data = raw[0], raw[1:]
+        if fmt & COMPRESS_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("队列中有zstd压缩的请求，需要安装zstandard")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif fmt & COMPRESS_ZLIB:
+            data = zlib.decompress(data)
+
+        if fmt & 0x0F == FORMAT_MSGPACK:
+            if msgpack is None:
+                raise RuntimeError("队列中有msgpack编码的请求，需要安装msgpack")
+            record = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        else:
+            record = json.loads(data.decode('utf-8'), object_hook=_json_hook)
+        return self.expand(record)
+
+
+_codec = None
+
+
+def configure(settings, server=None):
+    """按爬虫的settings创建编码器，由wangxiao_scrapy.scheduler.Scheduler在创建时调用"""
+    global _codec
+    if server is None:
+        from scrapy_redis import connection
+        server = connection.from_settings(settings)
+    _codec = RequestCodec(
+        InternTable(server, settings.get('SERIALIZER_INTERN_KEY', 'questions:intern')),
+        compression=settings.get('SERIALIZER_COMPRESSION', 'zlib'),
+        use_msgpack=settings.getbool('SERIALIZER_USE_MSGPACK', True),
+    )
+    return _codec
+
+
+def get_codec():
+    """当前的编码器
+
+    scrapy_redis把本模块当作serializer使用，拿不到crawler，编码器由调度器按crawler.settings创建；
+    没有经过调度器（例如在脚本中直接读取队列）时才按项目settings创建
+    """
+    if _codec is None:
+        from scrapy.utils.project import get_project_settings
+        configure(get_project_settings())
+    return _codec
+
+
+def loads(s):
+    return get_codec().loads(s)
+
+
+def dumps(obj):
+    return get_codec().dumps(obj)
@@ -14,7 +14,10 @@ from config import (
     REDIS_PORT,
     REDIS_DB,
     REDIS_PARAMS,
-    RESULTS_DIR
+    RESULTS_DIR,
+    # Cookie
+    COOKIE_LATEST_FILE,
+    COOKIE_REDIS_KEY
 )
 
 
@@ -42,12 +45,18 @@ REDIS_HOST = REDIS_HOST
 REDIS_PORT = REDIS_PORT
 REDIS_DB = REDIS_DB
 REDIS_PARAMS = REDIS_PARAMS
-SCHEDULER = 'scrapy_redis.scheduler.Scheduler'
+# scrapy_redis的调度器，另外负责按爬虫的settings创建请求编码器、清空队列时一起清空intern表
+SCHEDULER = 'wangxiao_scrapy.scheduler.Scheduler'
 SCHEDULER_PERSIST = True
 DUPEFILTER_CLASS = 'scrapy_redis.dupefilter.RFPDupeFilter'
 
 
 SCHEDULER_QUEUE_CLASS = 'scrapy_redis.queue.PriorityQueue'
+# 队列中请求的序列化：紧凑编码 + intern + 压缩，Cookie不入队（由CookieInjectionMiddleware注入）
+SCHEDULER_SERIALIZER = 'wangxiao_scrapy.serializers'
+SERIALIZER_INTERN_KEY = 'questions:intern'  # 请求头、路径前缀、标题的intern表，SCHEDULER_FLUSH_ON_START时随队列一起清空
+SERIALIZER_COMPRESSION = 'zlib'  # zlib / zstd（需要安装zstandard）/ none
+SERIALIZER_USE_MSGPACK = True  # 没有安装msgpack时自动改用JSON
 
 # 并发和性能配置
 CONCURRENT_REQUESTS = 16  # 全局并发请求数
@@ -62,6 +71,15 @@ RETRY_ENABLED = True
 RETRY_TIMES = 5  # 最大重试次数
 RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429, 403]
 
+# listQuestions分页：考点的题目数超过这个值时拆成多页并发请求，每页到了就开始产出item；0表示不分页（一次请求全部题目）
+LIST_QUESTIONS_PAGE_SIZE = 0
+# 页码参数名和第一页的页码。接口是否接受分页参数还没有确认：开启后如果各页返回的题目相同，
+# 会打印警告、对这个考点改为一次请求全部题目，之后的考点也不再分页
+LIST_QUESTIONS_PAGE_PARAM = 'pageIndex'
+LIST_QUESTIONS_PAGE_START = 1
+# 记录“接口忽略分页参数”的Redis键，所有worker共用，留空时为 <spider>:paging_ignored；确认接口支持分页后可以删除这个键
+LIST_QUESTIONS_PAGING_IGNORED_KEY = ''
+
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED = False
 # 启用深度优先
@@ -86,9 +104,31 @@ SCHEDULER_MEMORY_QUEUE = 'scrapy.squeues.FifoMemoryQueue'
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
+   # 在Scrapy自带的UserAgentMiddleware（500）之前设置UA
+   "wangxiao_scrapy.middlewares.UserAgentPoolMiddleware": 400,
+   # 在Scrapy自带的CookiesMiddleware（700）之前注入Cookie
+   "wangxiao_scrapy.middlewares.CookieInjectionMiddleware": 650,
    "wangxiao_scrapy.middlewares.WangxiaoScrapyDownloaderMiddleware": 543,
 }
 
+# Cookie热更新：cookie_get.py定时刷新登录后，运行中的爬虫自动换上新Cookie，不需要重启
+COOKIE_FILE = COOKIE_LATEST_FILE  # 监视这个文件的修改时间
+COOKIE_REDIS_KEY = COOKIE_REDIS_KEY  # 不为空时改为监视Redis中的版本号（<key>:version）
+COOKIE_CHECK_INTERVAL = 30  # 最多每隔多少秒检查一次
+
+# User-Agent池：启动时从fake_useragent的数据集加载一次
+USER_AGENT_POOL_BROWSERS = ['Chrome', 'Edge', 'Firefox', 'Safari']  # 只用这些浏览器，留空表示不限
+USER_AGENT_POOL_PLATFORMS = ['desktop']  # desktop / mobile / tablet，留空表示不限
+USER_AGENT_POOL_MIN_PERCENTAGE = 0.0  # 忽略使用占比低于这个值的UA
+USER_AGENT_POOL_SIZE = 1000  # 加权数组的长度，越大占比越精确
+USER_AGENT_POOL_STICKY = True  # 同一个Cookie会话固定使用同一个UA
+# 数据集加载失败或过滤后为空时使用
+USER_AGENT_POOL_FALLBACK = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36 Edg/122.0.0.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:123.0) Gecko/20100101 Firefox/123.0',
+]
+
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
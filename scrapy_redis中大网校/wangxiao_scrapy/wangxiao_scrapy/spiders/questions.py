@@ -2,9 +2,83 @@ import scrapy
 from scrapy_redis.spiders import RedisSpider,RedisCrawlSpider
 from scrapy.linkextractors import LinkExtractor
 import json
-from pathlib import Path
+import hashlib
+from lxml import etree
 from ..items import WangxiaoScrapyItem
 
+# 名称里要去掉的空白字符
+_NAME_STRIP = str.maketrans('', '', ' \n\t\r')
+# 考点所在的章、节
+FATHER_CLASSES = ('section-item', 'chapter-item')
+
+
+def fl_items(ul):
+    """ul下class为fl的li（相当于 ./li[@class="fl"]）"""
+    return [li for li in ul.iterchildren('li') if li.get('class') == 'fl']
+
+
+def direct_texts(element):
+    """元素自己的文本节点（相当于 ./text()）"""
+    texts = [element.text] + [child.tail for child in element]
+    return [text for text in texts if text]
+
+
+def point_name(ul):
+    """第一个li.fl的文本去掉空白"""
+    items = fl_items(ul)
+    return ''.join(direct_texts(items[0]) if items else []).translate(_NAME_STRIP)
+
+
+def point_params(ul):
+    """(data_sign, data_subsign, 题目数量)"""
+    items = fl_items(ul)
+    texts = direct_texts(items[1]) if len(items) > 1 else []
+    data_number = (texts[0] if texts else None).split('/')[1]
+    spans = [span for li in items for span in li.iterchildren('span')]
+    data_sign = next((span.get('data_sign') for span in spans if span.get('data_sign') is not None), None)
+    data_subsign = next((span.get('data_subsign') for span in spans if span.get('data_subsign') is not None), None)
+    return data_sign, data_subsign, data_number
+
+
+def iter_exam_points(root, first_title, second_title):
+    """深度优先遍历一次章节树，依次返回每个考点的 (路径, data_sign, data_subsign, 题目数量)
+
+    有两种页面：
+    - 章 > 节 > 考点（ul.section-point-item）：路径是 [一级标题, 二级标题, 各级章节..., 考点]
+    - 只有章（ul.chapter-item），没有考点：路径是 [二级标题, 二级标题, 章]
+    进入章节时把名称压栈、离开时出栈，每个节点只提取和清洗一次
+    """
+    flat_points = []
+    found_points = False
+    for body in root.iterchildren('body'):
+        for top in body:
+            # 考点只在 /html/body/div 下面找
+            in_div = top.tag == 'div'
+            stack = []
+            for event, ul in etree.iterwalk(top, events=('start', 'end'), tag='ul'):
+                ul_class = ul.get('class')
+                if event == 'end':
+                    if in_div and ul_class in FATHER_CLASSES:
+                        stack.pop()
+                    continue
+
+                if in_div and ul_class == 'section-point-item':
+                    found_points = True
+                    father_names = [first_title, second_title] + stack + [point_name(ul)]
+                    yield (father_names, *point_params(ul))
+                elif not found_points and ul_class == 'chapter-item' and ul.getparent().tag == 'div':
+                    flat_points.append(ul)
+
+                if in_div and ul_class in FATHER_CLASSES:
+                    stack.append(point_name(ul))
+
+    if found_points:
+        return
+    for ul in flat_points:
+        father_names = [second_title, second_title, point_name(ul)]
+        yield (father_names, *point_params(ul))
+
+
 class QuestionsSpider(RedisSpider):
     name = "questions"
     allowed_domains = ["ks.wangxiao.cn"]
@@ -13,25 +87,15 @@ class QuestionsSpider(RedisSpider):
 
     def __init__(self,*args,**kwargs):
         super(QuestionsSpider,self).__init__(*args,**kwargs)
-        self.cookies = self.load_cookies_from_file()
-
-
-    def load_cookies_from_file(self):
-        """从文件加载Cookie"""
-        PROJECT_ROOT = Path(__file__).resolve().parents[3]
-        cookie_file = PROJECT_ROOT / "results" / "cookies_latest.json"
-        if cookie_file.exists():
-            try:
-                with open(cookie_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    cookies = data.get('cookies', {})
-                    self.logger.info(f"✅ 从文件加载 {len(cookies)} 条Cookie")
-                    return cookies
-            except Exception as e:
-                self.logger.error(f"加载Cookie文件失败: {e}")
-
-        self.logger.warning("Cookie文件不存在或加载失败")
-        return {}
+        # Cookie由CookieInjectionMiddleware加载，cookie_get.py刷新登录后自动替换
+        self.cookies = {}
+        # 分页请求时每个考点还没到的页数和各页第一道题的指纹，用来发现接口忽略了分页参数；考点的页都到了就删除
+        self.page_heads = {}
+        # 接口忽略分页参数的标记放在Redis中，所有worker共用；这里只缓存已经发现的结果
+        self.paging_ignored = False
+        # 已经改为一次请求全部题目的考点
+        self.refetched = set()
+
 
     def parse(self, response,**kwargs):
         self.logger.info('开始解析-->获取题目类型url')
@@ -76,41 +140,31 @@ class QuestionsSpider(RedisSpider):
         meta = response.meta.copy()
         post_url = "https://ks.wangxiao.cn/practice/listQuestions"
 
-        son_points = response.xpath('/html/body/div//ul[@class="section-point-item"]')
-        if son_points:
-            for son_point in son_points:
-                father_points = son_point.xpath('ancestor::ul[@class="section-item" or @class="chapter-item"]')
-                father_names = [meta['first_title'],meta['second_title']]
-                for father_point in father_points:
-                    father_name = father_point.xpath('./li[@class="fl"][1]/text()').extract()
-
-                    father_name = ''.join(father_name).replace(' ','').replace('\n','').replace('\t','').replace('\r','')
-                    father_names.append(father_name)
-
-                son_name = son_point.xpath('./li[@class="fl"][1]/text()').extract()
-                son_name = ''.join(son_name).replace(' ','').replace('\n','').replace('\t','').replace('\r','')
-                father_names.append(son_name)
-                meta['father_names'] = father_names
-                # print('第一',father_names)
-                # 接下来就是找参数了
-                # 把那几个参数找到然后丢接口，然后发送请求
-                data_number = son_point.xpath('./li[@class="fl"][2]/text()').extract_first().split('/')[1]
-                data_sign = son_point.xpath('./li[@class="fl"]/span/@data_sign').extract_first()
-                data_subsign = son_point.xpath('./li[@class="fl"]/span/@data_subsign').extract_first()
-                # print('第一',data_number,data_sign,data_subsign)
-                # 传参
+        # 章节/小节/考点的ul树只遍历一次，路径边走边拼
+        for father_names, data_sign, data_subsign, data_number in iter_exam_points(
+                response.selector.root, meta['first_title'], meta['second_title']):
+            meta['father_names'] = father_names
+            # 把那几个参数找到然后丢接口，然后发送请求
+            pages = self.list_question_pages(data_number)
+            meta['pages'] = len(pages)
+            for page, top in pages:
                 data_post = {
                     'examPointType':'',
                     'practiceType':'2',
                     'questionType':'',
                     'sign':data_sign,
                     'subsign':data_subsign,
-                    'top':data_number,
+                    'top':top,
                 }
+                meta['page'] = page
+                meta['top'] = data_number
+                # 下载前由CookieInjectionMiddleware注入当前的Cookie，请求本身不带Cookie
+                meta['inject_cookies'] = True
+                if page is not None:
+                    data_post[self.settings.get('LIST_QUESTIONS_PAGE_PARAM')] = page
                 yield scrapy.Request(url=post_url,
                                      method="POST",
                                      body=json.dumps(data_post),
-                                     cookies=self.cookies,
                                      headers={
                                          'x-requested-with': 'XMLHttpRequest',
                                          'accept':'application/json, text/javascript, */*; q=0.01',
@@ -121,43 +175,87 @@ class QuestionsSpider(RedisSpider):
                                      priority=200
                                      )
 
+    def list_question_pages(self, data_number):
+        """一个考点要发的 (页码, top)
 
-        else:
-            points = response.xpath('/html/body//div/ul[@class="chapter-item"]')
-            for point in points:
-                father_names = [meta['second_title'],meta['second_title']]
-                son_name = point.xpath('./li[@class="fl"][1]/text()').extract()
-                son_name = ''.join(son_name).replace(' ','').replace('\n','').replace('\t','').replace('\r','')
-                father_names.append(son_name)
-                meta['father_names'] = father_names
-                # print('第二',father_names)
-
-                data_number = point.xpath('./li[@class="fl"][2]/text()').extract_first().split('/')[1]
-                data_sign = point.xpath('./li[@class="fl"]/span/@data_sign').extract_first()
-                data_subsign = point.xpath('./li[@class="fl"]/span/@data_subsign').extract_first()
-                # print('第二',data_number,data_sign,data_subsign)
+        LIST_QUESTIONS_PAGE_SIZE为0或者题目数不超过一页时只发一个请求（页码为None），和原来一样；
+        否则按页拆成多个请求，由Scrapy并发下载，每一页到了就开始产出item
+        """
+        page_size = self.settings.getint('LIST_QUESTIONS_PAGE_SIZE', 0)
+        try:
+            total = int(data_number)
+        except ValueError:
+            total = 0
+        if page_size <= 0 or total <= page_size or self.is_paging_ignored():
+            return [(None, data_number)]
 
-                data_post = {
-                    'examPointType':'',
-                    'practiceType':'2',
-                    'questionType':'',
-                    'sign':data_sign,
-                    'subsign':data_subsign,
-                    'top':data_number,
-                }
-                yield scrapy.Request(url=post_url,
-                                     method="POST",
-                                     body=json.dumps(data_post),
-                                     cookies=self.cookies,
-                                     headers={
-                                         'x-requested-with': 'XMLHttpRequest',
-                                         'accept':'application/json, text/javascript, */*; q=0.01',
-                                         'Content-Type':'application/json; charset=UTF-8'
-                                     },
-                                     callback=self.parse_get_json,
-                                     meta=meta,
-                                     priority=200
-                                     )
+        first = self.settings.getint('LIST_QUESTIONS_PAGE_START', 1)
+        pages = (total + page_size - 1) // page_size
+        return [(first + i, str(page_size)) for i in range(pages)]
+
+    @property
+    def paging_ignored_key(self):
+        return self.settings.get('LIST_QUESTIONS_PAGING_IGNORED_KEY') or f'{self.name}:paging_ignored'
+
+    def is_paging_ignored(self):
+        """是否已经有worker发现接口忽略了分页参数
+
+        Redis中记录的是当时的页码参数名，换了LIST_QUESTIONS_PAGE_PARAM之后会重新尝试分页
+        """
+        if not self.paging_ignored:
+            param = self.server.get(self.paging_ignored_key)
+            self.paging_ignored = param is not None and param.decode('utf-8') == self.settings.get('LIST_QUESTIONS_PAGE_PARAM')
+        return self.paging_ignored
+
+    def is_repeated_page(self, response, all_q):
+        """接口不支持分页参数时每一页返回的都是同样的题目，发现后丢弃重复页并停止分页
+
+        没有题目的页也要经过这里，考点的页都到了以后删除它的记录
+        """
+        page = response.meta.get('page')
+        if page is None:
+            return False
+
+        point = self.point_of(response)
+        state = self.page_heads.setdefault(point, {'left': response.meta.get('pages', 1), 'heads': {}})
+        state['left'] -= 1
+        if state['left'] <= 0:
+            del self.page_heads[point]
+        if not all_q:
+            return False
+
+        head = hashlib.sha1(json.dumps(all_q[0], sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+        first_page = state['heads'].setdefault(head, page)
+        if first_page == page:
+            return False
+
+        if not self.paging_ignored:
+            self.paging_ignored = True
+            param = self.settings.get('LIST_QUESTIONS_PAGE_PARAM')
+            self.server.set(self.paging_ignored_key, param)
+            self.logger.warning(f"⚠️ 第{page}页和第{first_page}页的题目相同，接口似乎不支持分页参数 "
+                                f"{param}，所有worker之后的考点都不再分页")
+        return True
+
+    @staticmethod
+    def point_of(response):
+        body = json.loads(response.request.body)
+        return body.get('sign'), body.get('subsign')
+
+    def unpaged_request(self, response):
+        """分页无效时，这个考点改为一次请求全部题目（只请求一次；先到的那一页会有重复的题，导出时去重）"""
+        point = self.point_of(response)
+        if point in self.refetched:
+            return None
+        self.refetched.add(point)
+
+        data_post = json.loads(response.request.body)
+        data_post.pop(self.settings.get('LIST_QUESTIONS_PAGE_PARAM'), None)
+        data_post['top'] = response.meta['top']
+        meta = response.meta.copy()
+        meta['page'] = None
+        meta['pages'] = 1
+        return response.request.replace(body=json.dumps(data_post), meta=meta)
 
     def parse_get_json(self,response):
         meta = response.meta.copy()
@@ -185,6 +283,11 @@ class QuestionsSpider(RedisSpider):
                     m = data.get("materials")
                     all_q.extend(m)
 
+            if self.is_repeated_page(response, all_q):
+                request = self.unpaged_request(response)
+                if request:
+                    yield request
+                return
 
             for q in all_q:
                 # 完整的一道题：类型 -> 题目 -> 选项 -> 正确答案 -> 解析
@@ -262,4 +365,5 @@ class QuestionsSpider(RedisSpider):
 
             self.logger.info(f'题目《{tile}》解析完成，开始存入reids数据库')
         else:
+            self.is_repeated_page(response, [])
             self.logger.info(f"题目《{tile}》解析失败，相应状态码{response.status},url为{response.url}")